@@ -3,6 +3,8 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
 
+from quantile_sketch import SketchStore
+
 '''
 Uses .txt files containing stardist segmentation measurements, exported from the open-source software QuPath.
 The primary purpose of this script is to analyze the intensity distribution of detected objects, filter out background noise, perform normalization, and aggregate intensity metrics across multiple datasets. 
@@ -36,7 +38,8 @@ lower_25th_percentile_list = []
 median_intensity_list = []
 upper_75th_percentile_list = []
 custom_max_value_list = []
-all_unfiltered_intensity = []
+# Quantile sketch of the unfiltered intensities per (file, class) instead of a list of every value
+sketches = SketchStore()
 
 # For every file ending in .txt in that path, we will run through this loop of calculations once.
 for f in filelist:
@@ -77,7 +80,8 @@ for f in filelist:
         median_intensity_list.append(custom_min_value + Quant_Intensity[0.5] * (custom_max_value - custom_min_value))
         upper_75th_percentile_list.append(custom_min_value + Quant_Intensity[0.75] * (custom_max_value - custom_min_value))
         custom_max_value_list.append(custom_max_value)
-        all_unfiltered_intensity.extend(Cell["Cy5: Mean"].values)
+        for name, cells in Cell.groupby("Name"):
+            sketches.add(f, name, "Cy5: Mean", cells["Cy5: Mean"])
 
 # Calculate overall mean values across all files
 overall_mean_custom_min_value = sum(custom_min_value_list) / len(custom_min_value_list)
@@ -94,3 +98,7 @@ overall_values = pd.DataFrame({
 
 # Writes a csv file with the overall values in the path
 overall_values.to_csv("Overall_Values_minmedmax_normalized_custommax.csv", index=False)
+
+# Save the sketches (mergeable across runs) and the pooled percentiles of all files
+sketches.save("intensity_quantile_sketches.json")
+sketches.percentiles(by=("measurement",)).to_csv("Pooled_Percentiles_unfiltered.csv", index=False)
@@ -3,6 +3,8 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
 
+from quantile_sketch import SketchStore
+
 # Path to data
 path_det = "/Users/jamieannemortel/Downloads/RawData_VGLUT2/detection results"
 os.chdir(path_det)
@@ -23,7 +25,8 @@ lower_25th_percentile_list = []
 median_intensity_list = []
 upper_75th_percentile_list = []
 custom_max_value_list = []
-all_unfiltered_intensity = []
+# Quantile sketch of the unfiltered intensities per (file, class) instead of a list of every value
+sketches = SketchStore()
 
 # For every file ending in .txt in that path, we will run through this loop of calculations once.
 for f in filelist:
@@ -81,7 +84,8 @@ for f in filelist:
         median_intensity_list.append(custom_min_value + Quant_Intensity[0.5] * (custom_max_value - custom_min_value))
         upper_75th_percentile_list.append(custom_min_value + Quant_Intensity[0.75] * (custom_max_value - custom_min_value))
         custom_max_value_list.append(custom_max_value)
-        all_unfiltered_intensity.extend(Cell["AF568: Cell: Mean"].values)
+        for name, cells in Cell.groupby("Name"):
+            sketches.add(f, name, "AF568: Cell: Mean", cells["AF568: Cell: Mean"])
     else:
         print(f"No valid data found for {Pink_posName} in {f}")
 
@@ -102,5 +106,9 @@ if custom_min_value_list:
 
     # Writes a csv file with the overall values in the path
     overall_values.to_csv(os.path.join(plots_dir, "Overall_Values_minmedmax_normalized_custommax.csv"), index=False)
+
+    # Save the sketches (mergeable across runs) and the pooled percentiles of all files
+    sketches.save(os.path.join(plots_dir, "intensity_quantile_sketches.json"))
+    sketches.percentiles(by=("measurement",)).to_csv(os.path.join(plots_dir, "Pooled_Percentiles_unfiltered.csv"), index=False)
 else:
     print("No valid data was found for processing.")
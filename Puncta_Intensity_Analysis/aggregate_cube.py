@@ -0,0 +1,456 @@
+import argparse
+import json
+import os
+import re
+import numpy as np
+import pandas as pd
+
+from quantile_sketch import COMPRESSION, SketchStore, merge_digests
+
+'''
+Mergeable per-(sample, class, measurement) partial aggregates, re-aggregated ("rolled up")
+over any sample grouping without re-reading the exports.
+
+For every sample, class and measurement the cube keeps the cell count, the sum and the sum
+of squares, the min and max, a histogram on fixed bins and a quantile sketch. All of these
+add up across samples, so the statistics of any group of samples (an animal, a hemisphere,
+an iteration, ...) are sums over the sample axis of the cube arrays: one np.add.reduceat per
+array, milliseconds even for thousands of samples.
+
+The grouping columns come from sample metadata: parsed from the sample names with a regex
+(named groups become columns) and/or joined from a CSV with a "Sample" column:
+
+    python aggregate_cube.py cube.npz --by date --metadata animals.csv
+
+Percentiles are read off the merged histograms by default (fast; accurate to the bin
+width) or off the merged quantile sketches with --source sketch. Groups with values outside
+a measurement's histogram range take their percentiles from the sketches either way (with a
+warning), so set the histogram range of every measurement to the range of its values.
+'''
+
+# Histogram bins (start, stop, number of bins) of measurements without their own setting;
+# values outside the range are counted in the first/last bin (roll-ups fall back to the
+# quantile sketches for them)
+DEFAULT_HISTOGRAM = (0.0, 1024.0, 256)
+
+# Histogram bins of mean channel intensities: the full range of the 16-bit images
+INTENSITY_HISTOGRAM = (0.0, 65536.0, 4096)
+
+# Names of the CZI scene exports, e.g. "2023_06_23__RecognizedCode-2.czi - Scene #1.txt"
+SAMPLE_NAME_PATTERN = r"(?P<date>\d{4}_\d{2}_\d{2})__(?P<slide>.+?)\.czi - Scene #(?P<scene>\d+)"
+
+CUBE_FORMAT_VERSION = 1
+
+# Per-(sample, class, measurement) partials and the value of an empty cell of the cube
+STAT_FIELDS = {"count": 0.0, "total": 0.0, "squares": 0.0, "minimum": np.inf, "maximum": -np.inf}
+
+
+def histogram_edges(start, stop, bins):
+    """
+    Returns the bin edges of a (start, stop, number of bins) histogram setting.
+    """
+    return np.linspace(float(start), float(stop), int(bins) + 1)
+
+
+def parse_sample_names(samples, pattern=SAMPLE_NAME_PATTERN):
+    """
+    Parses metadata out of sample names.
+
+    Parameters:
+        samples (list): Sample names.
+        pattern (str): Regex whose named groups become the metadata columns.
+
+    Returns:
+        pd.DataFrame: One row per sample (indexed by name); NaN where the name does not match.
+    """
+    regex = re.compile(pattern)
+    rows = {}
+    for sample in samples:
+        match = regex.search(sample)
+        rows[sample] = match.groupdict() if match else {}
+    unmatched = sum(1 for row in rows.values() if not row)
+    if unmatched:
+        print(f"{unmatched} of {len(rows)} sample names do not match the sample name pattern.")
+    return pd.DataFrame.from_dict(rows, orient="index", columns=list(regex.groupindex))
+
+
+def read_metadata(path, samples, sample_column="Sample"):
+    """
+    Reads sample metadata (e.g. animal, hemisphere) from a CSV with one row per sample.
+    Samples are matched by their full name or by their name without extension.
+
+    Returns:
+        pd.DataFrame: One row per sample (indexed by name); NaN for samples not in the CSV.
+    """
+    table = pd.read_csv(path, dtype=str).drop_duplicates(sample_column, keep="last").set_index(sample_column)
+    names = [sample if sample in table.index else os.path.splitext(sample)[0] for sample in samples]
+    return table.reindex(names).set_axis(list(samples))
+
+
+def sample_metadata(samples, pattern=SAMPLE_NAME_PATTERN, metadata_csv=None):
+    """
+    Returns the metadata of the samples: columns parsed from the names (if pattern is not
+    None) joined with the columns of a metadata CSV (which take precedence).
+    """
+    metadata = parse_sample_names(samples, pattern) if pattern else pd.DataFrame(index=list(samples))
+    if metadata_csv:
+        table = read_metadata(metadata_csv, samples)
+        metadata = metadata.drop(columns=[column for column in table.columns if column in metadata.columns])
+        metadata = metadata.join(table)
+    return metadata
+
+
+def _histogram_quantiles(counts, edges, q, minimum, maximum):
+    # Percentiles of binned counts (..., bins), interpolated linearly within the bins and
+    # clipped to the exact min/max (values outside the bins sit in the first/last bin)
+    cumulative = np.cumsum(counts, axis=-1, dtype=np.float64)
+    total = cumulative[..., -1:]
+    result = []
+    for quantile in q:
+        target = quantile * total
+        index = np.minimum((cumulative < target).sum(axis=-1, keepdims=True), counts.shape[-1] - 1)
+        before = np.take_along_axis(cumulative, index, axis=-1) - np.take_along_axis(counts, index, axis=-1)
+        inside = np.take_along_axis(counts, index, axis=-1)
+        fraction = np.divide(target - before, inside, out=np.zeros(target.shape), where=inside > 0)
+        value = edges[index] + fraction * (edges[index + 1] - edges[index])
+        result.append(np.clip(value[..., 0], minimum, maximum))
+    return result
+
+
+class AggregateCube:
+    """
+    Count, sums, min/max, histogram and quantile sketch of every (sample, class, measurement).
+
+    Parameters:
+        classes (list): Class (cell type) labels.
+        measurements (list): Measurement names.
+        histograms (dict): Measurement -> (start, stop, bins); DEFAULT_HISTOGRAM otherwise.
+        compression (float): Compression of the quantile sketches.
+    """
+
+    def __init__(self, classes, measurements, histograms=None, compression=COMPRESSION):
+        histograms = histograms or {}
+        self.classes = list(classes)
+        self.measurements = list(measurements)
+        self.edges = {m: histogram_edges(*histograms.get(m, DEFAULT_HISTOGRAM)) for m in self.measurements}
+        self.samples = []
+        self.sketches = SketchStore(compression)
+        self._index = {}
+        self._capacity = 0
+        self._stats = {field: self._empty(field, 0) for field in STAT_FIELDS}
+        self._histograms = {m: np.zeros((0, len(self.classes), len(self.edges[m]) - 1), dtype=np.uint32)
+                            for m in self.measurements}
+
+    def _empty(self, field, n_samples):
+        return np.full((n_samples, len(self.classes), len(self.measurements)), STAT_FIELDS[field])
+
+    def _grow(self, capacity):
+        # Room for more samples (capacity doubles, so adding samples one by one stays linear)
+        for field, array in self._stats.items():
+            grown = self._empty(field, capacity)
+            grown[:self._capacity] = array
+            self._stats[field] = grown
+        for measurement, array in self._histograms.items():
+            grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+            grown[:self._capacity] = array
+            self._histograms[measurement] = grown
+        self._capacity = capacity
+
+    def add_sample(self, sample):
+        """
+        Registers a sample (also one without cells) and returns its index in the cube.
+        """
+        if sample not in self._index:
+            if len(self.samples) == self._capacity:
+                self._grow(max(16, 2 * self._capacity))
+            self._index[sample] = len(self.samples)
+            self.samples.append(sample)
+        return self._index[sample]
+
+    def add(self, sample, cls, measurement, values):
+        """
+        Adds the values of one (sample, class, measurement); NaNs and infinities are ignored.
+        """
+        slot = self.add_sample(sample)
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[np.isfinite(values)]
+        if not len(values):
+            return
+        c, m = self.classes.index(cls), self.measurements.index(measurement)
+        stats = self._stats
+        stats["count"][slot, c, m] += len(values)
+        stats["total"][slot, c, m] += values.sum()
+        stats["squares"][slot, c, m] += np.dot(values, values)
+        stats["minimum"][slot, c, m] = min(stats["minimum"][slot, c, m], values.min())
+        stats["maximum"][slot, c, m] = max(stats["maximum"][slot, c, m], values.max())
+
+        edges = self.edges[measurement]
+        bins = np.clip(np.searchsorted(edges, values, side="right") - 1, 0, len(edges) - 2)
+        self._histograms[measurement][slot, c] += np.bincount(bins, minlength=len(edges) - 1).astype(np.uint32)
+        self.sketches.add(sample, cls, measurement, values)
+
+    def add_frame(self, sample, cells_by_class):
+        """
+        Adds every cube measurement found in the columns of per-class cell tables.
+
+        Parameters:
+            sample (str): Sample (export) name.
+            cells_by_class (dict): Class label -> DataFrame of its cells.
+        """
+        self.add_sample(sample)
+        for cls, cells in cells_by_class.items():
+            for measurement in self.measurements:
+                if measurement in cells.columns:
+                    self.add(sample, cls, measurement, pd.to_numeric(cells[measurement], errors="coerce"))
+
+    def add_cells(self, measurement, values, class_codes, classes, sample_ids, samples):
+        """
+        Adds per-cell values grouped by class code and sample id (e.g. a CellStore's arrays).
+
+        Parameters:
+            measurement (str): Measurement name.
+            values, class_codes, sample_ids (array-like): One entry per cell.
+            classes (list): Class labels (class code -> label).
+            samples (list): Sample names (sample id -> name); all of them are registered.
+        """
+        for sample in samples:
+            self.add_sample(sample)
+        values = np.asarray(values, dtype=np.float64)
+        class_codes = np.asarray(class_codes)
+        sample_ids = np.asarray(sample_ids)
+        order = np.lexsort((class_codes, sample_ids))
+        values, class_codes, sample_ids = values[order], class_codes[order], sample_ids[order]
+        starts = np.flatnonzero(np.r_[True, (class_codes[1:] != class_codes[:-1]) | (sample_ids[1:] != sample_ids[:-1])])
+        for start, end in zip(starts, np.r_[starts[1:], len(values)]):
+            self.add(samples[sample_ids[start]], classes[class_codes[start]], measurement, values[start:end])
+
+    def _extend(self, classes, measurements, edges):
+        # Adds classes and measurements of another cube (shared measurements need equal bins)
+        for measurement in measurements:
+            if measurement in self.edges and not np.array_equal(self.edges[measurement], edges[measurement]):
+                raise ValueError(f"Histogram bins of {measurement} differ between the cubes.")
+        new_classes = [cls for cls in classes if cls not in self.classes]
+        new_measurements = [m for m in measurements if m not in self.measurements]
+        if not new_classes and not new_measurements:
+            return
+        n_classes, n_measurements = len(self.classes), len(self.measurements)
+        self.classes += new_classes
+        self.measurements += new_measurements
+        for field, array in self._stats.items():
+            grown = self._empty(field, self._capacity)
+            grown[:, :n_classes, :n_measurements] = array
+            self._stats[field] = grown
+        for measurement, array in self._histograms.items():
+            grown = np.zeros((self._capacity, len(self.classes), array.shape[2]), dtype=array.dtype)
+            grown[:, :n_classes] = array
+            self._histograms[measurement] = grown
+        for measurement in new_measurements:
+            self.edges[measurement] = np.asarray(edges[measurement], dtype=np.float64)
+            self._histograms[measurement] = np.zeros(
+                (self._capacity, len(self.classes), len(self.edges[measurement]) - 1), dtype=np.uint32)
+
+    def merge(self, other):
+        """
+        Adds all partials of another cube (e.g. another run, panel or worker). Samples in
+        both cubes are combined; new samples, classes and measurements are added.
+        """
+        self._extend(other.classes, other.measurements, other.edges)
+        slots = np.array([self.add_sample(sample) for sample in other.samples], dtype=np.intp)
+        n = len(other.samples)
+        c = [self.classes.index(cls) for cls in other.classes]
+        m = [self.measurements.index(measurement) for measurement in other.measurements]
+        target = np.ix_(slots, c, m)
+        for field in ("count", "total", "squares"):
+            self._stats[field][target] += other._stats[field][:n]
+        self._stats["minimum"][target] = np.minimum(self._stats["minimum"][target], other._stats["minimum"][:n])
+        self._stats["maximum"][target] = np.maximum(self._stats["maximum"][target], other._stats["maximum"][:n])
+        for measurement, histogram in other._histograms.items():
+            self._histograms[measurement][np.ix_(slots, c)] += histogram[:n]
+        self.sketches.merge(other.sketches)
+
+    def _groups(self, by, metadata):
+        # Sample indices sorted by group, the start of every group and the group keys;
+        # samples without a value in one of the grouping columns are left out
+        if metadata is None:
+            metadata = sample_metadata(self.samples)
+        metadata = metadata.reindex(self.samples)
+        missing = [column for column in by if column not in metadata.columns]
+        if missing:
+            raise KeyError(f"Unknown metadata columns {missing} (available: {list(metadata.columns)})")
+        if not by:
+            return np.arange(len(self.samples)), np.array([0]), pd.DataFrame(index=[0])
+        keys = metadata[by]
+        keep = np.flatnonzero(keys.notna().all(axis=1).to_numpy())
+        if len(keep) < len(self.samples):
+            print(f"{len(self.samples) - len(keep)} samples without {', '.join(by)} left out of the roll-up.")
+        codes, groups = pd.MultiIndex.from_frame(keys.iloc[keep]).factorize(sort=True)
+        order = np.argsort(codes, kind="stable")
+        starts = np.flatnonzero(np.r_[True, codes[order][1:] != codes[order][:-1]])
+        return keep[order], starts, pd.DataFrame(groups.tolist(), columns=by)
+
+    def rollup(self, by=(), metadata=None, classes=None, measurements=None, q=(0.25, 0.5, 0.75),
+               source="histogram"):
+        """
+        Re-aggregates the cube over groups of samples.
+
+        Parameters:
+            by (list): Metadata columns to group the samples by ([] pools all samples).
+            metadata (pd.DataFrame): Metadata indexed by sample name (default: parsed from
+                the sample names with SAMPLE_NAME_PATTERN, see sample_metadata).
+            classes, measurements (list): Only these classes/measurements (default: all).
+            q (list): Quantiles (0-1) of the percentile columns.
+            source (str): "histogram" (fast) or "sketch" (merged quantile sketches); groups
+                with values outside the histogram range always use the sketches.
+
+        Returns:
+            pd.DataFrame: One row per group, class and measurement with cells: the grouping
+            columns, "Class", "Measurement", "Samples", "Count", "Mean", "Standard Deviation",
+            "Min", "Max" and one "<q>th Percentile" column per quantile.
+        """
+        by = [by] if isinstance(by, str) else list(by)
+        classes = self.classes if classes is None else list(classes)
+        measurements = self.measurements if measurements is None else list(measurements)
+        c = [self.classes.index(cls) for cls in classes]
+        m = [self.measurements.index(measurement) for measurement in measurements]
+        slots, starts, groups = self._groups(by, metadata)
+        if not len(slots):
+            return pd.DataFrame()
+
+        def reduce(field, ufunc):
+            return ufunc.reduceat(self._stats[field][np.ix_(slots, c, m)], starts, axis=0)
+
+        count = reduce("count", np.add)
+        total = reduce("total", np.add)
+        squares = reduce("squares", np.add)
+        minimum = reduce("minimum", np.minimum)
+        maximum = reduce("maximum", np.maximum)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = total / count
+            variance = np.maximum(squares - total * mean, 0) / (count - 1)
+        variance[count < 2] = np.nan
+
+        ends = np.r_[starts[1:], len(slots)]
+        # (class, measurement) -> {sample: sketch key}, so groups look their sketches up directly
+        sketch_keys = {}
+        for key in self.sketches.sketches:
+            sketch_keys.setdefault(key[1:], {})[key[0]] = key
+
+        def sketch_quantiles(g, cls, measurement):
+            by_sample = sketch_keys.get((cls, measurement), {})
+            keys = [by_sample[self.samples[slot]] for slot in slots[starts[g]:ends[g]] if self.samples[slot] in by_sample]
+            if not keys:
+                return np.nan
+            return merge_digests([self.sketches.sketches[key] for key in keys], self.sketches.compression).quantile(q)
+
+        percentiles = np.full((len(q),) + count.shape, np.nan)
+        for j, measurement in enumerate(measurements):
+            if source == "sketch":
+                use_sketch = count[..., j] > 0
+            else:
+                edges = self.edges[measurement]
+                counts = np.add.reduceat(self._histograms[measurement][np.ix_(slots, c)], starts, axis=0, dtype=np.int64)
+                percentiles[:, ..., j] = _histogram_quantiles(counts, edges, q, minimum[..., j], maximum[..., j])
+                # Values outside the bins were counted in the first/last bin: use the sketches
+                use_sketch = (count[..., j] > 0) & ((minimum[..., j] < edges[0]) | (maximum[..., j] > edges[-1]))
+                if use_sketch.any():
+                    print(f"{measurement}: values outside the histogram range ({edges[0]:g} to {edges[-1]:g}) in "
+                          f"{use_sketch.sum()} group/class combinations; their percentiles come from the quantile sketches.")
+            for g, i in zip(*np.nonzero(use_sketch)):
+                percentiles[:, g, i, j] = sketch_quantiles(g, classes[i], measurement)
+
+        g, i, j = np.nonzero(count > 0)
+        table = groups.iloc[g].reset_index(drop=True)
+        table["Class"] = np.array(classes, dtype=object)[i]
+        table["Measurement"] = np.array(measurements, dtype=object)[j]
+        table["Samples"] = np.diff(np.r_[starts, len(slots)])[g]
+        table["Count"] = count[g, i, j].astype(np.int64)
+        table["Mean"] = mean[g, i, j]
+        table["Standard Deviation"] = np.sqrt(variance[g, i, j])
+        table["Min"] = minimum[g, i, j]
+        table["Max"] = maximum[g, i, j]
+        for k, quantile in enumerate(q):
+            table[f"{quantile * 100:g}th Percentile"] = percentiles[k, g, i, j]
+        return table
+
+    def histograms(self, measurement, by=(), metadata=None, classes=None):
+        """
+        Returns the histograms of one measurement summed over groups of samples.
+
+        Returns:
+            tuple: (group keys DataFrame, bin edges, counts array of shape
+            (groups, classes, bins)).
+        """
+        by = [by] if isinstance(by, str) else list(by)
+        classes = self.classes if classes is None else list(classes)
+        slots, starts, groups = self._groups(by, metadata)
+        c = [self.classes.index(cls) for cls in classes]
+        counts = np.add.reduceat(self._histograms[measurement][np.ix_(slots, c)], starts, axis=0, dtype=np.int64)
+        return groups, self.edges[measurement], counts
+
+    def save(self, path):
+        """
+        Writes the cube as a compressed .npz file (temp file + rename).
+        """
+        n = len(self.samples)
+        arrays = {field: array[:n] for field, array in self._stats.items()}
+        for i, measurement in enumerate(self.measurements):
+            arrays[f"histogram_{i}"] = self._histograms[measurement][:n]
+            arrays[f"edges_{i}"] = self.edges[measurement]
+        meta = {
+            "version": CUBE_FORMAT_VERSION, "samples": self.samples, "classes": self.classes,
+            "measurements": self.measurements, "sketches": self.sketches.to_dict(),
+        }
+        with open(path + ".tmp", "wb") as file:
+            np.savez_compressed(file, meta=np.array(json.dumps(meta)), **arrays)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads a cube written by save.
+        """
+        with np.load(path) as content:
+            meta = json.loads(str(content["meta"]))
+            sketches = SketchStore.from_dict(meta["sketches"])
+            cube = cls(meta["classes"], meta["measurements"], compression=sketches.compression)
+            n = len(meta["samples"])
+            cube._grow(n)
+            for field in STAT_FIELDS:
+                cube._stats[field][:n] = content[field]
+            for i, measurement in enumerate(cube.measurements):
+                cube.edges[measurement] = content[f"edges_{i}"]
+                cube._histograms[measurement] = content[f"histogram_{i}"].copy()
+        cube.samples = list(meta["samples"])
+        cube._index = {sample: i for i, sample in enumerate(cube.samples)}
+        cube.sketches = sketches
+        return cube
+
+
+def load_cubes(paths):
+    """
+    Loads and merges several saved cubes (e.g. of different runs or panels).
+    """
+    cube = AggregateCube.load(paths[0])
+    for path in paths[1:]:
+        cube.merge(AggregateCube.load(path))
+    return cube
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Roll up saved aggregate cubes over sample metadata.")
+    parser.add_argument("cubes", nargs="+", help="Cube files (.npz) to merge")
+    parser.add_argument("--by", nargs="*", default=[], help="Metadata columns to group the samples by")
+    parser.add_argument("--metadata", help="CSV with a Sample column and one column per metadata field")
+    parser.add_argument("--pattern", default=SAMPLE_NAME_PATTERN, help="Regex (named groups) parsing sample names")
+    parser.add_argument("--classes", nargs="*", help="Only these classes")
+    parser.add_argument("--measurements", nargs="*", help="Only these measurements")
+    parser.add_argument("--source", choices=["histogram", "sketch"], default="histogram", help="Percentiles from")
+    parser.add_argument("--output", help="Write the roll-up to this CSV file")
+    args = parser.parse_args()
+
+    merged = load_cubes(args.cubes)
+    metadata = sample_metadata(merged.samples, args.pattern or None, args.metadata)
+    table = merged.rollup(args.by, metadata, args.classes, args.measurements, source=args.source)
+    print(table.to_string(index=False))
+    if args.output:
+        table.to_csv(args.output, index=False)
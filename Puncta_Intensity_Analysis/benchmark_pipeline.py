@@ -0,0 +1,228 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+from aggregate_cube import INTENSITY_HISTOGRAM, AggregateCube
+from distribution_engine import DistributionSummary
+from gating import gate_groups
+from hierarchy_join import join_children
+from panel_pipeline import load_panel
+from plot_renderer import PlotQueue
+from qupath_io import ClassIndex, list_exports, read_export
+from resampling import compare_groups
+from summary_engine import annotation_area, summarize_samples
+from synthetic_exports import write_exports
+
+'''
+Benchmarks of the pipeline stages on synthetic exports (see synthetic_exports.py) at several
+scales, so changes in speed and memory show up as numbers instead of impressions.
+
+For every scale (images x cells per image) the exports are generated once, then each stage
+is run and timed (wall clock) with its peak traced memory (tracemalloc):
+
+    ingest     parse every detection and annotation export (no parse cache)
+    classify   class index per export, cell groups selected, cell-to-spot join
+    aggregate  per-sample summary table, aggregate cube and a roll-up by date
+    stats      distribution summary, KDE + IQR gating, permutation/bootstrap comparison
+    plotting   histogram and CDF of every cell group (one process)
+
+Stages use the panel config (default panels/vgat_oprm1.json) with its paths pointed at the
+synthetic data. Results are written as JSON; with --baseline the run is compared to an
+earlier result file and stages slower by more than --tolerance are reported:
+
+    python benchmark_pipeline.py --scales 4x5000 16x20000 --output bench.json --baseline old.json
+'''
+
+DEFAULT_SCALES = ["2x2000", "4x10000", "8x40000"]
+
+DEFAULT_PANEL = os.path.join(os.path.dirname(os.path.abspath(__file__)), "panels", "vgat_oprm1.json")
+
+STAGES = ["ingest", "classify", "aggregate", "stats", "plotting"]
+
+# Resamples of the comparison in the stats stage (kept small: this times the machinery)
+N_RESAMPLES = 1000
+
+
+def parse_scale(text):
+    """
+    Returns (images, cells per image) of a scale written as "<images>x<cells>".
+    """
+    images, cells = text.lower().split("x")
+    return int(images), int(cells)
+
+
+def measure(function, trace_memory=True):
+    """
+    Runs function once.
+
+    Returns:
+        tuple: (result, seconds, peak traced memory in MB or None).
+    """
+    gc.collect()
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = function()
+    seconds = time.perf_counter() - start
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    return result, seconds, peak
+
+
+def stage_ingest(panel):
+    detections = {}
+    for file in list_exports(panel["paths"]["raw_detection"]):
+        name = file.replace(" Detections", "")
+        det = read_export(os.path.join(panel["paths"]["raw_detection"], file), use_cache=False)
+        ano = read_export(os.path.join(panel["paths"]["raw_annotation"], name), use_cache=False)
+        detections[name] = (det, annotation_area(ano))
+    return detections
+
+
+def stage_classify(panel, detections):
+    groups = {}
+    for name, (det, _) in detections.items():
+        cells = ClassIndex(det, "Classification")
+        parents = ClassIndex(det, "Parent")
+        for group, settings in panel["cell_groups"].items():
+            selected = cells.select(settings["labels"])
+            children = parents.select([f"Cell ({label})" for label in settings["labels"]])
+            groups.setdefault(group, []).append(join_children(selected, children, how="id"))
+    return {group: pd.concat(frames, ignore_index=True) for group, frames in groups.items()}
+
+
+def stage_aggregate(panel, detections):
+    samples = [(name, det, area) for name, (det, area) in detections.items()]
+    summary = summarize_samples(samples, panel["cell_groups"], panel.get("subcellular_classes", []),
+                                panel.get("subcellular_metrics", []), **panel.get("summary_options", {}))
+    column = f"{panel['markers']['oprm1']}: Cell: Mean"
+    spots = "Subcellular: Channel 2: Num spots estimated"
+    cube = AggregateCube(list(panel["cell_groups"]), [column, spots], histograms={column: INTENSITY_HISTOGRAM, spots: (0, 64, 64)})
+    for name, (det, _) in detections.items():
+        cells = ClassIndex(det, "Classification")
+        cube.add_frame(name, {group: cells.select(settings["labels"]) for group, settings in panel["cell_groups"].items()})
+    return summary, cube.rollup(["date"])
+
+
+def stage_stats(panel, groups):
+    column = f"{panel['markers']['oprm1']}: Cell: Mean"
+    summary = DistributionSummary.from_groups({group: frame[column].to_numpy() for group, frame in groups.items()})
+    table = summary.statistics_table()
+    masks, gates = gate_groups(groups, [column], [{"rule": "kde"}, {"rule": "iqr"}])
+    first, second = list(groups)[:2]
+    comparison = compare_groups(groups[first][column], groups[second][column], n_resamples=N_RESAMPLES, n_workers=1)
+    return table, gates.statistics, comparison
+
+
+def stage_plotting(panel, groups, plots_dir):
+    column = f"{panel['markers']['oprm1']}: Cell: Mean"
+    plots = PlotQueue(n_workers=1)
+    for group, frame in groups.items():
+        values = frame[column].to_numpy()
+        stem = os.path.join(plots_dir, group.replace(":", "").replace(" ", "_"))
+        plots.add("hist", f"{stem}_histogram.png", values, title=group, bins=30, figsize=(10, 6))
+        plots.add("cdf", f"{stem}_cdf.png", values, title=group, figsize=(10, 6))
+    return plots.render()
+
+
+def run_scale(panel_path, n_images, cells_per_image, work_dir, trace_memory=True, seed=0):
+    """
+    Generates the exports of one scale and benchmarks every stage on them.
+
+    Returns:
+        list: One result dict per stage.
+    """
+    data_dir = os.path.join(work_dir, f"{n_images}x{cells_per_image}")
+    panel = load_panel(panel_path)
+    panel["paths"] = dict(panel["paths"], **write_exports(data_dir, n_images, cells_per_image, seed=seed))
+    plots_dir = os.path.join(data_dir, "plots")
+    os.makedirs(plots_dir, exist_ok=True)
+
+    runs = {
+        "ingest": lambda: stage_ingest(panel),
+        "classify": lambda: stage_classify(panel, detections),
+        "aggregate": lambda: stage_aggregate(panel, detections),
+        "stats": lambda: stage_stats(panel, groups),
+        "plotting": lambda: stage_plotting(panel, groups, plots_dir),
+    }
+    results = []
+    detections = groups = None
+    for stage in STAGES:
+        output, seconds, peak = measure(runs[stage], trace_memory)
+        if stage == "ingest":
+            detections = output
+        elif stage == "classify":
+            groups = output
+        results.append({
+            "images": n_images, "cells_per_image": cells_per_image, "cells": n_images * cells_per_image,
+            "stage": stage, "seconds": round(seconds, 4), "peak_memory_mb": None if peak is None else round(peak, 2),
+        })
+        memory = "" if peak is None else f", peak {peak:.1f} MB"
+        print(f"{n_images}x{cells_per_image} {stage}: {seconds:.3f} s{memory}")
+    shutil.rmtree(data_dir, ignore_errors=True)
+    return results
+
+
+def compare_to_baseline(results, baseline_path, tolerance=0.25):
+    """
+    Returns the stages that are slower than in the baseline file by more than the tolerance.
+    """
+    with open(baseline_path) as file:
+        baseline = {(r["images"], r["cells_per_image"], r["stage"]): r for r in json.load(file)["results"]}
+    regressions = []
+    for result in results:
+        before = baseline.get((result["images"], result["cells_per_image"], result["stage"]))
+        if before and before["seconds"] > 0 and result["seconds"] > before["seconds"] * (1 + tolerance):
+            regressions.append(dict(result, baseline_seconds=before["seconds"],
+                                    ratio=round(result["seconds"] / before["seconds"], 2)))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic exports.")
+    parser.add_argument("--scales", nargs="+", default=DEFAULT_SCALES, help="Scales as <images>x<cells per image>")
+    parser.add_argument("--panel", default=DEFAULT_PANEL, help="Panel config (JSON)")
+    parser.add_argument("--output", default="benchmark_results.json", help="Result file (JSON)")
+    parser.add_argument("--baseline", help="Earlier result file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown before a stage is reported")
+    parser.add_argument("--no-memory", action="store_true", help="Do not trace memory (tracing slows allocations)")
+    parser.add_argument("--work-dir", help="Directory for the synthetic exports (default: a temporary directory)")
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="puncta_benchmark_")
+    results = []
+    for scale in args.scales:
+        n_images, cells_per_image = parse_scale(scale)
+        results += run_scale(args.panel, n_images, cells_per_image, work_dir, trace_memory=not args.no_memory)
+    if not args.work_dir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "memory_traced": not args.no_memory,
+        "results": results,
+    }
+    if args.baseline:
+        report["regressions"] = compare_to_baseline(results, args.baseline, args.tolerance)
+        for regression in report["regressions"]:
+            print(f"Slower than baseline: {regression['images']}x{regression['cells_per_image']} {regression['stage']} "
+                  f"{regression['seconds']} s vs {regression['baseline_seconds']} s ({regression['ratio']}x)")
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Benchmark results saved to {args.output}")
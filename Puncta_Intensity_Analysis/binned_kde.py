@@ -0,0 +1,216 @@
+import hashlib
+import os
+from collections import OrderedDict
+import numpy as np
+from scipy.signal import find_peaks
+
+'''
+Binned Gaussian kernel density estimation for large 1-D samples (e.g. all oprm1+ cells).
+
+The values are linearly binned onto an evenly spaced grid and the bin weights are convolved
+with the sampled Gaussian kernel by FFT, so the cost is O(n + gridsize log gridsize) instead
+of O(n * gridsize) for evaluating scipy's gaussian_kde at every grid point. With the same
+bandwidth ("scott" by default, as gaussian_kde) the density agrees with the exact one to
+well within plotting accuracy.
+
+Bandwidths:
+    "scott"      n^(-1/5) * std, the gaussian_kde default
+    "silverman"  (3n/4)^(-1/5) * std, gaussian_kde's silverman rule
+    "plugin"     two-stage direct plug-in (Sheather-Jones type), with the density
+                 functionals also estimated from the binned data
+    a number     used as is
+
+Results are cached per dataset (hash of the values and settings), in memory (the last
+MEMORY_CACHE_SIZE results) and optionally as .npz files in a cache directory, so a threshold
+computed for a group can be reused by the plots of that group without recomputing the density.
+'''
+
+SQRT_2PI = np.sqrt(2 * np.pi)
+
+# Kernel evaluated up to this many bandwidths from each grid point
+KERNEL_CUTOFF = 5
+
+# Results kept in memory (least recently used dropped first)
+MEMORY_CACHE_SIZE = 8
+
+_memory_cache = OrderedDict()
+
+
+def _remember(key, result):
+    _memory_cache[key] = result
+    _memory_cache.move_to_end(key)
+    while len(_memory_cache) > MEMORY_CACHE_SIZE:
+        _memory_cache.popitem(last=False)
+
+
+def _spread(values):
+    # Robust scale estimate used by the plug-in rule: min(std, IQR / 1.349)
+    q75, q25 = np.percentile(values, [75, 25])
+    std = np.std(values, ddof=1)
+    iqr_scale = (q75 - q25) / 1.349
+    return min(std, iqr_scale) if iqr_scale > 0 else std
+
+
+def linear_binning(values, grid_min, grid_max, gridsize):
+    """
+    Spreads every value over its two neighbouring grid points in proportion to closeness.
+
+    Returns:
+        tuple: (grid, weights) with weights summing to the number of values inside the grid.
+    """
+    grid = np.linspace(grid_min, grid_max, gridsize)
+    delta = grid[1] - grid[0]
+    position = (np.asarray(values, dtype=np.float64) - grid_min) / delta
+    inside = (position >= 0) & (position <= gridsize - 1)
+    position = position[inside]
+    lower = np.minimum(np.floor(position).astype(np.intp), gridsize - 2)
+    fraction = position - lower
+    weights = np.bincount(lower, weights=1 - fraction, minlength=gridsize)
+    weights += np.bincount(lower + 1, weights=fraction, minlength=gridsize)
+    return grid, weights
+
+
+def _convolve(weights, kernel):
+    # Linear (not circular) convolution of the grid weights with a symmetric kernel sampled
+    # at lags -L..L, via zero-padded real FFTs
+    n = len(weights)
+    half = (len(kernel) - 1) // 2
+    size = 1 << int(np.ceil(np.log2(n + len(kernel) - 1)))
+    result = np.fft.irfft(np.fft.rfft(weights, size) * np.fft.rfft(kernel, size), size)
+    return result[half:half + n]
+
+
+def _binned_functional(weights, delta, n, g, r):
+    """
+    Binned estimate of the density functional psi_r = E[f^(r)(X)] with a Gaussian kernel of
+    bandwidth g (r = 4 or 6).
+    """
+    lags = np.arange(-(len(weights) - 1), len(weights)) * delta / g
+    phi = np.exp(-0.5 * lags ** 2) / SQRT_2PI
+    if r == 4:
+        derivative = (lags ** 4 - 6 * lags ** 2 + 3) * phi
+    else:
+        derivative = (lags ** 6 - 15 * lags ** 4 + 45 * lags ** 2 - 15) * phi
+    kernel = derivative / g ** (r + 1)
+    return float(weights @ _convolve(weights, kernel)) / n ** 2
+
+
+def plugin_bandwidth(values, gridsize=1024):
+    """
+    Two-stage direct plug-in bandwidth (Wand & Jones 1995, section 3.6) for a Gaussian kernel.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n = len(values)
+    sigma = _spread(values)
+    grid, weights = linear_binning(values, values.min(), values.max(), gridsize)
+    delta = grid[1] - grid[0]
+
+    # Normal-scale estimate of psi_8, then two plug-in stages for psi_6 and psi_4
+    psi8 = 105 / (32 * np.sqrt(np.pi) * sigma ** 9)
+    g1 = (30 / (SQRT_2PI * psi8 * n)) ** (1 / 9)
+    psi6 = _binned_functional(weights, delta, n, g1, 6)
+    g2 = (-6 / (SQRT_2PI * psi6 * n)) ** (1 / 7)
+    psi4 = _binned_functional(weights, delta, n, g2, 4)
+    return (1 / (2 * np.sqrt(np.pi) * psi4 * n)) ** (1 / 5)
+
+
+def select_bandwidth(values, method="scott"):
+    """
+    Returns the kernel bandwidth (standard deviation of the Gaussian) for the values.
+    """
+    if not isinstance(method, str):
+        return float(method)
+    n = len(values)
+    if method == "scott":
+        return n ** (-1 / 5) * np.std(values, ddof=1)
+    if method == "silverman":
+        return (n * 3 / 4) ** (-1 / 5) * np.std(values, ddof=1)
+    if method == "plugin":
+        return plugin_bandwidth(values)
+    raise ValueError(f"Unknown bandwidth method: {method}")
+
+
+class KDEResult:
+    """
+    Density on an evenly spaced grid with its peaks and valleys.
+
+    Attributes:
+        x (np.ndarray): Grid points.
+        y (np.ndarray): Density at the grid points.
+        bandwidth (float): Kernel bandwidth used.
+        peaks (np.ndarray): Grid indices of the local maxima.
+        valleys (np.ndarray): Grid indices of the local minima.
+    """
+
+    def __init__(self, x, y, bandwidth):
+        self.x = x
+        self.y = y
+        self.bandwidth = bandwidth
+        self.peaks, _ = find_peaks(y)
+        self.valleys, _ = find_peaks(-y)
+
+    @property
+    def threshold(self):
+        """
+        Position of the first valley (the KDE valley threshold), or None without a valley.
+        """
+        return float(self.x[self.valleys[0]]) if len(self.valleys) else None
+
+
+def _cache_key(values, bandwidth, gridsize, grid_range):
+    digest = hashlib.sha1()
+    digest.update(repr((bandwidth, gridsize, grid_range)).encode("utf-8"))
+    digest.update(np.ascontiguousarray(values, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+def binned_kde(values, bandwidth="scott", gridsize=1000, grid_range=None, cache_dir=None):
+    """
+    Gaussian KDE of 1-D values on an evenly spaced grid, by linear binning and FFT.
+
+    Parameters:
+        values (array-like): Sample (NaNs are dropped).
+        bandwidth (str or float): "scott", "silverman", "plugin" or a fixed bandwidth.
+        gridsize (int): Number of grid points.
+        grid_range (tuple): (min, max) of the grid (default: min and max of the values).
+        cache_dir (str): Optional directory for cached results (.npz).
+
+    Returns:
+        KDEResult: The density grid with its peaks and valleys, or None for fewer than two values
+        or values without spread.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    values = values[~np.isnan(values)]
+    if len(values) < 2:
+        return None
+
+    key = _cache_key(values, bandwidth, gridsize, grid_range)
+    if key in _memory_cache:
+        _memory_cache.move_to_end(key)
+        return _memory_cache[key]
+    cache_path = os.path.join(cache_dir, f"kde-{key[:16]}.npz") if cache_dir else None
+    if cache_path and os.path.exists(cache_path):
+        cached = np.load(cache_path)
+        result = KDEResult(cached["x"], cached["y"], float(cached["bandwidth"]))
+        _remember(key, result)
+        return result
+
+    h = select_bandwidth(values, bandwidth)
+    if not h > 0:
+        return None
+    grid_min, grid_max = grid_range if grid_range is not None else (values.min(), values.max())
+    grid, weights = linear_binning(values, grid_min, grid_max, gridsize)
+    delta = grid[1] - grid[0]
+
+    # Gaussian kernel sampled at the grid spacing, cut off at KERNEL_CUTOFF bandwidths
+    n_lags = min(gridsize - 1, int(np.ceil(KERNEL_CUTOFF * h / delta)))
+    lags = np.arange(-n_lags, n_lags + 1) * delta
+    kernel = np.exp(-0.5 * (lags / h) ** 2) / (SQRT_2PI * h)
+    density = np.maximum(_convolve(weights, kernel), 0) / len(values)
+
+    result = KDEResult(grid, density, h)
+    _remember(key, result)
+    if cache_path:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.savez(cache_path, x=grid, y=density, bandwidth=h)
+    return result
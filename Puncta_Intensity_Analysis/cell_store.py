@@ -0,0 +1,158 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+
+'''
+Compact on-disk store of per-cell measurements for cross-image (pooled) distribution analysis.
+
+Every cell is one entry in three flat binary files that are appended to file by file:
+
+    values.f32      float32 measurement
+    classes.u8/u16  class code (index into the store's class list)
+    samples.u32     sample id (index into the store's sample list)
+
+plus a small JSON file with the class list, the samples (with the fingerprints of their
+exports) and the number of cells written. That is 9-10 bytes per cell instead of a Python
+tuple per cell. Later runs memory-map the arrays instead of re-reading the exports, as long
+as the exports have not changed.
+'''
+
+META_FILENAME = "store.json"
+
+
+def _code_dtype(n_classes):
+    return np.uint8 if n_classes <= np.iinfo(np.uint8).max + 1 else np.uint16
+
+
+class CellStore:
+    """
+    Append-only per-cell store of one measurement, grouped by class and sample.
+
+    Parameters:
+        store_dir (str): Directory holding the store files (created if missing).
+        classes (list): Class labels; their order defines the class codes.
+        metric (str): Name of the stored measurement (e.g. "Num spots").
+    """
+
+    def __init__(self, store_dir, classes, metric):
+        self.store_dir = store_dir
+        self.classes = list(classes)
+        self.metric = metric
+        self.code_dtype = _code_dtype(len(self.classes))
+        self.paths = {
+            "values": os.path.join(store_dir, "values.f32"),
+            "classes": os.path.join(store_dir, f"classes.u{np.dtype(self.code_dtype).itemsize * 8}"),
+            "samples": os.path.join(store_dir, "samples.u32"),
+        }
+        self.dtypes = {"values": np.float32, "classes": self.code_dtype, "samples": np.uint32}
+        self.meta_path = os.path.join(store_dir, META_FILENAME)
+        os.makedirs(store_dir, exist_ok=True)
+
+        self.samples = {}
+        self.n_cells = 0
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as file:
+                meta = json.load(file)
+            if meta.get("classes") == self.classes and meta.get("metric") == metric:
+                self.samples = meta["samples"]
+                self.n_cells = meta["n_cells"]
+        # Drop anything written after the last saved count (e.g. an interrupted run)
+        self._truncate(self.n_cells)
+
+    def _truncate(self, n_cells):
+        for key, path in self.paths.items():
+            with open(path, "ab") as file:
+                file.truncate(n_cells * np.dtype(self.dtypes[key]).itemsize)
+
+    def is_current(self, fingerprints):
+        """
+        Returns True if the store holds exactly these exports with these fingerprints.
+
+        Parameters:
+            fingerprints (dict): Sample name -> fingerprint (any JSON-serializable value).
+        """
+        stored = {name: sample["fingerprint"] for name, sample in self.samples.items()}
+        return stored == dict(fingerprints)
+
+    def reset(self):
+        """
+        Empties the store.
+        """
+        self.samples = {}
+        self.n_cells = 0
+        self._truncate(0)
+
+    def append(self, sample, values_by_class, fingerprint=None):
+        """
+        Appends the cells of one sample.
+
+        Parameters:
+            sample (str): Sample (export) name.
+            values_by_class (dict): Class label -> array of measurements.
+            fingerprint: Fingerprint of the sample's export, used by is_current.
+        """
+        sample_id = len(self.samples)
+        parts = [(self.classes.index(cls), np.asarray(values, dtype=np.float32))
+                 for cls, values in values_by_class.items() if len(values)]
+        values = np.concatenate([v for _, v in parts]) if parts else np.empty(0, dtype=np.float32)
+        codes = np.repeat(np.array([c for c, _ in parts], dtype=self.code_dtype), [len(v) for _, v in parts])
+        sample_ids = np.full(len(values), sample_id, dtype=np.uint32)
+
+        for key, array in (("values", values), ("classes", codes), ("samples", sample_ids)):
+            with open(self.paths[key], "ab") as file:
+                array.astype(self.dtypes[key], copy=False).tofile(file)
+        self.samples[sample] = {"id": sample_id, "fingerprint": fingerprint, "n_cells": int(len(values))}
+        self.n_cells += int(len(values))
+
+    def save(self):
+        """
+        Writes the store metadata atomically (temp file + rename).
+        """
+        meta = {"metric": self.metric, "classes": self.classes, "n_cells": self.n_cells, "samples": self.samples}
+        with open(self.meta_path + ".tmp", "w") as file:
+            json.dump(meta, file)
+        os.replace(self.meta_path + ".tmp", self.meta_path)
+
+    def _array(self, key):
+        # np.memmap cannot map an empty file
+        if self.n_cells == 0:
+            return np.empty(0, dtype=self.dtypes[key])
+        return np.memmap(self.paths[key], dtype=self.dtypes[key], mode="r", shape=(self.n_cells,))
+
+    def values(self):
+        """
+        Returns the memory-mapped float32 measurements of all cells.
+        """
+        return self._array("values")
+
+    def class_codes(self):
+        """
+        Returns the memory-mapped class code of every cell.
+        """
+        return self._array("classes")
+
+    def sample_ids(self):
+        """
+        Returns the memory-mapped sample id of every cell.
+        """
+        return self._array("samples")
+
+    def sample_names(self):
+        """
+        Returns the sample names in sample id order.
+        """
+        return sorted(self.samples, key=lambda name: self.samples[name]["id"])
+
+    def class_values(self, cls):
+        """
+        Returns the measurements of one class as an in-memory float32 array.
+        """
+        return self.values()[self.class_codes() == self.classes.index(cls)]
+
+    def frame(self, class_column="Cell Type", value_column=None):
+        """
+        Returns all cells as a DataFrame with a categorical class column (e.g. for seaborn).
+        """
+        labels = pd.Categorical.from_codes(np.asarray(self.class_codes(), dtype=np.int16), categories=self.classes)
+        return pd.DataFrame({class_column: labels, value_column or self.metric: np.asarray(self.values())})
@@ -4,6 +4,10 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 from scipy.stats import mannwhitneyu
 
+from hierarchy_join import join_export
+import instrumentation
+from qupath_io import list_exports
+
 # Define paths for VGAT and VGLUT2 data
 paths = {
     "vgat_positive_oprm1_positive": r"/Volumes/backup driv/VP_qp_LF - ITERATION4 - VGAT_OPRM1_COMPOSITE/detections_iteration4_vgatwithMu_12.13.24",
@@ -15,90 +19,46 @@ script_dir = os.path.dirname(os.path.abspath(__file__))
 plots_dir = os.path.join(script_dir, "oprm1VGATvsVGLUT2_plots")
 os.makedirs(plots_dir, exist_ok=True)
 
-# Define classifications and parent values
+# Define classifications (their spot rows have Parent "Cell (<classification>)")
 classifications = {
     "vgat_positive_oprm1_positive": ["vgat_Pos: oprm1_Pos"],
     "vglut2_positive_oprm1_positive": ["vglut2_Pos: oprm1_Pos"],
 }
-parent_values = {
-    "vgat_positive_oprm1_positive": "Cell (vgat_Pos: oprm1_Pos)",
-    "vglut2_positive_oprm1_positive": "Cell (vglut2_Pos: oprm1_Pos)",
-}
 
 # Initialize a dictionary to collect data for each classification
 data = {key: pd.DataFrame() for key in classifications.keys()}
 
-# Helper function to read data
-def read_data(file_path):
-    try:
-        return pd.read_csv(file_path, sep="\t", encoding="utf-8")
-    except UnicodeDecodeError:
-        print(f"Error reading file {file_path}: Unable to decode.")
-        return None
-
-# Helper function to detect and remove outliers using the IQR method
-def remove_outliers(df, column):
-    if df.empty:
-        return df
-    Q1 = df[column].quantile(0.25)  # First quartile (25th percentile)
-    Q3 = df[column].quantile(0.75)  # Third quartile (75th percentile)
-    IQR = Q3 - Q1  # Interquartile range
-    lower_bound = Q1 - 1.5 * IQR
-    upper_bound = Q3 + 1.5 * IQR
-    return df[(df[column] >= lower_bound) & (df[column] <= upper_bound)]
-
-# Collect intensity data
-def collect_intensity_data(raw_detection_path, labels):
-    filelist = [f for f in os.listdir(raw_detection_path) if f.endswith(".txt")]
-
-    intensity_data = []
-    for file in filelist:
-        file_path = os.path.join(raw_detection_path, file)
-        det_data = read_data(file_path)
-        if det_data is None or "Classification" not in det_data.columns or "AF568: Cell: Mean" not in det_data.columns:
-            print(f"Skipping file {file}: Required columns for intensity are missing.")
-            continue
-
-        filtered_data = det_data[det_data["Classification"].isin(labels)]
-        intensity_data.append(filtered_data[["AF568: Cell: Mean"]].dropna())
-
-    if intensity_data:
-        return pd.concat(intensity_data, ignore_index=True)
-    else:
-        return pd.DataFrame(columns=["AF568: Cell: Mean"])
-
-# Collect puncta data
-def collect_puncta_data(raw_detection_path, parent_value):
-    filelist = [f for f in os.listdir(raw_detection_path) if f.endswith(".txt")]
-
-    puncta_data = []
-    for file in filelist:
-        file_path = os.path.join(raw_detection_path, file)
-        det_data = read_data(file_path)
-        if det_data is None or "Parent" not in det_data.columns or "Num spots" not in det_data.columns:
-            print(f"Skipping file {file}: Required columns for puncta are missing.")
-            continue
-
-        filtered_data = det_data[det_data["Parent"] == parent_value]
-        puncta_data.append(filtered_data[["Num spots"]].dropna())
-
-    if puncta_data:
-        return pd.concat(puncta_data, ignore_index=True)
+# Collect per-cell intensity and puncta: every cell of the classification is joined with its
+# spot rows (by Parent ID, or by the nearest cell of the Parent's class), and "Num spots" is
+# the sum over the cell's spot rows (0 for cells without spots)
+def collect_cell_data(raw_detection_path, labels):
+    cell_data = []
+    for file in list_exports(raw_detection_path):
+        try:
+            cells = join_export(os.path.join(raw_detection_path, file), labels, {"Num spots": "sum"},
+                                cell_columns=["AF568: Cell: Mean"])
+            cell_data.append(cells[["AF568: Cell: Mean", "Num spots"]].dropna())
+        except KeyError as e:
+            print(f"Skipping file {file}: Required column {e} is missing.")
+        except Exception as e:
+            print(f"Error processing file {file}: {e}")
+
+    if cell_data:
+        return pd.concat(cell_data, ignore_index=True)
     else:
-        return pd.DataFrame(columns=["Num spots"])
+        return pd.DataFrame(columns=["AF568: Cell: Mean", "Num spots"])
 
+instrumentation.phase("read exports")
 # Collect data for each classification
 for key in classifications.keys():
-    raw_detection_path = paths[key]
-    intensity_df = collect_intensity_data(raw_detection_path, classifications[key])
-    puncta_df = collect_puncta_data(raw_detection_path, parent_values[key])
+    cell_df = collect_cell_data(paths[key], classifications[key])
 
-    if not intensity_df.empty and not puncta_df.empty:
-        merged_data = pd.concat([intensity_df, puncta_df], axis=1)
-        data[key] = merged_data.dropna()
+    if not cell_df.empty:
+        data[key] = cell_df
     else:
         print(f"No data for classification: {key}")
 
+instrumentation.phase("statistics")
 # File to save statistics
 stats_file_path = os.path.join(plots_dir, "vgat_vs_vglut2_stats.txt")
 with open(stats_file_path, "w") as stats_file:
@@ -179,18 +139,16 @@ with open(descriptive_stats_path, "w") as stats_file:
             stats_file.write("-" * 50 + "\n")
 
 
+instrumentation.phase("plots")
 #Visualization
-subpop_comparison = []
-for cell_type, df in data.items():
-    if not df.empty:
-        subpop_comparison.extend([
-            {"Cell Type": cell_type, "Intensity": row["AF568: Cell: Mean"], "Puncta": row["Num spots"]}
-            for _, row in df.iterrows()
-        ])
+subpop_comparison = [
+    pd.DataFrame({"Cell Type": cell_type, "Intensity": df["AF568: Cell: Mean"].to_numpy(), "Puncta": df["Num spots"].to_numpy()})
+    for cell_type, df in data.items() if not df.empty
+]
 
 
 if subpop_comparison:
-    subpop_comparison_df = pd.DataFrame(subpop_comparison)
+    subpop_comparison_df = pd.concat(subpop_comparison, ignore_index=True)
 
     # Apply renaming correctly
     subpop_comparison_df["Cell Type"] = subpop_comparison_df["Cell Type"].map(cell_type_rename)
@@ -253,4 +211,6 @@ if subpop_comparison:
         joint_plot.savefig(os.path.join(plots_dir, "Filtered_VGAT_vs_VGLUT2_JointPlot.png"))
         plt.close()
     else:
-        print("No data points meet the cutoff (Puncta > 2 and Intensity > 120). Skipping joint plot.")
\ No newline at end of file
+        print("No data points meet the cutoff (Puncta > 2 and Intensity > 120). Skipping joint plot.")
+
+instrumentation.report()
@@ -3,11 +3,13 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 from scipy.stats import mannwhitneyu, ks_2samp
-from scipy.signal import find_peaks
-from scipy.stats import gaussian_kde
-import numpy as np
 from statannotations.Annotator import Annotator
 
+from binned_kde import binned_kde
+import instrumentation
+from gating import gate_groups
+from resampling import compare_groups
+
 # Define paths for VGAT and VGLUT2 data
 paths = {
     "vgat": {
@@ -49,40 +51,6 @@ colors = {
 data = {key: [] for key in classifications.keys()}
 
 
-# Helper function to detect and remove outliers using the IQR method
-def remove_outliers(df, column):
-    if df.empty:
-        return df
-    Q1 = df[column].quantile(0.25)  # First quartile (25th percentile)
-    Q3 = df[column].quantile(0.75)  # Third quartile (75th percentile)
-    IQR = Q3 - Q1  # Interquartile range
-    lower_bound = Q1 - 1.5 * IQR
-    upper_bound = Q3 + 1.5 * IQR
-    return df[(df[column] >= lower_bound) & (df[column] <= upper_bound)]
-
-
-# Function to calculate the threshold (valley between peaks) dynamically
-def calculate_threshold(df, column):
-    if df.empty:
-        return None
-    
-    # Fit KDE
-    kde = gaussian_kde(df[column])
-    x = np.linspace(df[column].min(), df[column].max(), 1000)
-    y = kde(x)
-    
-    # Find peaks and valleys
-    peaks, _ = find_peaks(y)
-    valleys, _ = find_peaks(-y)
-
-    if len(valleys) > 0:
-        # Select the first valley as the threshold (or customize based on domain knowledge)
-        threshold = x[valleys[0]]
-        return threshold
-    else:
-        return None  # Return None if no valleys are found
-
-
 # Updated helper function to process files and extract relevant data
 def collect_data(paths, classification_key, labels):
     for file in os.listdir(paths["raw_detection"]):
@@ -105,35 +73,6 @@ def collect_data(paths, classification_key, labels):
             except Exception as e:
                 print(f"Error processing {file}: {e}")
 
-# Collect original data (no thresholding)
-original_data = {key: [] for key in classifications.keys()}
-for group, labels in classifications.items():
-    if "vgat" in group:
-        collect_data(paths["vgat"], group, labels)
-    elif "vglut2" in group:
-        collect_data(paths["vglut2"], group, labels)
-    if data[group]:
-        original_data[group] = pd.concat(data[group], ignore_index=True)
-    else:
-        original_data[group] = pd.DataFrame(columns=["AF568: Cell: Mean", "Subcellular: Channel 2: Num spots estimated"])
-
-# Calculate thresholds for VGAT and VGLUT2
-thresholds = {}
-for key, df in original_data.items():
-    thresholds[key] = calculate_threshold(df, "AF568: Cell: Mean")
-    print(f"Threshold for {key}: {thresholds[key]}")
-
-
-# Apply dynamic thresholds to trim data
-trimmed_data = {}
-for key, df in original_data.items():
-    if thresholds[key] is not None:
-        filtered_df = df[df["AF568: Cell: Mean"] > thresholds[key]]  # Apply calculated threshold
-        trimmed_data[key] = remove_outliers(filtered_df, "AF568: Cell: Mean")
-    else:
-        trimmed_data[key] = pd.DataFrame()  # Empty DataFrame if no threshold found
-
-
 # # Function to compare plots before and after trimming
 # def compare_plots(original_df, trimmed_df, column, title, color):
 #     plt.figure(figsize=(16, 8))
@@ -168,36 +107,45 @@ for key, df in original_data.items():
 #     plt.savefig(os.path.join(plots_dir, f"{title.replace(' ', '_')}_comparison.png"))
 #     plt.close()
 
+# Draw a KDE on a histogram's count scale (what histplot(kde=True) drew, without refitting)
+def plot_kde_counts(kde, n_values, bins, color):
+    bin_width = (kde.x[-1] - kde.x[0]) / bins
+    plt.plot(kde.x, kde.y * n_values * bin_width, color=color)
+
+
 # Function to compare plots before and after trimming, with peaks and thresholds
 def compare_plots_with_peaks_and_threshold(original_df, trimmed_df, column, title, color, threshold):
     plt.figure(figsize=(16, 8))
     
     # Original Data Distribution
     plt.subplot(2, 2, 1)
-    sns.histplot(original_df[column], kde=True, bins=30, color=color, alpha=0.7, label="Histogram")
+    # Binned KDE of the values (cached; the threshold may also come from the mixture fallback),
+    # None for fewer than two values or values without spread
+    kde = binned_kde(original_df[column], bandwidth="scott", gridsize=1000)
+
+    sns.histplot(original_df[column], bins=30, color=color, alpha=0.7, label="Histogram")
+    if kde is not None:
+        plot_kde_counts(kde, len(original_df), 30, color)
     plt.title(f"{title} (Original Data Distribution)")
     plt.xlabel("OPRM1 Intensity")
     plt.xlim(0, None)
+
+    if kde is not None:
+        x, y = kde.x, kde.y
+
+        # Plot KDE
+        plt.plot(x, y, color="blue", label="KDE", alpha=0.8)
     
-    # Add KDE and annotate peaks/thresholds
-    kde = gaussian_kde(original_df[column])
-    x = np.linspace(original_df[column].min(), original_df[column].max(), 1000)
-    y = kde(x)
-    peaks, _ = find_peaks(y)
-    valleys, _ = find_peaks(-y)
-
-    # Plot KDE
-    plt.plot(x, y, color="blue", label="KDE", alpha=0.8)
-    
-    # Annotate Peaks
-    for peak in peaks:
-        plt.axvline(x[peak], color="green", linestyle="--", label=f"Peak @ {x[peak]:.2f}")
-        plt.text(x[peak], y[peak] + 0.005, f"Peak: {x[peak]:.2f}", color="green", fontsize=8)
+        # Annotate Peaks
+        for peak in kde.peaks:
+            plt.axvline(x[peak], color="green", linestyle="--", label=f"Peak @ {x[peak]:.2f}")
+            plt.text(x[peak], y[peak] + 0.005, f"Peak: {x[peak]:.2f}", color="green", fontsize=8)
     
     # Annotate Threshold
     if threshold is not None:
+        text_y = max(kde.y) * 0.8 if kde is not None else plt.ylim()[1] * 0.8
         plt.axvline(threshold, color="red", linestyle="--", label=f"Threshold @ {threshold:.2f}")
-        plt.text(threshold, max(y) * 0.8, f"Threshold: {threshold:.2f}", color="red", fontsize=10)
+        plt.text(threshold, text_y, f"Threshold: {threshold:.2f}", color="red", fontsize=10)
 
     plt.legend()
 
@@ -210,7 +158,10 @@ def compare_plots_with_peaks_and_threshold(original_df, trimmed_df, column, titl
 
     # Trimmed Data Distribution
     plt.subplot(2, 2, 3)
-    sns.histplot(trimmed_df[column], kde=True, bins=30, color=color, alpha=0.7, label="Histogram")
+    sns.histplot(trimmed_df[column], bins=30, color=color, alpha=0.7, label="Histogram")
+    trimmed_kde = binned_kde(trimmed_df[column], bandwidth="scott", gridsize=200)
+    if trimmed_kde is not None:
+        plot_kde_counts(trimmed_kde, len(trimmed_df), 30, color)
     plt.title(f"{title} (Trimmed Data Distribution)")
     plt.xlabel("OPRM1 Intensity")
     plt.xlim(threshold - 5 if threshold else 0, None)
@@ -226,79 +177,126 @@ def compare_plots_with_peaks_and_threshold(original_df, trimmed_df, column, titl
     plt.savefig(os.path.join(plots_dir, f"{title.replace(' ', '_')}_peaks_thresholds.png"))
     plt.close()
 
-# Generate comparison plots for VGAT and VGLUT2 with peaks and thresholds
-compare_plots_with_peaks_and_threshold(original_data["vgat_positive_oprm1_positive"], 
-                                       trimmed_data["vgat_positive_oprm1_positive"], 
-                                       "AF568: Cell: Mean", 
-                                       "VGAT+ OPRM1+", 
-                                       colors["vgat_positive_oprm1_positive"], 
-                                       thresholds["vgat_positive_oprm1_positive"])
-
-compare_plots_with_peaks_and_threshold(original_data["vglut2_positive_oprm1_positive"], 
-                                       trimmed_data["vglut2_positive_oprm1_positive"], 
-                                       "AF568: Cell: Mean", 
-                                       "VGLUT2+ OPRM1+", 
-                                       colors["vglut2_positive_oprm1_positive"], 
-                                       thresholds["vglut2_positive_oprm1_positive"])
-
-# # Generate comparison plots for VGAT and VGLUT2
-# compare_plots(original_data["vgat_positive_oprm1_positive"], trimmed_data["vgat_positive_oprm1_positive"], 
-#               "AF568: Cell: Mean", "VGAT+ OPRM1+", colors["vgat_positive_oprm1_positive"])
-# compare_plots(original_data["vglut2_positive_oprm1_positive"], trimmed_data["vglut2_positive_oprm1_positive"], 
-#               "AF568: Cell: Mean", "VGLUT2+ OPRM1+", colors["vglut2_positive_oprm1_positive"])
-
-# Perform statistical tests between VGAT+ and VGLUT2+ groups for both original and trimmed data
-stat_results = {"original": {}, "trimmed": {}}
-
-# Statistical tests for original data
-if not original_data["vgat_positive_oprm1_positive"].empty and not original_data["vglut2_positive_oprm1_positive"].empty:
-    vgat_original = original_data["vgat_positive_oprm1_positive"]["AF568: Cell: Mean"]
-    vglut2_original = original_data["vglut2_positive_oprm1_positive"]["AF568: Cell: Mean"]
-
-    # Mann-Whitney U Test (original)
-    u_stat, u_p_value = mannwhitneyu(vgat_original, vglut2_original, alternative='two-sided')
-    stat_results["original"]["Mann-Whitney"] = (u_stat, u_p_value)
-
-    # Kolmogorov-Smirnov Test (original)
-    ks_stat, ks_p_value = ks_2samp(vgat_original, vglut2_original)
-    stat_results["original"]["Kolmogorov-Smirnov"] = (ks_stat, ks_p_value)
-
-# Statistical tests for trimmed data
-if not trimmed_data["vgat_positive_oprm1_positive"].empty and not trimmed_data["vglut2_positive_oprm1_positive"].empty:
-    vgat_trimmed = trimmed_data["vgat_positive_oprm1_positive"]["AF568: Cell: Mean"]
-    vglut2_trimmed = trimmed_data["vglut2_positive_oprm1_positive"]["AF568: Cell: Mean"]
-
-    # Mann-Whitney U Test
-    u_stat, u_p_value = mannwhitneyu(vgat_trimmed, vglut2_trimmed, alternative='two-sided')
-    stat_results["trimmed"]["Mann-Whitney"] = (u_stat, u_p_value)
-
-    # Kolmogorov-Smirnov Test
-    ks_stat, ks_p_value = ks_2samp(vgat_trimmed, vglut2_trimmed)
-    stat_results["trimmed"]["Kolmogorov-Smirnov"] = (ks_stat, ks_p_value)
-
-# Save results to a text file
-stats_results_path = os.path.join(plots_dir, "statistical_tests_results.txt")
-with open(stats_results_path, "w") as f:
-    f.write("Statistical Test Results (Original Data):\n")
-    for test_name, (stat, p_val) in stat_results["original"].items():
-        f.write(f"{test_name}: Statistic = {stat}, p-value = {p_val}\n")
-    f.write("\nStatistical Test Results (Trimmed Data):\n")
-    for test_name, (stat, p_val) in stat_results["trimmed"].items():
-        f.write(f"{test_name}: Statistic = {stat}, p-value = {p_val}\n")
-
-# Generate descriptive statistics for original and trimmed data
-descriptive_stats_path = os.path.join(plots_dir, "descriptive_statistics.txt")
-with open(descriptive_stats_path, "w") as f:
-    f.write("Descriptive Statistics for Original Data:\n")
-    for key, df in original_data.items():
-        f.write(f"\n{key}:\n")
-        f.write(df.describe().to_string())
-        f.write("\n")
-    f.write("\nDescriptive Statistics for Trimmed Data:\n")
-    for key, df in trimmed_data.items():
-        f.write(f"\n{key}:\n")
-        f.write(df.describe().to_string())
-        f.write("\n")
-
-print(f"Descriptive statistics saved to {descriptive_stats_path}")
-print(f"Statistical test results saved to {stats_results_path}")
+
+if __name__ == "__main__":
+    instrumentation.phase("read exports")
+    # Collect original data (no thresholding)
+    original_data = {key: [] for key in classifications.keys()}
+    for group, labels in classifications.items():
+        if "vgat" in group:
+            collect_data(paths["vgat"], group, labels)
+        elif "vglut2" in group:
+            collect_data(paths["vglut2"], group, labels)
+        if data[group]:
+            original_data[group] = pd.concat(data[group], ignore_index=True)
+        else:
+            original_data[group] = pd.DataFrame(columns=["AF568: Cell: Mean", "Subcellular: Channel 2: Num spots estimated"])
+
+    instrumentation.phase("gating")
+    # Gate both groups in one pass: cells above the KDE valley threshold (the Gaussian mixture
+    # crossing if the KDE has no valley), then IQR outlier removal among the cells above the threshold
+    masks, gates = gate_groups(original_data, ["AF568: Cell: Mean"],
+                               [{"rule": "kde", "gridsize": 1000, "fallback": {"rule": "mixture"}, "if_missing": "drop"},
+                                {"rule": "iqr", "k": 1.5}])
+    thresholds = gates.bounds("kde")
+    for key, threshold in thresholds.items():
+        print(f"Threshold for {key}: {threshold}")
+    trimmed_data = {key: df[masks[key]] for key, df in original_data.items()}
+    gates.statistics.to_csv(os.path.join(plots_dir, "gate_statistics.csv"), index=False)
+
+
+    instrumentation.phase("plots")
+    # Generate comparison plots for VGAT and VGLUT2 with peaks and thresholds
+    compare_plots_with_peaks_and_threshold(original_data["vgat_positive_oprm1_positive"], 
+                                           trimmed_data["vgat_positive_oprm1_positive"], 
+                                           "AF568: Cell: Mean", 
+                                           "VGAT+ OPRM1+", 
+                                           colors["vgat_positive_oprm1_positive"], 
+                                           thresholds["vgat_positive_oprm1_positive"])
+
+    compare_plots_with_peaks_and_threshold(original_data["vglut2_positive_oprm1_positive"], 
+                                           trimmed_data["vglut2_positive_oprm1_positive"], 
+                                           "AF568: Cell: Mean", 
+                                           "VGLUT2+ OPRM1+", 
+                                           colors["vglut2_positive_oprm1_positive"], 
+                                           thresholds["vglut2_positive_oprm1_positive"])
+
+    # # Generate comparison plots for VGAT and VGLUT2
+    # compare_plots(original_data["vgat_positive_oprm1_positive"], trimmed_data["vgat_positive_oprm1_positive"], 
+    #               "AF568: Cell: Mean", "VGAT+ OPRM1+", colors["vgat_positive_oprm1_positive"])
+    # compare_plots(original_data["vglut2_positive_oprm1_positive"], trimmed_data["vglut2_positive_oprm1_positive"], 
+    #               "AF568: Cell: Mean", "VGLUT2+ OPRM1+", colors["vglut2_positive_oprm1_positive"])
+
+    instrumentation.phase("statistics")
+    # Perform statistical tests between VGAT+ and VGLUT2+ groups for both original and trimmed data
+    stat_results = {"original": {}, "trimmed": {}}
+    resampling_results = {}
+
+    # Statistical tests for original data
+    if not original_data["vgat_positive_oprm1_positive"].empty and not original_data["vglut2_positive_oprm1_positive"].empty:
+        vgat_original = original_data["vgat_positive_oprm1_positive"]["AF568: Cell: Mean"]
+        vglut2_original = original_data["vglut2_positive_oprm1_positive"]["AF568: Cell: Mean"]
+
+        # Mann-Whitney U Test (original)
+        u_stat, u_p_value = mannwhitneyu(vgat_original, vglut2_original, alternative='two-sided')
+        stat_results["original"]["Mann-Whitney"] = (u_stat, u_p_value)
+
+        # Kolmogorov-Smirnov Test (original)
+        ks_stat, ks_p_value = ks_2samp(vgat_original, vglut2_original)
+        stat_results["original"]["Kolmogorov-Smirnov"] = (ks_stat, ks_p_value)
+
+        # Permutation tests and bootstrap confidence intervals (VGAT+ minus VGLUT2+)
+        resampling_results["original"] = compare_groups(vgat_original, vglut2_original)
+
+    # Statistical tests for trimmed data
+    if not trimmed_data["vgat_positive_oprm1_positive"].empty and not trimmed_data["vglut2_positive_oprm1_positive"].empty:
+        vgat_trimmed = trimmed_data["vgat_positive_oprm1_positive"]["AF568: Cell: Mean"]
+        vglut2_trimmed = trimmed_data["vglut2_positive_oprm1_positive"]["AF568: Cell: Mean"]
+
+        # Mann-Whitney U Test
+        u_stat, u_p_value = mannwhitneyu(vgat_trimmed, vglut2_trimmed, alternative='two-sided')
+        stat_results["trimmed"]["Mann-Whitney"] = (u_stat, u_p_value)
+
+        # Kolmogorov-Smirnov Test
+        ks_stat, ks_p_value = ks_2samp(vgat_trimmed, vglut2_trimmed)
+        stat_results["trimmed"]["Kolmogorov-Smirnov"] = (ks_stat, ks_p_value)
+
+        # Permutation tests and bootstrap confidence intervals (VGAT+ minus VGLUT2+)
+        resampling_results["trimmed"] = compare_groups(vgat_trimmed, vglut2_trimmed)
+
+    # Save results to a text file
+    stats_results_path = os.path.join(plots_dir, "statistical_tests_results.txt")
+    with open(stats_results_path, "w") as f:
+        f.write("Statistical Test Results (Original Data):\n")
+        for test_name, (stat, p_val) in stat_results["original"].items():
+            f.write(f"{test_name}: Statistic = {stat}, p-value = {p_val}\n")
+        f.write("\nStatistical Test Results (Trimmed Data):\n")
+        for test_name, (stat, p_val) in stat_results["trimmed"].items():
+            f.write(f"{test_name}: Statistic = {stat}, p-value = {p_val}\n")
+        for kind, results in resampling_results.items():
+            f.write(f"\nPermutation Tests and Bootstrap Confidence Intervals ({kind.title()} Data, VGAT+ minus VGLUT2+):\n")
+            f.write(results.to_string(index=False))
+            f.write("\n")
+
+    # Save resampling results as a table
+    if resampling_results:
+        pd.concat(resampling_results, names=["Data"]).reset_index(level=0).to_csv(
+            os.path.join(plots_dir, "resampling_results.csv"), index=False)
+
+    # Generate descriptive statistics for original and trimmed data
+    descriptive_stats_path = os.path.join(plots_dir, "descriptive_statistics.txt")
+    with open(descriptive_stats_path, "w") as f:
+        f.write("Descriptive Statistics for Original Data:\n")
+        for key, df in original_data.items():
+            f.write(f"\n{key}:\n")
+            f.write(df.describe().to_string())
+            f.write("\n")
+        f.write("\nDescriptive Statistics for Trimmed Data:\n")
+        for key, df in trimmed_data.items():
+            f.write(f"\n{key}:\n")
+            f.write(df.describe().to_string())
+            f.write("\n")
+
+    print(f"Descriptive statistics saved to {descriptive_stats_path}")
+    print(f"Statistical test results saved to {stats_results_path}")
+    instrumentation.report()
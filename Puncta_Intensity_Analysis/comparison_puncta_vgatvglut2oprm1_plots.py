@@ -5,6 +5,9 @@ import seaborn as sns
 from scipy.stats import mannwhitneyu, ks_2samp
 from statannotations.Annotator import Annotator
 
+import instrumentation
+from resampling import compare_groups
+
 # Define paths for VGAT and VGLUT2 data
 paths = {
     "vgat": {
@@ -52,78 +55,92 @@ def collect_data(group, cell_type_key, parent_value):
         except Exception as e:
             print(f"Error processing file {file}: {e}")
 
-# Collect data for each cell type
-collect_data("vgat", "vgat_positive_oprm1_positive", cell_types["vgat_positive_oprm1_positive"])
-collect_data("vglut2", "vglut2_positive_oprm1_positive", cell_types["vglut2_positive_oprm1_positive"])
-
-# Perform statistical tests
-vgat_data = pd.Series(data["vgat_positive_oprm1_positive"])
-vglut2_data = pd.Series(data["vglut2_positive_oprm1_positive"])
-
-stat_results = {}
-if not vgat_data.empty and not vglut2_data.empty:
-    # Mann-Whitney U Test
-    u_stat, u_p_value = mannwhitneyu(vgat_data, vglut2_data, alternative='two-sided')
-    stat_results["Mann-Whitney"] = (u_stat, u_p_value)
-
-    # Kolmogorov-Smirnov Test
-    ks_stat, ks_p_value = ks_2samp(vgat_data, vglut2_data)
-    stat_results["Kolmogorov-Smirnov"] = (ks_stat, ks_p_value)
-
-    # Save statistical test results and descriptive stats to a text file
-    stats_results_path = os.path.join(plots_dir, "statistical_tests_results.txt")
-    with open(stats_results_path, "w") as f:
-        f.write("Statistical Test Results and Distribution Statistics:\n")
-        f.write("=" * 50 + "\n\n")
-
-        # Statistical test results
-        for test_name, (stat, p_val) in stat_results.items():
-            f.write(f"{test_name}: Statistic = {stat}, p-value = {p_val}\n")
-        f.write("\n")
-
-        # Descriptive statistics
-        for cell_type, values in data.items():
-            if values:
-                values_series = pd.Series(values)
-                f.write(f"Cell Type: {cell_type.replace('_', ' ').title()}\n")
-#                f.write(f"  Total Cells: {len(values_series)}\n")
-                f.write(f"  Min Puncta Count: {values_series.min()}\n")
-                f.write(f"  Median Puncta Count: {values_series.median()}\n")
-                f.write(f"  Max Puncta Count: {values_series.max()}\n")
-                f.write(f"  Mean Puncta Count: {values_series.mean()}\n")
-                f.write(f"  25th Percentile (Q1): {values_series.quantile(0.25)}\n")
-                f.write(f"  75th Percentile (Q3): {values_series.quantile(0.75)}\n")
-                f.write(f"  Interquartile Range (IQR): {values_series.quantile(0.75) - values_series.quantile(0.25)}\n")
-                f.write("\n")
-    print(f"Statistical test results and stats saved to {stats_results_path}")
-
-# Updated palette to match Cell Type labels
-formatted_colors = {
-    "VGAT Positive OPRM1 Positive": "green",
-    "VGLUT2 Positive OPRM1 Positive": "orange",
-}
-
-# Create box plot with annotations
-if not vgat_data.empty and not vglut2_data.empty:
-    comparison_data = pd.DataFrame({
-        "Cell Type": ["VGAT Positive OPRM1 Positive"] * len(vgat_data) + ["VGLUT2 Positive OPRM1 Positive"] * len(vglut2_data),
-        "Puncta Count": pd.concat([vgat_data, vglut2_data])
-    })
-
-    plt.figure(figsize=(10, 6))
-    ax = sns.boxplot(data=comparison_data, x="Cell Type", y="Puncta Count", palette=formatted_colors)
-    pairs = [("VGAT Positive OPRM1 Positive", "VGLUT2 Positive OPRM1 Positive")]
-    annotator = Annotator(ax, pairs, data=comparison_data, x="Cell Type", y="Puncta Count")
-    annotator.set_pvalues([u_p_value])
-    annotator.annotate()
-
-    plt.title("Comparison of Puncta Count for VGAT+ and VGLUT2+ Cells", fontsize=14)
-    plt.xlabel("Cell Type")
-    plt.ylabel("Puncta Count")
-    plt.tight_layout()
-
-    box_plot_path = os.path.join(plots_dir, "Box_Comparison_VGAT_vs_VGLUT2_with_annotations.png")
-    plt.savefig(box_plot_path)
-    plt.close()
-
-    print(f"Box plot with annotations saved to {box_plot_path}.")
+if __name__ == "__main__":
+    instrumentation.phase("read exports")
+    # Collect data for each cell type
+    collect_data("vgat", "vgat_positive_oprm1_positive", cell_types["vgat_positive_oprm1_positive"])
+    collect_data("vglut2", "vglut2_positive_oprm1_positive", cell_types["vglut2_positive_oprm1_positive"])
+
+    instrumentation.phase("statistics")
+    # Perform statistical tests
+    vgat_data = pd.Series(data["vgat_positive_oprm1_positive"])
+    vglut2_data = pd.Series(data["vglut2_positive_oprm1_positive"])
+
+    stat_results = {}
+    if not vgat_data.empty and not vglut2_data.empty:
+        # Mann-Whitney U Test
+        u_stat, u_p_value = mannwhitneyu(vgat_data, vglut2_data, alternative='two-sided')
+        stat_results["Mann-Whitney"] = (u_stat, u_p_value)
+
+        # Kolmogorov-Smirnov Test
+        ks_stat, ks_p_value = ks_2samp(vgat_data, vglut2_data)
+        stat_results["Kolmogorov-Smirnov"] = (ks_stat, ks_p_value)
+
+        # Permutation tests and bootstrap confidence intervals (VGAT+ minus VGLUT2+)
+        resampling_results = compare_groups(vgat_data, vglut2_data)
+        resampling_results.to_csv(os.path.join(plots_dir, "resampling_results.csv"), index=False)
+
+        # Save statistical test results and descriptive stats to a text file
+        stats_results_path = os.path.join(plots_dir, "statistical_tests_results.txt")
+        with open(stats_results_path, "w") as f:
+            f.write("Statistical Test Results and Distribution Statistics:\n")
+            f.write("=" * 50 + "\n\n")
+
+            # Statistical test results
+            for test_name, (stat, p_val) in stat_results.items():
+                f.write(f"{test_name}: Statistic = {stat}, p-value = {p_val}\n")
+            f.write("\n")
+
+            # Resampling results
+            f.write("Permutation Tests and Bootstrap Confidence Intervals (VGAT+ minus VGLUT2+):\n")
+            f.write(resampling_results.to_string(index=False))
+            f.write("\n\n")
+
+            # Descriptive statistics
+            for cell_type, values in data.items():
+                if values:
+                    values_series = pd.Series(values)
+                    f.write(f"Cell Type: {cell_type.replace('_', ' ').title()}\n")
+    #                f.write(f"  Total Cells: {len(values_series)}\n")
+                    f.write(f"  Min Puncta Count: {values_series.min()}\n")
+                    f.write(f"  Median Puncta Count: {values_series.median()}\n")
+                    f.write(f"  Max Puncta Count: {values_series.max()}\n")
+                    f.write(f"  Mean Puncta Count: {values_series.mean()}\n")
+                    f.write(f"  25th Percentile (Q1): {values_series.quantile(0.25)}\n")
+                    f.write(f"  75th Percentile (Q3): {values_series.quantile(0.75)}\n")
+                    f.write(f"  Interquartile Range (IQR): {values_series.quantile(0.75) - values_series.quantile(0.25)}\n")
+                    f.write("\n")
+        print(f"Statistical test results and stats saved to {stats_results_path}")
+
+    instrumentation.phase("plots")
+    # Updated palette to match Cell Type labels
+    formatted_colors = {
+        "VGAT Positive OPRM1 Positive": "green",
+        "VGLUT2 Positive OPRM1 Positive": "orange",
+    }
+
+    # Create box plot with annotations
+    if not vgat_data.empty and not vglut2_data.empty:
+        comparison_data = pd.DataFrame({
+            "Cell Type": ["VGAT Positive OPRM1 Positive"] * len(vgat_data) + ["VGLUT2 Positive OPRM1 Positive"] * len(vglut2_data),
+            "Puncta Count": pd.concat([vgat_data, vglut2_data])
+        })
+
+        plt.figure(figsize=(10, 6))
+        ax = sns.boxplot(data=comparison_data, x="Cell Type", y="Puncta Count", palette=formatted_colors)
+        pairs = [("VGAT Positive OPRM1 Positive", "VGLUT2 Positive OPRM1 Positive")]
+        annotator = Annotator(ax, pairs, data=comparison_data, x="Cell Type", y="Puncta Count")
+        annotator.set_pvalues([u_p_value])
+        annotator.annotate()
+
+        plt.title("Comparison of Puncta Count for VGAT+ and VGLUT2+ Cells", fontsize=14)
+        plt.xlabel("Cell Type")
+        plt.ylabel("Puncta Count")
+        plt.tight_layout()
+
+        box_plot_path = os.path.join(plots_dir, "Box_Comparison_VGAT_vs_VGLUT2_with_annotations.png")
+        plt.savefig(box_plot_path)
+        plt.close()
+
+        print(f"Box plot with annotations saved to {box_plot_path}.")
+    instrumentation.report()
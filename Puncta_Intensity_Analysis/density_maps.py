@@ -0,0 +1,232 @@
+import argparse
+import os
+from functools import partial
+import numpy as np
+from scipy.signal import fftconvolve
+
+from hierarchy_join import CENTROID_COLUMNS
+from parallel_processing import N_WORKERS, run_per_file
+from plot_renderer import PlotQueue
+from qupath_io import list_exports, read_export
+from reclassification import cell_rows
+
+'''
+2D cell-density maps (cells/mm^2) of every cell type, per image and pooled, from the
+detection centroids.
+
+The centroids of every cell type are binned onto a grid of square pixels (pixel_um µm) with
+one np.bincount, and the count grids of all cell types are smoothed together by FFT
+convolution with a Gaussian kernel (sigma_um µm, truncated at 4 sigma, zero padded so
+nothing wraps around the edges). The cost is linear in the number of cells plus an FFT of
+the grid, so whole-dataset maps stay cheap.
+
+Per-image maps cover the image's own bounding box. For the pooled map the images are
+registered by the bounding box of their annotation: the exports carry no outline
+coordinates, so the box is the extent of the annotation's cells; every image is scaled onto
+the median box size and the pooled map is the mean of the registered per-image maps.
+Without registration the images are pooled in their own (slide) coordinates.
+
+Outputs: one .npz per image and one pooled .npz (maps [cell type, y, x] in cells/mm^2,
+cell_types, extent [x0, x1, y0, y1] in µm, pixel_um, sigma_um), and a heatmap PNG per map.
+
+    python density_maps.py <detections> --pixel-um 25 --sigma-um 50 --register \
+        --cell-type "Double Positive" "vgat_Pos: oprm1_Pos" --output-dir density_maps
+'''
+
+DEFAULT_PIXEL_UM = 25.0
+
+DEFAULT_SIGMA_UM = 50.0
+
+# Kernel radius in standard deviations
+KERNEL_TRUNCATE = 4.0
+
+
+def gaussian_kernel(sigma_um, pixel_um, truncate=KERNEL_TRUNCATE):
+    """
+    Returns the normalized 2D Gaussian kernel of a standard deviation in µm on pixel_um pixels.
+    """
+    sigma = sigma_um / pixel_um
+    radius = max(int(np.ceil(truncate * sigma)), 1)
+    offsets = np.arange(-radius, radius + 1)
+    profile = np.exp(-0.5 * (offsets / sigma) ** 2) if sigma > 0 else (offsets == 0).astype(np.float64)
+    kernel = np.outer(profile, profile)
+    return kernel / kernel.sum()
+
+
+def grid_shape(extent, pixel_um):
+    """
+    Returns (rows, columns) of the grid covering an extent (x0, x1, y0, y1).
+    """
+    x0, x1, y0, y1 = extent
+    return max(int(np.ceil((y1 - y0) / pixel_um)), 1), max(int(np.ceil((x1 - x0) / pixel_um)), 1)
+
+
+def bin_counts(points, codes, n_types, extent, pixel_um):
+    """
+    Bins points onto the grid of an extent.
+
+    Parameters:
+        points (np.ndarray): [n, 2] centroids (µm).
+        codes (np.ndarray): Cell type code of every point (negative = left out).
+        n_types (int): Number of cell types.
+
+    Returns:
+        np.ndarray: [n_types, rows, columns] cell counts (points outside the extent are left out).
+    """
+    rows, columns = grid_shape(extent, pixel_um)
+    column = np.floor((points[:, 0] - extent[0]) / pixel_um)
+    row = np.floor((points[:, 1] - extent[2]) / pixel_um)
+    # Points on the far edge (up to rounding, e.g. after registration) go into the last pixel
+    tolerance = pixel_um * 1e-6
+    column = np.where((column >= columns) & (points[:, 0] <= extent[1] + tolerance), columns - 1, column)
+    row = np.where((row >= rows) & (points[:, 1] <= extent[3] + tolerance), rows - 1, row)
+    inside = (codes >= 0) & (column >= 0) & (column < columns) & (row >= 0) & (row < rows)
+    flat = (codes[inside] * rows + row[inside].astype(np.intp)) * columns + column[inside].astype(np.intp)
+    return np.bincount(flat, minlength=n_types * rows * columns).reshape(n_types, rows, columns).astype(np.float64)
+
+
+def density_maps(counts, pixel_um, sigma_um):
+    """
+    Smooths count grids ([cell type, rows, columns]) with the Gaussian kernel and returns
+    them as densities in cells/mm^2.
+    """
+    if sigma_um > 0:
+        counts = fftconvolve(counts, gaussian_kernel(sigma_um, pixel_um)[None], mode="same", axes=(1, 2))
+        counts = np.maximum(counts, 0)
+    return counts / (pixel_um ** 2 / 1e6)
+
+
+def cell_positions(det_data, cell_types, class_column="Classification"):
+    """
+    Returns the centroids of every cell type of one detection export and the bounding box
+    of all its cells.
+
+    Returns:
+        tuple: (cell type -> [n, 2] float32 centroids in µm, box (x0, x1, y0, y1)).
+    """
+    cells = det_data[cell_rows(det_data, class_column)]
+    # The box is taken from the same float32 values, so cells on its edge stay inside it
+    points = cells[list(CENTROID_COLUMNS)].to_numpy(dtype=np.float32)
+    located = ~np.isnan(points).any(axis=1)
+    labels = cells[class_column].astype(object).to_numpy()
+    positions = {cell_type: points[located & np.isin(labels, type_labels)]
+                 for cell_type, type_labels in cell_types.items()}
+    if not located.any():
+        return positions, None
+    x, y = points[located, 0], points[located, 1]
+    return positions, (float(x.min()), float(x.max()), float(y.min()), float(y.max()))
+
+
+def _stack(positions, transform=None):
+    # All centroids of a sample with their cell type codes
+    arrays = [np.asarray(points, dtype=np.float64).reshape(-1, 2) for points in positions.values()]
+    points = np.concatenate(arrays) if arrays else np.empty((0, 2))
+    codes = np.repeat(np.arange(len(arrays)), [len(array) for array in arrays])
+    return (points if transform is None else transform(points)), codes
+
+
+def sample_maps(positions, extent, pixel_um, sigma_um, transform=None):
+    """
+    Density maps ([cell type, rows, columns], cells/mm^2) of one sample on the grid of an extent.
+    """
+    points, codes = _stack(positions, transform)
+    return density_maps(bin_counts(points, codes, len(positions), extent, pixel_um), pixel_um, sigma_um)
+
+
+def _save_maps(path, maps, cell_types, extent, pixel_um, sigma_um):
+    np.savez_compressed(path, maps=maps, cell_types=np.array(list(cell_types)), extent=np.asarray(extent, dtype=np.float64),
+                        pixel_um=pixel_um, sigma_um=sigma_um)
+
+
+def _file_label(name):
+    return "".join(character if character.isalnum() or character in "-_." else "_" for character in name)
+
+
+def _register(points, origin, scale):
+    # Maps centroids from an image's bounding box onto the common box
+    return (points - origin) * scale
+
+
+def write_density_maps(records, output_dir, stem, pixel_um=DEFAULT_PIXEL_UM, sigma_um=DEFAULT_SIGMA_UM,
+                       register=True, per_image_plots=True):
+    """
+    Writes the per-image and pooled density maps and their heatmaps.
+
+    Parameters:
+        records (list): (sample, cell type -> centroids, box) per image (see cell_positions).
+        register (bool): Pool the images registered by their bounding boxes (else in their
+            own coordinates).
+        per_image_plots (bool): Render a heatmap of every per-image map (else pooled only).
+
+    Returns:
+        np.ndarray: Pooled maps [cell type, rows, columns] (None without data).
+    """
+    records = [record for record in records if record[2] is not None]
+    if not records:
+        print("No centroids available for density maps.")
+        return None
+    cell_types = list(records[0][1])
+    os.makedirs(output_dir, exist_ok=True)
+    plots = PlotQueue()
+
+    def add_heatmaps(maps, extent, label):
+        for cell_type, density in zip(cell_types, maps):
+            plots.add("heatmap", os.path.join(output_dir, f"{_file_label(label)}_{_file_label(cell_type)}_density.png"),
+                      density, title=f"{cell_type} density ({label})", xlabel="X (µm)", ylabel="Y (µm)",
+                      extent=list(extent), colorbar_label="Cells/mm^2", figsize=(8, 7))
+
+    for sample, positions, box in records:
+        maps = sample_maps(positions, box, pixel_um, sigma_um)
+        _save_maps(os.path.join(output_dir, f"{_file_label(sample)}_density.npz"), maps, cell_types, box, pixel_um, sigma_um)
+        if per_image_plots:
+            add_heatmaps(maps, box, sample)
+
+    boxes = np.array([box for _, _, box in records], dtype=np.float64)
+    if register:
+        width = np.median(boxes[:, 1] - boxes[:, 0])
+        height = np.median(boxes[:, 3] - boxes[:, 2])
+        extent = (0.0, width, 0.0, height)
+    else:
+        extent = (boxes[:, 0].min(), boxes[:, 1].max(), boxes[:, 2].min(), boxes[:, 3].max())
+    pooled = np.zeros((len(cell_types),) + grid_shape(extent, pixel_um))
+    for _, positions, box in records:
+        transform = None
+        if register:
+            scale = np.array([width / max(box[1] - box[0], 1e-9), height / max(box[3] - box[2], 1e-9)])
+            transform = partial(_register, origin=np.array([box[0], box[2]]), scale=scale)
+        pooled += sample_maps(positions, extent, pixel_um, sigma_um, transform)
+    pooled /= len(records)
+    _save_maps(os.path.join(output_dir, f"{stem}_pooled_density.npz"), pooled, cell_types, extent, pixel_um, sigma_um)
+    add_heatmaps(pooled, extent, f"{stem} pooled")
+    plots.render()
+    print(f"Density maps of {len(records)} images saved to {output_dir}")
+    return pooled
+
+
+def _positions_of(detections, cell_types, class_column, file):
+    # Centroids of one export (run in a worker process)
+    return cell_positions(read_export(os.path.join(detections, file)), cell_types, class_column)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cell-density heatmaps per cell type from detection centroids.")
+    parser.add_argument("detections", help="Directory of detection exports")
+    parser.add_argument("--cell-type", nargs="+", action="append", required=True, metavar=("NAME", "LABEL"),
+                        help="Cell type name followed by its class labels (repeatable)")
+    parser.add_argument("--pixel-um", type=float, default=DEFAULT_PIXEL_UM, help="Grid resolution (µm per pixel)")
+    parser.add_argument("--sigma-um", type=float, default=DEFAULT_SIGMA_UM, help="Gaussian smoothing (µm, 0 = none)")
+    parser.add_argument("--register", action="store_true", help="Register the images by bounding box before pooling")
+    parser.add_argument("--pooled-only", action="store_true", help="Only render the pooled heatmaps")
+    parser.add_argument("--class-column", default="Classification", help="Column of the class labels")
+    parser.add_argument("--output-dir", default="density_maps", help="Output directory")
+    parser.add_argument("--workers", type=int, default=N_WORKERS, help="Worker processes (1 = serial)")
+    args = parser.parse_args()
+
+    cell_types = {cell_type[0]: cell_type[1:] for cell_type in args.cell_type}
+    files = list_exports(args.detections)
+    results = run_per_file(partial(_positions_of, args.detections, cell_types, args.class_column), files,
+                           n_workers=args.workers)
+    records = [(file.replace(" Detections", "").replace(".txt", ""), positions, box)
+               for file, (positions, box) in zip(files, [result or ({}, None) for result in results])]
+    write_density_maps(records, args.output_dir, "density", args.pixel_um, args.sigma_um, args.register,
+                       per_image_plots=not args.pooled_only)
@@ -0,0 +1,162 @@
+import numpy as np
+import pandas as pd
+
+'''
+One-pass distribution summaries (histograms, ECDFs, quantiles, moments, box plot stats)
+for every classification at once.
+
+All values are sorted a single time, grouped by class (one lexsort over class code and
+value). Everything else is read off the sorted arrays: histogram counts for the shared bin
+edges are differences of searchsorted positions, the ECDF is the sorted values themselves,
+quantiles are interpolated by rank, and the moments come from one sum per class. Plots and
+tables then all use the same DistributionSummary instead of re-filtering and re-sorting the
+pooled table for each of them.
+'''
+
+# Columns of the descriptive statistics table, in output order
+STATISTICS_COLUMNS = [
+    "Cell Type", "Min", "Max", "Mean", "25th Percentile", "Median", "75th Percentile",
+    "Standard Deviation", "Variance",
+]
+
+
+def _quantile_sorted(sorted_values, q):
+    # Linear interpolation between closest ranks (same as np.percentile/pd.Series.quantile)
+    n = len(sorted_values)
+    position = np.asarray(q, dtype=float) * (n - 1)
+    lower = np.floor(position).astype(int)
+    upper = np.minimum(lower + 1, n - 1)
+    fraction = position - lower
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * fraction
+
+
+class DistributionSummary:
+    """
+    Sorted values and derived statistics of every class, with shared histogram bins.
+
+    Parameters:
+        values (array-like): Measurement of every cell.
+        codes (array-like): Class code of every cell (index into classes).
+        classes (list): Class labels.
+        bins (int): Number of histogram bins.
+        value_range (tuple): (min, max) of the bins (default: global min and max of all values).
+    """
+
+    def __init__(self, values, codes, classes, bins=20, value_range=None):
+        values = np.asarray(values, dtype=np.float64)
+        codes = np.asarray(codes)
+        keep = ~np.isnan(values)
+        values, codes = values[keep], codes[keep]
+
+        self.classes = list(classes)
+        order = np.lexsort((values, codes))
+        sorted_values = values[order]
+        bounds = np.concatenate([[0], np.cumsum(np.bincount(codes.astype(np.intp), minlength=len(self.classes)))])
+        self.sorted = {cls: sorted_values[bounds[i]:bounds[i + 1]] for i, cls in enumerate(self.classes)}
+
+        if value_range is None:
+            value_range = (values.min(), values.max()) if len(values) else (0.0, 1.0)
+        self.x_min, self.x_max = float(value_range[0]), float(value_range[1])
+        self.edges = np.linspace(self.x_min, self.x_max, bins + 1)
+        self.counts = {cls: self.histogram(cls) for cls in self.classes}
+
+        self.moments = {}
+        for cls, data in self.sorted.items():
+            n = len(data)
+            mean = data.sum() / n if n else np.nan
+            var = ((data - mean) ** 2).sum() / (n - 1) if n > 1 else np.nan
+            self.moments[cls] = {"count": n, "mean": mean, "var": var, "std": np.sqrt(var)}
+
+    @classmethod
+    def from_groups(cls, values_by_class, bins=20, value_range=None):
+        """
+        Builds the summary from a dict of class label -> array of values.
+        """
+        classes = list(values_by_class)
+        arrays = [np.asarray(values_by_class[label], dtype=np.float64) for label in classes]
+        values = np.concatenate(arrays) if arrays else np.empty(0)
+        codes = np.repeat(np.arange(len(classes)), [len(array) for array in arrays])
+        return cls(values, codes, classes, bins, value_range)
+
+    def non_empty(self):
+        """
+        Returns the classes that have at least one value.
+        """
+        return [cls for cls in self.classes if len(self.sorted[cls])]
+
+    def histogram(self, cls, edges=None):
+        """
+        Returns the counts of a class per bin (np.histogram semantics: the last bin includes
+        its right edge, values outside the edges are not counted).
+        """
+        edges = self.edges if edges is None else np.asarray(edges, dtype=np.float64)
+        data = self.sorted[cls]
+        positions = np.searchsorted(data, edges, side="left")
+        positions[-1] = np.searchsorted(data, edges[-1], side="right")
+        return np.diff(positions)
+
+    @property
+    def y_max(self):
+        """
+        Largest bin count over all classes (for a shared y-axis).
+        """
+        return max((int(counts.max()) for counts in self.counts.values() if len(counts)), default=0)
+
+    def ecdf(self, cls):
+        """
+        Returns (sorted values, cumulative fraction) of a class.
+        """
+        data = self.sorted[cls]
+        return data, np.arange(1, len(data) + 1) / len(data)
+
+    def quantiles(self, cls, q):
+        """
+        Returns the q-quantiles (0-1) of a class.
+        """
+        return _quantile_sorted(self.sorted[cls], q)
+
+    def statistics(self, cls):
+        """
+        Returns the descriptive statistics of a class as a dict (see STATISTICS_COLUMNS).
+        """
+        data = self.sorted[cls]
+        q25, q50, q75 = self.quantiles(cls, [0.25, 0.5, 0.75])
+        moments = self.moments[cls]
+        return {
+            "Cell Type": cls,
+            "Min": data[0],
+            "Max": data[-1],
+            "Mean": moments["mean"],
+            "25th Percentile": q25,
+            "Median": q50,
+            "75th Percentile": q75,
+            "Standard Deviation": moments["std"],
+            "Variance": moments["var"],
+        }
+
+    def statistics_table(self):
+        """
+        Returns the descriptive statistics of every non-empty class as a DataFrame.
+        """
+        return pd.DataFrame([self.statistics(cls) for cls in self.non_empty()], columns=STATISTICS_COLUMNS)
+
+    def boxplot_stats(self, cls, whis=1.5):
+        """
+        Returns the box plot statistics of a class in the format of matplotlib's Axes.bxp
+        (quartiles, whiskers at the last values within whis * IQR, and the fliers).
+        """
+        data = self.sorted[cls]
+        q1, median, q3 = self.quantiles(cls, [0.25, 0.5, 0.75])
+        iqr = q3 - q1
+        low = np.searchsorted(data, q1 - whis * iqr, side="left")
+        high = np.searchsorted(data, q3 + whis * iqr, side="right")
+        return {
+            "label": cls,
+            "med": median,
+            "q1": q1,
+            "q3": q3,
+            "whislo": data[low] if low < len(data) and data[low] <= q1 else q1,
+            "whishi": data[high - 1] if high > 0 and data[high - 1] >= q3 else q3,
+            "fliers": np.concatenate([data[:low], data[high:]]),
+            "mean": self.moments[cls]["mean"],
+        }
@@ -1,17 +1,246 @@
-##find and replace string for all text files in a directory
+##find and replace string for all text files in a directory (and its subdirectories)
 ##ensure your script is in the same root directory as your files directory
 
+import argparse
 import fnmatch
+import hashlib
+import json
 import os
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+'''
+Streams every matching export under a root directory through a set of replacement rules.
+
+Files are read and written in fixed-size chunks (never loaded whole) and rewritten through
+a temp file in the same folder that only replaces the original once it is complete. Files
+are processed by a pool of threads (the work is I/O bound). A state file in the root
+directory records the size, modification time and content hash of every file once it is
+clean, so a rerun, or a restart after an interruption, skips clean files without reading
+them. Files that contain none of the strings are never rewritten.
+'''
 
 #root directory where subdirectories/files are located
 root_directory = r"/Users/jamieannemortel/Downloads/RawData_Composite/annotation results"
 
-#find and replace string in each text file in root directory
-for root, dirnames, filenames in os.walk(root_directory):
-  for filename in fnmatch.filter(filenames, '*.txt'):
-    with open(os.path.join(root_directory, filename), "r+") as text_file:
-        texts = text_file.read()
-        texts = texts.replace("#", "")
-    with open(os.path.join(root_directory, filename), "w") as text_file:
-        text_file.write(texts)
+#strings to replace (old -> new); the QuPath exports only need their "#" characters stripped
+replacements = {"#": ""}
+
+#files to process
+file_pattern = "*.txt"
+
+STATE_FILENAME = ".sanitize_state.json"
+CHUNK_SIZE = 8 << 20
+N_THREADS = 8
+
+# Save the state file after this many files, so an interrupted run loses little
+SAVE_EVERY = 50
+
+
+def compile_rules(replacements):
+    """
+    Compiles the replacement rules into one byte pattern (longest strings first).
+
+    Returns:
+        tuple: (compiled pattern, dict of old bytes -> new bytes, length of the longest old string)
+    """
+    rules = {old.encode("utf-8"): new.encode("utf-8") for old, new in replacements.items()}
+    pattern = re.compile(b"|".join(re.escape(old) for old in sorted(rules, key=len, reverse=True)))
+    return pattern, rules, max(len(old) for old in rules)
+
+
+def rules_hash(replacements):
+    """
+    Returns a short hash of the replacement rules (a rule change invalidates the state file).
+    """
+    return hashlib.sha1(json.dumps(replacements, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def needs_cleaning(file_path, pattern, max_len, chunk_size=CHUNK_SIZE):
+    """
+    Scans a file for the strings, hashing it on the way.
+
+    Returns:
+        tuple: (True, None) as soon as one of the strings is found, reading no further than
+        needed, else (False, SHA-1 hex digest of the file).
+    """
+    digest = hashlib.sha1()
+    carry = b""
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            data = carry + chunk
+            if pattern.search(data):
+                return True, None
+            digest.update(chunk)
+            # Keep enough bytes to catch a string split across two chunks
+            carry = data[len(data) - (max_len - 1):] if max_len > 1 else b""
+    return False, digest.hexdigest()
+
+
+def sanitize_file(file_path, pattern, rules, max_len, chunk_size=CHUNK_SIZE):
+    """
+    Rewrites a file with all replacements applied, streaming it chunk by chunk.
+
+    The output goes to a temp file next to the original that replaces it with os.replace,
+    so the original is left untouched if the run is interrupted.
+
+    Returns:
+        tuple: (number of replacements made, SHA-1 hex digest of the rewritten file).
+    """
+    tmp_path = os.path.join(os.path.dirname(file_path), f".{os.path.basename(file_path)}.sanitize.tmp")
+    n_replaced = 0
+    digest = hashlib.sha1()
+    try:
+        with open(file_path, "rb") as src, open(tmp_path, "wb") as dst:
+            carry = b""
+            while True:
+                chunk = src.read(chunk_size)
+                data = carry + chunk
+                last = not chunk
+                # Matches starting before safe_end are complete; the rest waits for the next chunk
+                safe_end = len(data) if last else max(0, len(data) - (max_len - 1))
+                out = []
+                pos = 0
+                for match in pattern.finditer(data):
+                    if match.start() >= safe_end:
+                        break
+                    out.append(data[pos:match.start()])
+                    out.append(rules[match.group()])
+                    pos = match.end()
+                    n_replaced += 1
+                end = max(pos, safe_end)
+                out.append(data[pos:end])
+                block = b"".join(out)
+                digest.update(block)
+                dst.write(block)
+                carry = data[end:]
+                if last:
+                    break
+        shutil.copymode(file_path, tmp_path)
+        os.replace(tmp_path, file_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return n_replaced, digest.hexdigest()
+
+
+def find_files(root_directory, file_pattern):
+    """
+    Returns the paths of all matching files under root_directory, including subfolders.
+    """
+    matches = []
+    for root, dirnames, filenames in os.walk(root_directory):
+        for filename in fnmatch.filter(filenames, file_pattern):
+            if not filename.startswith("._"):
+                matches.append(os.path.join(root, filename))
+    return sorted(matches)
+
+
+def load_state(state_path, rules_key):
+    """
+    Returns the per-file state recorded for these rules ({} if none or if the rules changed).
+    """
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path) as file:
+        state = json.load(file)
+    return state.get("files", {}) if state.get("rules") == rules_key else {}
+
+
+def save_state(state_path, rules_key, files):
+    """
+    Writes the state file atomically (temp file + rename).
+    """
+    with open(state_path + ".tmp", "w") as file:
+        json.dump({"rules": rules_key, "files": files}, file)
+    os.replace(state_path + ".tmp", state_path)
+
+
+def process_file(file_path, entry, pattern, rules, max_len, chunk_size=CHUNK_SIZE):
+    """
+    Cleans one file unless its recorded state shows it is already clean. The file is read
+    at most twice: once to scan and hash it, once more to rewrite it (hashing the output).
+
+    Parameters:
+        file_path (str): File to clean.
+        entry (dict): Recorded {"size", "mtime_ns", "sha1"} of the clean file, or None.
+
+    Returns:
+        tuple: (status, new state entry) with status "skipped", "clean" or the number of
+        replacements made.
+    """
+    stat = os.stat(file_path)
+    if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+        return "skipped", entry
+
+    found, sha1 = needs_cleaning(file_path, pattern, max_len, chunk_size)
+    if not found:
+        # Touched or copied but unchanged files are recognized by their content hash
+        status = "skipped" if entry and entry["sha1"] == sha1 else "clean"
+        return status, {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha1": sha1}
+    status, sha1 = sanitize_file(file_path, pattern, rules, max_len, chunk_size)
+    stat = os.stat(file_path)
+    return status, {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha1": sha1}
+
+
+def sanitize_directory(root_directory, replacements, file_pattern="*.txt", n_threads=N_THREADS, chunk_size=CHUNK_SIZE):
+    """
+    Applies the replacements to every matching file under root_directory.
+
+    Parameters:
+        root_directory (str): Directory to walk.
+        replacements (dict): Old string -> new string.
+        file_pattern (str): Filename pattern of the files to process.
+        n_threads (int): Files processed at the same time.
+        chunk_size (int): Bytes read per chunk.
+    """
+    pattern, rules, max_len = compile_rules(replacements)
+    rules_key = rules_hash(replacements)
+    state_path = os.path.join(root_directory, STATE_FILENAME)
+    state = load_state(state_path, rules_key)
+
+    files = find_files(root_directory, file_pattern)
+    counts = {"skipped": 0, "clean": 0, "rewritten": 0, "failed": 0}
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        futures = {
+            executor.submit(process_file, path, state.get(os.path.relpath(path, root_directory)),
+                            pattern, rules, max_len, chunk_size): path
+            for path in files
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            path = futures[future]
+            key = os.path.relpath(path, root_directory)
+            try:
+                status, entry = future.result()
+            except Exception as e:
+                print(f"Error processing {path}: {e}")
+                counts["failed"] += 1
+                continue
+            state[key] = entry
+            if status in ("skipped", "clean"):
+                counts[status] += 1
+            else:
+                counts["rewritten"] += 1
+                print(f"{key}: {status} replacements")
+            if done % SAVE_EVERY == 0:
+                save_state(state_path, rules_key, state)
+
+    # Forget files that no longer exist
+    current = {os.path.relpath(path, root_directory) for path in files}
+    state = {key: entry for key, entry in state.items() if key in current}
+    save_state(state_path, rules_key, state)
+    print(f"{len(files)} files: {counts['rewritten']} rewritten, {counts['clean']} already clean, "
+          f"{counts['skipped']} skipped (unchanged since the last run), {counts['failed']} failed")
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find and replace strings in all text files under a directory.")
+    parser.add_argument("directory", nargs="?", default=root_directory, help="Root directory (default: root_directory)")
+    parser.add_argument("--threads", type=int, default=N_THREADS, help="Files processed at the same time")
+    parser.add_argument("--chunk-mb", type=int, default=CHUNK_SIZE >> 20, help="Read chunk size in MB")
+    args = parser.parse_args()
+
+    #find and replace string in each text file in root directory (and subdirectories)
+    sanitize_directory(args.directory, replacements, file_pattern, n_threads=args.threads, chunk_size=args.chunk_mb << 20)
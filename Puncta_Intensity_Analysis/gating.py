@@ -0,0 +1,264 @@
+import numpy as np
+import pandas as pd
+
+from binned_kde import binned_kde
+from mixture_models import fit_mixtures
+
+'''
+Gating of per-cell measurements: thresholds and robust outlier rules for many columns and
+groups in one grouped pass.
+
+The gate of a column is a list of rules applied in order; the bounds of every rule are
+computed per group from the cells kept by the rules before it (e.g. the IQR of the cells
+above the KDE threshold). Rules:
+
+    {"rule": "fixed", "lower": 0.01, "upper": None}   fixed bounds (inclusive)
+    {"rule": "kde"}                                   above the first valley of the binned KDE
+    {"rule": "mixture", "family": "gaussian"}         above the crossing of a two-component
+                                                      mixture (see mixture_models.py), fitted
+                                                      for all groups in one EM loop
+    {"rule": "iqr", "k": 1.5}                         within k IQRs of the quartiles
+    {"rule": "mad", "k": 3.5}                         modified z-score 0.6745 (x - median) / MAD
+                                                      within k
+    {"rule": "percentile", "lower": 1, "upper": 99}   between two percentiles
+
+Threshold rules ("kde", "mixture") keep the cells strictly above the threshold; their
+"fallback" setting (another rule, e.g. {"rule": "kde", "fallback": {"rule": "mixture"}})
+gives the bounds of the groups without a threshold (no valley, too few cells), and their
+"if_missing" setting ("keep" or "drop") decides what happens to a group that still has none.
+
+The values of a column are sorted once (by group, then value) and the quantiles of every
+group are read off the sorted values by rank, so a rule costs one pass over the column
+whatever the number of groups. The result is a boolean keep-mask over the input rows (a
+cell must pass the gates of all columns; NaNs never pass) and a table of per-group gate
+statistics, instead of filtered copies of the data.
+'''
+
+# Columns of the gate statistics table
+GATE_STATISTICS_COLUMNS = ["Group", "Column", "Rule", "Lower", "Upper", "Cells", "Kept"]
+
+# Modified z-score scale (MAD of a normal distribution in standard deviations)
+MAD_SCALE = 0.6745
+
+
+def _group_bounds(codes, n_groups):
+    # Start of every group (and the end of the last) in values sorted by group code
+    return np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=n_groups))])
+
+
+def _group_quantiles(sorted_values, bounds, q):
+    # Linear interpolation between closest ranks within every group (as np.percentile);
+    # NaN for empty groups
+    n = np.diff(bounds)
+    if not len(sorted_values):
+        return np.full(len(n), np.nan)
+    position = bounds[:-1] + q * np.maximum(n - 1, 0)
+    lower = np.minimum(np.floor(position).astype(np.intp), len(sorted_values) - 1)
+    upper = np.minimum(lower + 1, np.maximum(bounds[1:] - 1, 0))
+    fraction = position - lower
+    result = sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * fraction
+    result[n == 0] = np.nan
+    return result
+
+
+def mixture_threshold(values, iterations=200, tolerance=1e-8):
+    """
+    Fits a two-component Gaussian mixture by EM and returns the point between the two means
+    where both weighted components are equally likely, or None if there is none.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    fit = fit_mixtures(values, np.zeros(len(values), dtype=np.intp), 1, "gaussian", iterations, tolerance)
+    return None if np.isnan(fit.thresholds[0]) else float(fit.thresholds[0])
+
+
+def _threshold_bounds(threshold_of, groups):
+    lower = np.array([np.nan if threshold is None else threshold
+                      for threshold in (threshold_of(values) for values in groups)], dtype=np.float64)
+    return lower, np.full(len(groups), np.inf)
+
+
+def _kde_bounds(rule, sorted_values, bounds, row_groups):
+    settings = {"bandwidth": rule.get("bandwidth", "scott"), "gridsize": rule.get("gridsize", 1000)}
+
+    def threshold_of(values):
+        kde = binned_kde(values, **settings)
+        return kde.threshold if kde is not None else None
+    return _threshold_bounds(threshold_of, row_groups())
+
+
+def _mixture_bounds(rule, sorted_values, bounds, row_groups):
+    # All groups in one batched EM over the segmented sorted values
+    n_groups = len(bounds) - 1
+    codes = np.repeat(np.arange(n_groups), np.diff(bounds))
+    fit = fit_mixtures(sorted_values, codes, n_groups, rule.get("family", "gaussian"))
+    return fit.thresholds, np.full(n_groups, np.inf)
+
+
+def _fixed_bounds(rule, sorted_values, bounds, row_groups):
+    n_groups = len(bounds) - 1
+    lower = -np.inf if rule.get("lower") is None else rule["lower"]
+    upper = np.inf if rule.get("upper") is None else rule["upper"]
+    return np.full(n_groups, lower, dtype=np.float64), np.full(n_groups, upper, dtype=np.float64)
+
+
+def _iqr_bounds(rule, sorted_values, bounds, row_groups):
+    k = rule.get("k", 1.5)
+    q1 = _group_quantiles(sorted_values, bounds, 0.25)
+    q3 = _group_quantiles(sorted_values, bounds, 0.75)
+    return q1 - k * (q3 - q1), q3 + k * (q3 - q1)
+
+
+def _mad_bounds(rule, sorted_values, bounds, row_groups):
+    k = rule.get("k", 3.5)
+    median = _group_quantiles(sorted_values, bounds, 0.5)
+    codes = np.repeat(np.arange(len(bounds) - 1), np.diff(bounds))
+    deviations = np.abs(sorted_values - median[codes])
+    # Deviations are sorted again within every group (one lexsort for all groups)
+    mad = _group_quantiles(deviations[np.lexsort((deviations, codes))], bounds, 0.5)
+    return median - k * mad / MAD_SCALE, median + k * mad / MAD_SCALE
+
+
+def _percentile_bounds(rule, sorted_values, bounds, row_groups):
+    return (_group_quantiles(sorted_values, bounds, rule.get("lower", 1) / 100),
+            _group_quantiles(sorted_values, bounds, rule.get("upper", 99) / 100))
+
+
+# Rule name -> (bounds function, whether the lower bound is a strict threshold)
+RULES = {
+    "fixed": (_fixed_bounds, False),
+    "kde": (_kde_bounds, True),
+    "mixture": (_mixture_bounds, True),
+    "iqr": (_iqr_bounds, False),
+    "mad": (_mad_bounds, False),
+    "percentile": (_percentile_bounds, False),
+}
+
+
+class GateResult:
+    """
+    Keep-mask and per-group statistics of a gating pass.
+
+    Attributes:
+        keep (np.ndarray): True for the rows that pass every gate.
+        statistics (pd.DataFrame): One row per group, column and rule (GATE_STATISTICS_COLUMNS):
+            the bounds of the rule and the cells before ("Cells") and after ("Kept") it.
+    """
+
+    def __init__(self, keep, statistics):
+        self.keep = keep
+        self.statistics = statistics
+
+    def bounds(self, rule, column=None):
+        """
+        Returns group -> lower bound (threshold) of a rule, None where there is none.
+        """
+        rows = self.statistics[self.statistics["Rule"] == rule]
+        if column is not None:
+            rows = rows[rows["Column"] == column]
+        return {group: (None if np.isnan(lower) else float(lower)) for group, lower in zip(rows["Group"], rows["Lower"])}
+
+
+def gate_values(values_by_column, codes, groups, rules):
+    """
+    Gates per-cell values of several columns within groups.
+
+    Parameters:
+        values_by_column (dict): Column -> per-row values.
+        codes (array-like): Group code of every row (index into groups; negative = no group,
+            never kept).
+        groups (list): Group labels.
+        rules (list or dict): Rules applied to every column, or column -> rules.
+
+    Returns:
+        GateResult: Keep-mask over the rows and the gate statistics.
+    """
+    codes = np.asarray(codes, dtype=np.intp)
+    n_groups = len(groups)
+    keep = codes >= 0
+    codes = np.where(keep, codes, 0)
+    records = []
+
+    for column, values in values_by_column.items():
+        column_rules = rules.get(column, []) if isinstance(rules, dict) else rules
+        values = np.where(keep, np.asarray(values, dtype=np.float64), np.nan)
+        order = np.lexsort((values, codes))
+        sorted_values, sorted_codes = values[order], codes[order]
+        kept = ~np.isnan(sorted_values)
+
+        for rule in column_rules:
+            bounds_of, strict = RULES[rule["rule"]]
+            kept_bounds = _group_bounds(sorted_codes[kept], n_groups)
+
+            def row_groups():
+                # Kept values of every group in row order (the order binned_kde caches on)
+                rows = np.zeros(len(values), dtype=bool)
+                rows[order[kept]] = True
+                row_order = np.argsort(codes, kind="stable")
+                row_order = row_order[rows[row_order]]
+                group_bounds = _group_bounds(codes[row_order], n_groups)
+                return [values[row_order[group_bounds[g]:group_bounds[g + 1]]] for g in range(n_groups)]
+
+            lower, upper = bounds_of(rule, sorted_values[kept], kept_bounds, row_groups)
+            if "fallback" in rule and np.isnan(lower).any():
+                fallback_of = RULES[rule["fallback"]["rule"]][0]
+                fallback_lower, fallback_upper = fallback_of(rule["fallback"], sorted_values[kept], kept_bounds, row_groups)
+                missing_groups = np.isnan(lower)
+                lower = np.where(missing_groups, fallback_lower, lower)
+                upper = np.where(missing_groups, fallback_upper, upper)
+            missing = -np.inf if rule.get("if_missing", "keep") == "keep" else np.inf
+            effective_lower = np.where(np.isnan(lower), missing, lower)[sorted_codes]
+            effective_upper = np.where(np.isnan(upper), np.inf, upper)[sorted_codes]
+            above = sorted_values > effective_lower if strict else sorted_values >= effective_lower
+            kept &= above & (sorted_values <= effective_upper)
+
+            kept_after = np.bincount(sorted_codes[kept], minlength=n_groups)
+            for g, group in enumerate(groups):
+                records.append((group, column, rule["rule"], lower[g], upper[g],
+                                int(kept_bounds[g + 1] - kept_bounds[g]), int(kept_after[g])))
+
+        column_keep = np.zeros(len(values), dtype=bool)
+        column_keep[order[kept]] = True
+        keep &= column_keep
+
+    return GateResult(keep, pd.DataFrame(records, columns=GATE_STATISTICS_COLUMNS))
+
+
+def gate(frame, columns, rules, by=None):
+    """
+    Gates the columns of a cell table within the groups of the by column(s).
+
+    Returns:
+        GateResult: Keep-mask aligned with the rows of frame, and the gate statistics.
+    """
+    if by is None:
+        codes, groups = np.zeros(len(frame), dtype=np.intp), ["All"]
+    else:
+        grouped = frame.groupby(by, sort=True)
+        codes, groups = grouped.ngroup().to_numpy(), list(grouped.groups)
+    values = {column: pd.to_numeric(frame[column], errors="coerce").to_numpy() for column in columns}
+    return gate_values(values, codes, groups, rules)
+
+
+def gate_groups(frames, columns, rules):
+    """
+    Gates the columns of several cell tables, each table being one group.
+
+    Parameters:
+        frames (dict): Group -> DataFrame.
+        columns (list): Columns to gate.
+        rules (list or dict): Rules applied to every column, or column -> rules.
+
+    Returns:
+        tuple: (group -> keep-mask aligned with the rows of its table, GateResult over all rows).
+    """
+    groups = list(frames)
+    sizes = [len(frames[group]) for group in groups]
+    codes = np.repeat(np.arange(len(groups)), sizes)
+    values = {
+        column: np.concatenate([pd.to_numeric(frames[group][column], errors="coerce").to_numpy(dtype=np.float64)
+                                for group in groups]) if groups else np.empty(0)
+        for column in columns
+    }
+    result = gate_values(values, codes, groups, rules)
+    masks = dict(zip(groups, np.split(result.keep, np.cumsum(sizes)[:-1])))
+    return masks, result
@@ -0,0 +1,170 @@
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from qupath_io import ClassIndex, read_export
+
+'''
+Joins cell rows of a QuPath export with their child rows (spots, subcellular clusters), so
+cell measurements and per-cell puncta counts end up in one per-cell table.
+
+Every child row is located in a HierarchyIndex of the cells:
+
+    by ID        the child's "Parent ID" is looked up among the cells' "Object ID" (hash
+                 index; exact, used when both columns are exported)
+    by centroid  the child goes to the nearest cell centroid among the cells of the same image
+                 whose display name ("Cell (<classification>)", or the cell's Name) equals
+                 the child's Parent (one KD-tree per image and name; optionally within a
+                 maximum distance)
+
+The children's measurements are then aggregated per cell in one grouped pass (sum, mean,
+min, max, count) and added as columns of the cell table; cells without children get 0 for
+sums and counts.
+'''
+
+CELL_ID_COLUMN = "Object ID"
+PARENT_ID_COLUMN = "Parent ID"
+CENTROID_COLUMNS = ("Centroid X µm", "Centroid Y µm")
+IMAGE_COLUMN = "Image"
+
+# Name of the column with the number of children of every cell
+CHILD_COUNT_COLUMN = "Child Count"
+
+
+def parent_labels(cells, class_column="Classification", object_name="Cell"):
+    """
+    Returns the display name children refer to as their Parent: the cell's Name if it has
+    one, "<object_name> (<classification>)" otherwise.
+    """
+    labels = object_name + " (" + cells[class_column].astype(str) + ")"
+    if "Name" in cells.columns:
+        names = cells["Name"].astype(object)
+        labels = names.where(names.notna() & (names.astype(str) != ""), labels)
+    return labels.astype(str)
+
+
+def _join_keys(frame, labels):
+    # Parent name, prefixed by the image for exports of several images
+    if IMAGE_COLUMN in frame.columns:
+        return frame[IMAGE_COLUMN].astype(str).to_numpy() + "\x1f" + np.asarray(labels, dtype=object)
+    return np.asarray(labels, dtype=object)
+
+
+class HierarchyIndex:
+    """
+    Lookup of the parent cell of child rows, by object ID or by centroid.
+
+    Parameters:
+        cells (pd.DataFrame): Cell rows of one export.
+        class_column (str): Column of the cell classification (for the parent names).
+    """
+
+    def __init__(self, cells, class_column="Classification"):
+        self.cells = cells
+        self.has_ids = CELL_ID_COLUMN in cells.columns
+        self._ids = pd.Index(cells[CELL_ID_COLUMN]) if self.has_ids else None
+        self._keys = _join_keys(cells, parent_labels(cells, class_column))
+        self._trees = {}
+
+    def _tree(self, key):
+        # KD-tree of the centroids of the cells with one parent key, built on first use
+        if key not in self._trees:
+            positions = np.flatnonzero(self._keys == key)
+            points = self.cells[list(CENTROID_COLUMNS)].to_numpy(dtype=np.float64)[positions]
+            self._trees[key] = (cKDTree(points) if len(positions) else None, positions)
+        return self._trees[key]
+
+    def locate(self, children, how="auto", max_distance=None):
+        """
+        Returns the row position (in cells) of the parent of every child, -1 if none.
+
+        Parameters:
+            children (pd.DataFrame): Child rows with "Parent" (and "Parent ID" or centroids).
+            how (str): "id", "centroid" or "auto" (IDs if both tables have them).
+            max_distance (float): Centroid join only: farthest allowed cell centroid (µm).
+        """
+        if how == "auto":
+            how = "id" if self.has_ids and PARENT_ID_COLUMN in children.columns else "centroid"
+        if how == "id":
+            return self._ids.get_indexer(children[PARENT_ID_COLUMN])
+
+        parents = np.full(len(children), -1, dtype=np.intp)
+        keys = _join_keys(children, children["Parent"].astype(str))
+        points = children[list(CENTROID_COLUMNS)].to_numpy(dtype=np.float64)
+        codes, uniques = pd.factorize(keys)
+        order = np.argsort(codes, kind="stable")
+        bounds = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(uniques)))])
+        for code, key in enumerate(uniques):
+            tree, positions = self._tree(key)
+            if tree is None:
+                continue
+            rows = order[bounds[code]:bounds[code + 1]]
+            distance, nearest = tree.query(points[rows], distance_upper_bound=max_distance or np.inf)
+            found = np.isfinite(distance)
+            parents[rows[found]] = positions[nearest[found]]
+        return parents
+
+
+def join_children(cells, children, measurements=None, how="auto", max_distance=None,
+                  class_column="Classification"):
+    """
+    Adds the aggregated measurements of every cell's children to the cell table.
+
+    Parameters:
+        cells (pd.DataFrame): Cell rows.
+        children (pd.DataFrame): Child rows (spots, clusters).
+        measurements (dict): Child column -> "sum", "mean", "min", "max" or "count"
+            (default: {"Num spots": "sum"}).
+        how, max_distance: See HierarchyIndex.locate.
+
+    Returns:
+        pd.DataFrame: The cell rows with one column per aggregated measurement plus
+        CHILD_COUNT_COLUMN (children without a parent cell are left out).
+    """
+    measurements = {"Num spots": "sum"} if measurements is None else measurements
+    parents = HierarchyIndex(cells, class_column).locate(children, how, max_distance)
+    matched = parents >= 0
+    if len(children) and not matched.all():
+        print(f"{int((~matched).sum())} of {len(children)} child rows without a parent cell.")
+
+    parents = parents[matched]
+    counts = np.bincount(parents, minlength=len(cells))
+    columns = {CHILD_COUNT_COLUMN: counts}
+    for column, how_to in measurements.items():
+        values = pd.to_numeric(children[column], errors="coerce").to_numpy(dtype=np.float64)[matched]
+        if how_to == "count":
+            columns[column] = np.bincount(parents, weights=~np.isnan(values), minlength=len(cells)).astype(np.int64)
+        elif how_to in ("sum", "mean"):
+            total = np.bincount(parents, weights=np.nan_to_num(values), minlength=len(cells))
+            if how_to == "mean":
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    total = total / np.bincount(parents, weights=~np.isnan(values), minlength=len(cells))
+            columns[column] = total
+        elif how_to in ("min", "max"):
+            extreme = np.full(len(cells), np.nan)
+            (np.fmin if how_to == "min" else np.fmax).at(extreme, parents, values)
+            columns[column] = extreme
+        else:
+            raise ValueError(f"Unknown aggregation for {column}: {how_to}")
+    return cells.assign(**columns)
+
+
+def join_export(file_path, cell_labels, measurements=None, cell_columns=None, how="auto", max_distance=None,
+                class_column="Classification"):
+    """
+    Reads one detection export and returns its cells of the given classifications, each
+    with the aggregated measurements of its child rows.
+
+    Parameters:
+        file_path (str): Detection export.
+        cell_labels (list): Classifications of the cells to keep.
+        measurements (dict): Child column -> aggregation (see join_children).
+        cell_columns (list): Cell columns to keep (default: all).
+    """
+    det_data = read_export(file_path)
+    cells = ClassIndex(det_data, class_column).select(cell_labels)
+    if cell_columns is not None:
+        keys = [CELL_ID_COLUMN, IMAGE_COLUMN, "Name", class_column, *CENTROID_COLUMNS]
+        cells = cells[[column for column in dict.fromkeys(list(cell_columns) + keys) if column in cells.columns]]
+    children = ClassIndex(det_data, "Parent").select(parent_labels(cells, class_column).unique())
+    return join_children(cells, children, measurements, how, max_distance, class_column)
@@ -0,0 +1,116 @@
+import hashlib
+import json
+import math
+import os
+
+'''
+Processed-sample manifest for incremental runs of the txt_to_cell_analysis pipelines.
+
+The manifest remembers, for every detection export, the fingerprint (size and modification
+time) of the export and of its annotation export together with the summary row it produced.
+On the next run only new or changed exports are processed, exports that disappeared are
+dropped, and the output table is rebuilt from the stored rows. Changing the summary settings
+(cell populations, metrics, totals) invalidates every stored row.
+'''
+
+
+def settings_hash(*settings):
+    """
+    Returns a short hash of JSON-serializable pipeline settings.
+    """
+    text = json.dumps(settings, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+def path_fingerprint(file_path):
+    """
+    Returns [size, mtime_ns] for an existing file, or None if it does not exist.
+    """
+    if not os.path.exists(file_path):
+        return None
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _json_value(value):
+    # NaN/None become null; NumPy scalars become plain Python numbers
+    if value is None:
+        return None
+    if hasattr(value, "item"):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+class SampleManifest:
+    """
+    Maps each processed export to its input fingerprint and summary row.
+
+    Parameters:
+        manifest_path (str): JSON file holding the manifest.
+        settings (str): Hash of the settings the stored rows were computed with.
+    """
+
+    def __init__(self, manifest_path, settings=""):
+        self.manifest_path = manifest_path
+        self.settings = settings
+        self.entries = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as file:
+                manifest = json.load(file)
+            if manifest.get("settings") == settings:
+                self.entries = manifest.get("samples", {})
+            else:
+                print("Summary settings changed since the last run: reprocessing every sample.")
+
+    def stale(self, fingerprints):
+        """
+        Returns the files whose fingerprint is new or differs from the stored one.
+
+        Parameters:
+            fingerprints (dict): File name -> fingerprint for every current export.
+        """
+        return [
+            file for file, fingerprint in fingerprints.items()
+            if file not in self.entries or self.entries[file]["fingerprint"] != fingerprint
+        ]
+
+    def prune(self, files):
+        """
+        Drops entries for exports that no longer exist and returns their names.
+        """
+        removed = [file for file in self.entries if file not in set(files)]
+        for file in removed:
+            del self.entries[file]
+        return removed
+
+    def update(self, file, fingerprint, row):
+        """
+        Stores the summary row (a dict of column -> value) produced by an export.
+        """
+        self.entries[file] = {
+            "fingerprint": fingerprint,
+            "row": {column: _json_value(value) for column, value in row.items()},
+        }
+
+    def discard(self, file):
+        """
+        Forgets an export (e.g. one that failed or lost its annotation export).
+        """
+        self.entries.pop(file, None)
+
+    def rows(self, files):
+        """
+        Returns the stored rows for the given files, in that order, skipping unknown files.
+        """
+        return [self.entries[file]["row"] for file in files if file in self.entries]
+
+    def save(self):
+        """
+        Writes the manifest atomically (temp file + rename).
+        """
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump({"settings": self.settings, "samples": self.entries}, file)
+        os.replace(tmp_path, self.manifest_path)
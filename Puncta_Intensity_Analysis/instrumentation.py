@@ -0,0 +1,299 @@
+import functools
+import json
+import os
+import sys
+import time
+from contextlib import nullcontext
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows: peak RSS is left out
+    resource = None
+
+'''
+Per-stage timing and memory instrumentation for the analysis pipelines.
+
+Profiling is off unless the PUNCTA_PROFILE environment variable is set (or enable() is
+called); while it is off every hook returns immediately, so the pipelines run as before:
+
+    PUNCTA_PROFILE=1 python txt_to_cell_analysis_withRNAmetrics.py             summary table
+    PUNCTA_PROFILE=profile.json python txt_to_cell_analysis_withRNAmetrics.py  + Chrome trace
+
+Hooks:
+
+    with stage("convert"):        times a block (stages nest)
+    @timed("aggregate")           times every call of a function
+    phase("write")                ends the previous phase and starts the next one, for flat
+                                  scripts whose steps are not blocks
+    count(rows=n, bytes_read=b)   adds rows processed / bytes read to every open stage
+                                  (read_export and the streaming readers do this themselves)
+    report()                      prints the summary table and writes the trace
+
+Every stage records wall time, CPU time (of the process, plus the CPU time of the worker
+processes it waited for), the peak resident set size (high-water mark of the process, or of
+the largest worker) at its end, rows processed and bytes read. run_per_file wraps every file
+in a stage named after the worker, records it in the worker process and ships it back with
+the result, so the trace shows one bar per file on the worker's row and the totals of the
+files add up in the stage that ran the pool. The trace file opens in chrome://tracing or
+https://ui.perfetto.dev.
+'''
+
+ENV_VARIABLE = "PUNCTA_PROFILE"
+
+SUMMARY_COLUMNS = ["Stage", "Calls", "Wall (s)", "CPU (s)", "Peak RSS (MB)", "Rows", "Read (MB)", "Rows/s"]
+
+# ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+_NULL_STAGE = nullcontext()
+
+
+def peak_rss_mb():
+    """
+    Returns the high-water mark of the process's resident set size in MB (None without
+    the resource module).
+    """
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNIT / 2 ** 20
+
+
+class _Profiler:
+    def __init__(self, trace_path=None):
+        self.trace_path = trace_path
+        self.events = []
+        self.open = []
+        self.phase = None
+
+
+class _Stage:
+    """
+    One timed block; becomes an event when it exits.
+    """
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.rows = 0
+        self.bytes_read = 0
+        self.child_cpu = 0.0
+        self.child_rss = None
+
+    def __enter__(self):
+        self.depth = len(_profiler.open)
+        _profiler.open.append(self)
+        self.timestamp = time.time()
+        self.cpu_start = time.process_time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall = time.perf_counter() - self.start
+        cpu = time.process_time() - self.cpu_start + self.child_cpu
+        rss = peak_rss_mb()
+        if self.child_rss is not None:
+            rss = max(rss or 0.0, self.child_rss)
+        if self in _profiler.open:
+            _profiler.open.remove(self)
+        _profiler.events.append({
+            "name": self.name, "args": self.args, "pid": os.getpid(), "depth": self.depth,
+            "timestamp": self.timestamp, "wall": wall, "cpu": cpu, "peak_rss_mb": rss,
+            "rows": self.rows, "bytes_read": self.bytes_read,
+        })
+        return False
+
+
+def _from_environment():
+    value = os.environ.get(ENV_VARIABLE, "")
+    if not value or value == "0":
+        return None
+    return _Profiler(value if value.endswith(".json") else None)
+
+
+_profiler = _from_environment()
+
+
+def enabled():
+    """
+    Returns True while profiling is on.
+    """
+    return _profiler is not None
+
+
+def enable(trace_path=None):
+    """
+    Turns profiling on for this process and the worker processes it starts afterwards.
+
+    Parameters:
+        trace_path (str): Where report() writes the Chrome trace (None: summary only).
+    """
+    global _profiler
+    _profiler = _Profiler(trace_path)
+    os.environ[ENV_VARIABLE] = trace_path or "1"
+
+
+def disable():
+    """
+    Turns profiling off and drops everything recorded.
+    """
+    global _profiler
+    _profiler = None
+    os.environ.pop(ENV_VARIABLE, None)
+
+
+def stage(name, **args):
+    """
+    Returns a context manager timing a block as the stage name (extra keyword arguments,
+    e.g. file=..., are kept with the event).
+    """
+    if _profiler is None:
+        return _NULL_STAGE
+    return _Stage(name, args)
+
+
+def timed(name=None):
+    """
+    Decorator timing every call of a function as a stage (default name: the function's).
+    """
+    def decorate(function):
+        label = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return function(*args, **kwargs)
+            with _Stage(label, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def phase(name):
+    """
+    Ends the current phase (if any) and starts a new stage called name (None: just end it).
+    """
+    if _profiler is None:
+        return
+    if _profiler.phase is not None:
+        _profiler.phase.__exit__(None, None, None)
+        _profiler.phase = None
+    if name is not None:
+        _profiler.phase = _Stage(name, {}).__enter__()
+
+
+def count(rows=0, bytes_read=0):
+    """
+    Adds rows processed and bytes read to every open stage.
+    """
+    if _profiler is None:
+        return
+    for open_stage in _profiler.open:
+        open_stage.rows += rows
+        open_stage.bytes_read += bytes_read
+
+
+def checkpoint():
+    """
+    Returns the number of events recorded so far (None while profiling is off).
+    """
+    return None if _profiler is None else len(_profiler.events)
+
+
+def take_events(start):
+    """
+    Removes and returns the events recorded since checkpoint() returned start (None while
+    profiling is off), e.g. to send them from a worker process to the parent.
+    """
+    if _profiler is None or start is None:
+        return None
+    events = _profiler.events[start:]
+    del _profiler.events[start:]
+    return events
+
+
+def absorb(events):
+    """
+    Adds events taken in another process (or in this one) back to the record. The rows,
+    bytes, CPU time and peak RSS of another process's outermost events count towards the
+    stages open here.
+    """
+    if _profiler is None or not events:
+        return
+    _profiler.events.extend(events)
+    foreign = [event for event in events if event["pid"] != os.getpid()]
+    if not foreign:
+        return
+    top = min(event["depth"] for event in foreign)
+    for event in foreign:
+        if event["depth"] != top:
+            continue
+        for open_stage in _profiler.open:
+            open_stage.rows += event["rows"]
+            open_stage.bytes_read += event["bytes_read"]
+            open_stage.child_cpu += event["cpu"]
+            if event["peak_rss_mb"] is not None:
+                open_stage.child_rss = max(open_stage.child_rss or 0.0, event["peak_rss_mb"])
+
+
+def summary(per_file=False):
+    """
+    Returns the summary table: one row per stage name in order of first use (or, with
+    per_file, one row per stage and file for the stages that ran per file).
+    """
+    if _profiler is None or not _profiler.events:
+        return pd.DataFrame(columns=SUMMARY_COLUMNS)
+    events = pd.DataFrame(_profiler.events)
+    events["Stage"] = events["name"]
+    if per_file:
+        events["file"] = [args.get("file") for args in events["args"]]
+        events = events[events["file"].notna()]
+        events = events.assign(Stage=[f"{name}: {file}" for name, file in zip(events["name"], events["file"])])
+    grouped = events.groupby("Stage", sort=False)
+    table = pd.DataFrame({
+        "Calls": grouped.size(),
+        "Wall (s)": grouped["wall"].sum(),
+        "CPU (s)": grouped["cpu"].sum(),
+        "Peak RSS (MB)": grouped["peak_rss_mb"].max(),
+        "Rows": grouped["rows"].sum(),
+        "Read (MB)": grouped["bytes_read"].sum() / 2 ** 20,
+    }).reset_index()
+    table["Rows/s"] = (table["Rows"] / table["Wall (s)"].where(table["Wall (s)"] > 0)).fillna(0)
+    return table[SUMMARY_COLUMNS]
+
+
+def chrome_trace():
+    """
+    Returns the recorded events in the Chrome trace event format (complete events, one
+    row per process).
+    """
+    events = [] if _profiler is None else _profiler.events
+    trace = []
+    for event in events:
+        args = dict(event["args"], cpu_s=round(event["cpu"], 6), peak_rss_mb=event["peak_rss_mb"],
+                    rows=event["rows"], bytes_read=event["bytes_read"])
+        trace.append({
+            "name": event["name"], "ph": "X", "pid": event["pid"], "tid": event["pid"],
+            "ts": event["timestamp"] * 1e6, "dur": event["wall"] * 1e6, "args": args,
+        })
+    return {"traceEvents": trace, "displayTimeUnit": "ms"}
+
+
+def report(per_file=False, trace_path=None):
+    """
+    Ends the current phase, prints the summary table and writes the Chrome trace (to
+    trace_path, or the path given by PUNCTA_PROFILE / enable()). Does nothing while
+    profiling is off.
+    """
+    if _profiler is None:
+        return
+    phase(None)
+    table = summary(per_file)
+    print("Profile:")
+    print(table.to_string(index=False, float_format=lambda value: f"{value:.3f}"))
+    trace_path = trace_path or _profiler.trace_path
+    if trace_path:
+        with open(trace_path, "w") as file:
+            json.dump(chrome_trace(), file)
+        print(f"Trace saved to {trace_path}")
@@ -0,0 +1,360 @@
+import argparse
+import os
+from functools import partial
+import numpy as np
+import pandas as pd
+from scipy.special import gammaln
+
+from parallel_processing import N_WORKERS, run_per_file
+from qupath_io import ClassIndex, list_exports, read_export
+from threshold_sweep import cell_frame
+
+'''
+Two-component mixture models for positivity calling, fitted by EM for every group (e.g.
+every sample, or every sample and cell type) at once.
+
+Families:
+
+    "gaussian"    normal components on the values (intensities)
+    "lognormal"   normal components on log(values); values <= 0 are negative and left
+                  out of the fit
+    "poisson"     Poisson components on counts (e.g. "Num spots estimated")
+    "negbin"      negative binomial components on overdispersed counts (the dispersion
+                  is updated from the weighted moments of each component)
+
+The groups are not fitted one after the other: the values of all groups are laid out as
+one segmented array (sorted by group code) and every EM step is a handful of vectorized
+operations over all cells, with the per-group sums done by np.bincount. Groups drop out of
+the loop once their log-likelihood stops improving, so a few hundred images cost about as
+much as one large one.
+
+The component with the higher mean is the positive one. Every fit gives per-cell posterior
+probabilities of positivity and a per-group threshold: the point between the two means where
+both weighted components are equally likely (for counts, the count where the positive
+component starts to win, minus 0.5, so "count > threshold" is positive). Groups without a
+threshold (too few cells, no spread, a collapsed component) get NaN.
+
+    python mixture_models.py <detections> --column "AF568: Cell: Mean" --family lognormal \
+        --cell-type "Double Positive" "vgat_Pos: oprm1_Pos" --output mixture_fits.csv
+'''
+
+FAMILIES = ("gaussian", "lognormal", "poisson", "negbin")
+
+# Columns of the fit table after the group columns
+FIT_COLUMNS = ["Family", "Cells", "Low Weight", "High Weight", "Low Mean", "High Mean", "Low Spread",
+               "High Spread", "Threshold", "Positive Cells", "Log Likelihood", "Iterations", "Converged"]
+
+# Smallest group that is fitted
+MIN_CELLS = 4
+
+# Dispersion used when a negative binomial component is not overdispersed (~ Poisson)
+MAX_DISPERSION = 1e6
+
+
+def _log_density(family, y, mean, spread):
+    # Log density of every value under each component (mean/spread broadcast per row)
+    if family in ("gaussian", "lognormal"):
+        return -np.log(spread) - 0.5 * ((y - mean) / spread) ** 2 - 0.5 * np.log(2 * np.pi)
+    if family == "poisson":
+        return y * np.log(mean) - mean - gammaln(y + 1)
+    return (gammaln(y + spread) - gammaln(spread) - gammaln(y + 1)
+            + spread * np.log(spread / (spread + mean)) + y * np.log(mean / (spread + mean)))
+
+
+def _transform(family, values):
+    # Values the components are fitted on, and the rows that take part in the fit
+    if family == "lognormal":
+        usable = values > 0
+        return np.log(np.where(usable, values, 1.0)), usable
+    if family in ("poisson", "negbin"):
+        usable = values >= 0
+        return np.where(usable, np.round(values), 0.0), usable
+    return values, np.ones(len(values), dtype=bool)
+
+
+class MixtureFit:
+    """
+    Fitted two-component mixtures of a set of groups (component 0 = low, 1 = high).
+
+    Attributes:
+        family (str): One of FAMILIES.
+        weights, means, spreads (np.ndarray): [group, component] parameters; means and
+            spreads (standard deviations) are on the log scale for "lognormal", spreads
+            are the dispersions for "negbin" and NaN for "poisson". NaN for unfitted groups.
+        thresholds (np.ndarray): Positivity threshold per group (NaN where there is none).
+        cells, iterations (np.ndarray): Cells fitted and EM iterations per group.
+        log_likelihood (np.ndarray): Final log-likelihood per group.
+        converged (np.ndarray): True for the groups whose log-likelihood settled.
+    """
+
+    def __init__(self, family, weights, means, spreads, cells, log_likelihood, iterations, converged):
+        self.family = family
+        self.weights = weights
+        self.means = means
+        self.spreads = spreads
+        self.cells = cells
+        self.log_likelihood = log_likelihood
+        self.iterations = iterations
+        self.converged = converged
+        self.thresholds = self._thresholds()
+
+    def _thresholds(self):
+        if self.family in ("gaussian", "lognormal"):
+            thresholds = _gaussian_crossing(self.weights, self.means, self.spreads)
+            return np.exp(thresholds) if self.family == "lognormal" else thresholds
+        return self._count_crossing()
+
+    def _count_crossing(self):
+        # First count between the two means where the high component wins, on one integer
+        # grid shared by all groups
+        n_groups = len(self.means)
+        thresholds = np.full(n_groups, np.nan)
+        fitted = np.flatnonzero(~np.isnan(self.means[:, 0]))
+        if not len(fitted):
+            return thresholds
+        grid = np.arange(int(np.ceil(self.means[fitted, 1].max())) + 2, dtype=np.float64)
+        log_odds = (np.log(self.weights[fitted, 1:]) - np.log(self.weights[fitted, :1])
+                    + _log_density(self.family, grid, self.means[fitted, 1:], self.spreads[fitted, 1:])
+                    - _log_density(self.family, grid, self.means[fitted, :1], self.spreads[fitted, :1]))
+        between = (grid >= np.floor(self.means[fitted, :1])) & (grid <= np.ceil(self.means[fitted, 1:]))
+        wins = between & (log_odds >= 0)
+        has_crossing = wins.any(axis=1)
+        thresholds[fitted[has_crossing]] = wins[has_crossing].argmax(axis=1) - 0.5
+        return thresholds
+
+    def posterior(self, values, codes):
+        """
+        Returns the posterior probability of the high (positive) component for every value
+        (NaN for NaN values and unfitted or negative-coded groups; 0 for values outside the
+        family's support).
+        """
+        values = np.asarray(values, dtype=np.float64)
+        codes = np.asarray(codes, dtype=np.intp)
+        result = np.full(len(values), np.nan)
+        rows = (codes >= 0) & ~np.isnan(values)
+        rows[rows] = ~np.isnan(self.means[codes[rows], 0])
+        y, usable = _transform(self.family, values[rows])
+        group = codes[rows]
+        log_odds = (np.log(self.weights[group, 1]) - np.log(self.weights[group, 0])
+                    + _log_density(self.family, y, self.means[group, 1], self.spreads[group, 1])
+                    - _log_density(self.family, y, self.means[group, 0], self.spreads[group, 0]))
+        with np.errstate(over="ignore"):
+            result[rows] = np.where(usable, 1 / (1 + np.exp(-log_odds)), 0.0)
+        return result
+
+    def table(self, groups, positive_cells=None):
+        """
+        Returns the fit table: one row per group (group columns + FIT_COLUMNS).
+
+        Parameters:
+            groups (list or pd.DataFrame): Group labels, or a frame of group columns.
+            positive_cells (array-like): Cells called positive per group (default: NaN).
+        """
+        table = groups.reset_index(drop=True) if isinstance(groups, pd.DataFrame) else pd.DataFrame({"Group": list(groups)})
+        table = table.assign(**{
+            "Family": self.family, "Cells": self.cells,
+            "Low Weight": self.weights[:, 0], "High Weight": self.weights[:, 1],
+            "Low Mean": self.means[:, 0], "High Mean": self.means[:, 1],
+            "Low Spread": self.spreads[:, 0], "High Spread": self.spreads[:, 1],
+            "Threshold": self.thresholds,
+            "Positive Cells": np.nan if positive_cells is None else positive_cells,
+            "Log Likelihood": self.log_likelihood, "Iterations": self.iterations, "Converged": self.converged,
+        })
+        return table
+
+
+def _gaussian_crossing(weights, means, sds):
+    # w1 N(x; m1, s1) = w2 N(x; m2, s2) is a quadratic in x; the root between the means
+    (w1, w2), (m1, m2), (s1, s2) = weights.T, means.T, sds.T
+    with np.errstate(invalid="ignore", divide="ignore"):
+        a = 1 / (2 * s2 ** 2) - 1 / (2 * s1 ** 2)
+        b = m1 / s1 ** 2 - m2 / s2 ** 2
+        c = m2 ** 2 / (2 * s2 ** 2) - m1 ** 2 / (2 * s1 ** 2) + np.log(w1 * s2 / (w2 * s1))
+        quadratic = np.abs(a) > 1e-12
+        root = np.sqrt(b ** 2 - 4 * a * c)
+        candidates = np.stack([(-b + root) / (2 * a), (-b - root) / (2 * a)], axis=1)
+        candidates[~quadratic] = (-c / b)[~quadratic, None]
+    inside = (candidates >= np.minimum(m1, m2)[:, None]) & (candidates <= np.maximum(m1, m2)[:, None])
+    first = inside.argmax(axis=1)
+    return np.where(inside.any(axis=1), candidates[np.arange(len(candidates)), first], np.nan)
+
+
+def _group_percentiles(sorted_y, bounds, q):
+    # Percentile q of every group of values sorted by group, then value (linear interpolation,
+    # as np.percentile; NaN for empty groups)
+    counts = np.diff(bounds)
+    result = np.full(len(counts), np.nan)
+    filled = counts > 0
+    position = bounds[:-1][filled] + q / 100 * (counts[filled] - 1)
+    lower = np.floor(position).astype(np.intp)
+    upper = np.minimum(lower + 1, bounds[1:][filled] - 1)
+    result[filled] = sorted_y[lower] + (sorted_y[upper] - sorted_y[lower]) * (position - lower)
+    return result
+
+
+def fit_mixtures(values, codes, n_groups, family="gaussian", iterations=200, tolerance=1e-8, min_cells=MIN_CELLS):
+    """
+    Fits a two-component mixture to the values of every group, all groups in one EM loop.
+
+    Parameters:
+        values (array-like): Per-cell values (NaNs are left out).
+        codes (array-like): Group code of every cell (negative = no group).
+        n_groups (int): Number of groups.
+        family (str): One of FAMILIES.
+        iterations (int): Maximum EM iterations.
+        tolerance (float): A group stops when its log-likelihood gains less than
+            tolerance per cell in an iteration.
+        min_cells (int): Groups with fewer usable cells are not fitted.
+
+    Returns:
+        MixtureFit: Parameters, thresholds and convergence of every group.
+    """
+    if family not in FAMILIES:
+        raise ValueError(f"Unknown mixture family {family!r} (available: {FAMILIES})")
+    values = np.asarray(values, dtype=np.float64)
+    codes = np.asarray(codes, dtype=np.intp)
+    rows = (codes >= 0) & ~np.isnan(values)
+    y, usable = _transform(family, values[rows])
+    y, codes = y[usable], codes[rows][usable]
+
+    # Segmented layout: the cells of every group are contiguous (sorted by value within it)
+    order = np.lexsort((y, codes))
+    y = y[order]
+    cells = np.bincount(codes, minlength=n_groups)
+    bounds = np.concatenate([[0], np.cumsum(cells)])
+    group_codes = np.repeat(np.arange(n_groups), cells)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.bincount(group_codes, weights=y, minlength=n_groups) / cells
+        sd = np.sqrt(np.bincount(group_codes, weights=(y - mean[group_codes]) ** 2, minlength=n_groups) / cells)
+
+    # Start: components at the quartiles, half the overall spread, equal weights
+    weights = np.full((n_groups, 2), 0.5)
+    means = np.stack([_group_percentiles(y, bounds, 25), _group_percentiles(y, bounds, 75)], axis=1)
+    if family in ("gaussian", "lognormal"):
+        spreads = np.repeat(sd[:, None] / 2, 2, axis=1)
+    else:
+        means = np.maximum(means, 0.5)
+        means[:, 0] = np.minimum(means[:, 0], mean)
+        means[:, 1] = np.maximum(means[:, 1], np.maximum(mean, means[:, 0] + 1))
+        spreads = np.full((n_groups, 2), np.nan if family == "poisson" else MAX_DISPERSION)
+
+    log_likelihood = np.full(n_groups, -np.inf)
+    n_iterations = np.zeros(n_groups, dtype=np.int64)
+    converged = np.zeros(n_groups, dtype=bool)
+    failed = (cells < max(min_cells, 1)) | ~(sd > 0)
+    active = ~failed
+    y = y[np.repeat(active, cells)]
+
+    for _ in range(iterations):
+        groups = np.flatnonzero(active)
+        if not len(groups):
+            break
+        counts = cells[groups]
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+        def per_cell(parameter):
+            return np.repeat(parameter[groups], counts)
+
+        def per_group(cell_values):
+            return np.add.reduceat(cell_values, starts)
+
+        # E step over the cells of all active groups (contiguous parameters instead of a gather)
+        low = np.log(per_cell(weights[:, 0])) + _log_density(family, y, per_cell(means[:, 0]), per_cell(spreads[:, 0]))
+        high = np.log(per_cell(weights[:, 1])) + _log_density(family, y, per_cell(means[:, 1]), per_cell(spreads[:, 1]))
+        cell_likelihood = np.logaddexp(low, high)
+        shares = (np.exp(low - cell_likelihood), np.exp(high - cell_likelihood))
+        new_likelihood = per_group(cell_likelihood)
+
+        # M step: weighted sums per group and component
+        totals = np.stack([per_group(share) for share in shares], axis=1)
+        collapsed = (totals < 1e-9).any(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            new_means = np.stack([per_group(share * y) for share in shares], axis=1) / totals
+            variances = np.stack([per_group(share * (y - np.repeat(new_means[:, k], counts)) ** 2)
+                                  for k, share in enumerate(shares)], axis=1) / totals
+        ok = ~collapsed
+        update = groups[ok]
+        n_iterations[update] += 1
+        weights[update] = totals[ok] / counts[ok, None]
+        means[update] = new_means[ok]
+        if family in ("gaussian", "lognormal"):
+            spreads[update] = np.sqrt(variances[ok]) + 1e-12
+        else:
+            means[update] = np.maximum(means[update], 1e-9)
+            if family == "negbin":
+                excess = variances[ok] - means[update]
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    spreads[update] = np.where(excess > 0, means[update] ** 2 / excess, MAX_DISPERSION).clip(1e-3, MAX_DISPERSION)
+
+        settled = ok & (new_likelihood - log_likelihood[groups] < tolerance * counts)
+        log_likelihood[update] = new_likelihood[ok]
+        converged[groups[settled]] = True
+        failed[groups[collapsed]] = True
+        finished = settled | collapsed
+        if finished.any():
+            active[groups[finished]] = False
+            y = y[np.repeat(~finished, counts)]
+
+    # Component 0 is the low one
+    swap = means[:, 0] > means[:, 1]
+    for parameter in (weights, means, spreads):
+        parameter[swap] = parameter[swap][:, ::-1]
+    for parameter in (weights, means, spreads):
+        parameter[failed] = np.nan
+    log_likelihood[failed] = np.nan
+    return MixtureFit(family, weights, means, spreads, cells, log_likelihood, n_iterations, converged)
+
+
+def fit_frame(frame, column, by=None, family="gaussian", **options):
+    """
+    Fits a mixture to a column of a cell table within the groups of the by column(s).
+
+    Returns:
+        tuple: (posterior probability of positivity per row, aligned with frame; fit table
+        with one row per group).
+    """
+    if by is None:
+        codes, keys = np.zeros(len(frame), dtype=np.intp), pd.DataFrame({"Group": ["All"]})
+    else:
+        grouped = frame.groupby(by, sort=True, observed=True)
+        codes, keys = grouped.ngroup().to_numpy(), grouped.size().index.to_frame(index=False)
+    values = pd.to_numeric(frame[column], errors="coerce").to_numpy(dtype=np.float64)
+    fit = fit_mixtures(values, codes, len(keys), family, **options)
+    posterior = fit.posterior(values, codes)
+    positive = np.bincount(codes[posterior >= 0.5], minlength=len(keys))
+    return pd.Series(posterior, index=frame.index, name="Positive Probability"), fit.table(keys, positive)
+
+
+def _read_values(detections, column, cell_types, class_column, file):
+    # Per-cell values of every cell type of one export
+    index = ClassIndex(read_export(os.path.join(detections, file)), class_column)
+    return {cell_type: pd.to_numeric(index.select(labels)[column], errors="coerce").to_numpy(dtype=np.float64)
+            for cell_type, labels in cell_types.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit positivity mixture models per sample and cell type.")
+    parser.add_argument("detections", help="Directory of detection exports")
+    parser.add_argument("--column", required=True, help="Measurement to fit, e.g. 'AF568: Cell: Mean'")
+    parser.add_argument("--family", choices=FAMILIES, default="gaussian", help="Component distribution")
+    parser.add_argument("--cell-type", nargs="+", action="append", required=True, metavar=("NAME", "LABEL"),
+                        help="Cell type name followed by its class labels (repeatable)")
+    parser.add_argument("--class-column", default="Classification", help="Column of the class labels")
+    parser.add_argument("--pooled", action="store_true", help="One fit per cell type over all samples")
+    parser.add_argument("--output", default="mixture_fits.csv", help="Fit table (CSV)")
+    parser.add_argument("--posteriors", help="Also write the per-cell posterior probabilities (CSV)")
+    parser.add_argument("--workers", type=int, default=N_WORKERS, help="Worker processes (1 = serial)")
+    args = parser.parse_args()
+
+    cell_types = {cell_type[0]: cell_type[1:] for cell_type in args.cell_type}
+    files = list_exports(args.detections)
+    results = run_per_file(partial(_read_values, args.detections, args.column, cell_types, args.class_column),
+                           files, n_workers=args.workers)
+    cells = cell_frame([(file.replace(" Detections", ""), result) for file, result in zip(files, results) if result])
+    by = ["Cell Type"] if args.pooled else ["Sample", "Cell Type"]
+    posterior, table = fit_frame(cells, "Value", by, args.family)
+    table.to_csv(args.output, index=False)
+    print(table[by + ["Cells", "Threshold", "Positive Cells", "Converged"]].to_string(index=False))
+    print(f"Fits of {len(table)} groups saved to {args.output}")
+    if args.posteriors:
+        cells.assign(**{"Positive Probability": posterior}).to_csv(args.posteriors, index=False)
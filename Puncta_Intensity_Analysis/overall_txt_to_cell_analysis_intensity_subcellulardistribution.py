@@ -4,6 +4,13 @@ import matplotlib.pyplot as plt
 import numpy as np
 import seaborn as sns
 
+from aggregate_cube import INTENSITY_HISTOGRAM, AggregateCube
+from cell_store import CellStore
+from distribution_engine import DistributionSummary
+from incremental import path_fingerprint
+import instrumentation
+from qupath_io import collect_values, list_exports
+
 # Specify directories
 input_directory = "/Volumes/backup driv/VP_qp_LF - ITERATION4/detections_iteration4_withMu_12.23.24"
 overall_plots_directory = "/Volumes/backup driv/VP_qp_LF - ITERATION4/SCALEDoutputintensity_overall_plots"
@@ -31,108 +38,98 @@ colors = {
 
 metric_column = "AF568: Cell: Mean"
 
-# Initialize a list to store overall data for all classifications
-overall_distribution_data = []
-
-# Read all files and combine data
-for file in os.listdir(input_directory):
-    if file.endswith(".csv") or file.endswith(".txt"):
+# Stage timings, memory and rows read are reported when PUNCTA_PROFILE is set (see instrumentation.py)
+instrumentation.phase("load values")
+
+# Per-cell values of every file go into a compact on-disk store (float32 values, small
+# integer class and sample codes); if no export changed since the last run the store is
+# memory-mapped instead of re-reading the exports
+exports = list_exports(input_directory, extensions=(".csv", ".txt"))
+fingerprints = {file: path_fingerprint(os.path.join(input_directory, file)) for file in exports}
+store = CellStore(os.path.join(overall_data_directory, "cell_store"), classifications, metric_column)
+
+if store.is_current(fingerprints):
+    print(f"Using stored values of {len(exports)} files from {store.store_dir}")
+else:
+    store.reset()
+    # Read all files and combine data
+    for file in exports:
         try:
-            # Load file and normalize headers
+            # Stream only the two needed columns in bounded-size chunks
             file_path = os.path.join(input_directory, file)
-
-            if file.endswith(".csv"):
-                df = pd.read_csv(file_path, encoding="utf-8")
-            elif file.endswith(".txt"):
-                df = pd.read_csv(file_path, delimiter="\t", encoding="utf-8")
-
-            df.columns = df.columns.str.strip()
-
-            if "Classification" not in df.columns or metric_column not in df.columns:
-                print(f"Skipping file {file}: Missing required columns.")
-                continue
-
-            df["Classification"] = df["Classification"].str.strip()
-
-            # Append relevant data to the overall dataset
-            for cls in classifications:
-                Classification_data = df[df["Classification"] == cls][metric_column].dropna()
-                overall_distribution_data.extend([(cls, spots) for spots in Classification_data])
-
+            with instrumentation.stage("collect values", file=file):
+                values_by_class = collect_values(file_path, "Classification", metric_column, classifications)
+            store.append(file, values_by_class, fingerprints[file])
+
+        except KeyError:
+            print(f"Skipping file {file}: Missing required columns.")
+            # Stored without cells so an unchanged file is not re-read next time
+            store.append(file, {}, fingerprints[file])
         except Exception as e:
             print(f"Error processing file {file}: {e}")
-
-# Convert overall data to DataFrame
-overall_df = pd.DataFrame(overall_distribution_data, columns=["Cell Type", "AF568: Cell: Mean"])
-
-# Calculate global min and max for x-axis
-x_min = overall_df["AF568: Cell: Mean"].min()
-x_max = overall_df["AF568: Cell: Mean"].max()
-
-# Calculate global max for y-axis
-y_max = 0
-for cls in classifications:
-    cls_data = overall_df[overall_df["Cell Type"] == cls]["AF568: Cell: Mean"]
-    if not cls_data.empty:
-        y_max = max(y_max, np.histogram(cls_data, bins=20, range=(x_min, x_max))[0].max())
+            # Also stored without cells, else the store would be rebuilt on every run
+            store.append(file, {}, fingerprints[file])
+    store.save()
+
+# Mergeable per-(sample, class) partials (count, sums, min/max, histogram, quantile sketch),
+# so the same statistics can be rolled up by date, slide or any metadata column with
+# aggregate_cube.py instead of re-reading the exports
+instrumentation.phase("aggregate cube")
+cube = AggregateCube(classifications, [metric_column], histograms={metric_column: INTENSITY_HISTOGRAM})
+cube.add_cells(metric_column, store.values(), store.class_codes(), classifications,
+               store.sample_ids(), store.sample_names())
+cube.save(os.path.join(overall_data_directory, "aggregate_cube.npz"))
+cube.sketches.save(os.path.join(overall_data_directory, "quantile_sketches.json"))
+
+# Sort every cell type's values once; histograms (on shared bins over the global range), CDFs,
+# statistics and box plot stats for all plots below come from this one summary
+instrumentation.phase("statistics")
+summary = DistributionSummary(store.values(), store.class_codes(), classifications, bins=20)
+
+# Global min and max for x-axis, global max for y-axis
+x_min, x_max = summary.x_min, summary.x_max
+y_max = summary.y_max
 
 # Calculate overall descriptive statistics
-overall_statistics_data = []
-for cls in classifications:
-    cls_data = overall_df[overall_df["Cell Type"] == cls]["AF568: Cell: Mean"]
-    if not cls_data.empty:
-        overall_statistics = {
-            "Cell Type": cls,
-            "Min": cls_data.min(),
-            "Max": cls_data.max(),
-            "Mean": cls_data.mean(),
-            "25th Percentile": np.percentile(cls_data, 25),
-            "Median": cls_data.median(),
-            "75th Percentile": np.percentile(cls_data, 75),
-            "Standard Deviation": cls_data.std(),
-            "Variance": cls_data.var()
-        }
-        overall_statistics_data.append(overall_statistics)
-
-        # Generate and save histogram for this cell type
-        plt.figure()
-        cls_data.hist(bins=20, edgecolor="black", alpha=0.7, color=colors[cls], range=(x_min, x_max))
-        plt.title(f"Distribution of OPRM1 Intensity For Cell Type\n{cls}", fontsize=10)
-        plt.xlabel("OPRM1 Intensity")
-        plt.ylabel("Frequency")
-        plt.xlim(x_min, x_max)  # Set consistent x-axis
-        plt.ylim(0, y_max)  # Set consistent y-axis
-        plt.tight_layout()
-
-        histogram_path = os.path.join(overall_plots_directory, f"Overall_{cls.replace(': ', '_').replace(' ', '_')}_Histogram.png")
-        plt.savefig(histogram_path)
-        plt.close()
-
-        # Generate and save CDF plot for this cell type
-        sorted_data = np.sort(cls_data)
-        cdf = np.arange(1, len(sorted_data) + 1) / len(sorted_data)
-
-        plt.figure()
-        plt.plot(sorted_data, cdf, marker="o", linestyle="--", color=colors[cls])
-        plt.title(f"CDF of OPRM1 Intensity For Cell Type\n{cls}", fontsize=10)
-        plt.xlabel("OPRM1 Intensity")
-        plt.ylabel("CDF")
-        plt.xlim(x_min, x_max)  # Set consistent x-axis
-        plt.tight_layout()
-
-        cdf_path = os.path.join(overall_plots_directory, f"Overall_{cls.replace(': ', '_').replace(' ', '_')}CDF.png")
-        plt.savefig(cdf_path)
-        plt.close()
+overall_statistics_df = summary.statistics_table()
+
+instrumentation.phase("plots")
+for cls in summary.non_empty():
+    # Generate and save histogram for this cell type (bars drawn from the precomputed counts)
+    plt.figure()
+    plt.hist(summary.edges[:-1], bins=summary.edges, weights=summary.counts[cls], edgecolor="black", alpha=0.7, color=colors[cls])
+    plt.title(f"Distribution of OPRM1 Intensity For Cell Type\n{cls}", fontsize=10)
+    plt.xlabel("OPRM1 Intensity")
+    plt.ylabel("Frequency")
+    plt.xlim(x_min, x_max)  # Set consistent x-axis
+    plt.ylim(0, y_max)  # Set consistent y-axis
+    plt.tight_layout()
+
+    histogram_path = os.path.join(overall_plots_directory, f"Overall_{cls.replace(': ', '_').replace(' ', '_')}_Histogram.png")
+    plt.savefig(histogram_path)
+    plt.close()
+
+    # Generate and save CDF plot for this cell type
+    sorted_data, cdf = summary.ecdf(cls)
+
+    plt.figure()
+    plt.plot(sorted_data, cdf, marker="o", linestyle="--", color=colors[cls])
+    plt.title(f"CDF of OPRM1 Intensity For Cell Type\n{cls}", fontsize=10)
+    plt.xlabel("OPRM1 Intensity")
+    plt.ylabel("CDF")
+    plt.xlim(x_min, x_max)  # Set consistent x-axis
+    plt.tight_layout()
+
+    cdf_path = os.path.join(overall_plots_directory, f"Overall_{cls.replace(': ', '_').replace(' ', '_')}CDF.png")
+    plt.savefig(cdf_path)
+    plt.close()
 
 # Generate and save combined CDF plot for all classifications
 plt.figure(figsize=(10, 6))
 
-for cls in classifications:
-    cls_data = overall_df[overall_df["Cell Type"] == cls]["AF568: Cell: Mean"]
-    if not cls_data.empty:
-        sorted_data = np.sort(cls_data)
-        cdf = np.arange(1, len(sorted_data) + 1) / len(sorted_data)
-        plt.plot(sorted_data, cdf, label=cls, color=colors[cls])  # Add label for legend
+for cls in summary.non_empty():
+    sorted_data, cdf = summary.ecdf(cls)
+    plt.plot(sorted_data, cdf, label=cls, color=colors[cls])  # Add label for legend
 
 plt.title("Overlayed CDF of OPRM1 Intensity Per Cell Type", fontsize=14)
 plt.xlabel("OPRM1 Intensity")
@@ -151,29 +148,21 @@ print(f"Overlayed CDF plot saved to {combined_cdf_path}.")
 
 #overlay histogram
 # Generate and save an overlay histogram for all classifications
-# Generate and save an overlay histogram for all classifications
 plt.figure(figsize=(10, 6))
 
-# Calculate the maximum frequency for consistent y-axis
-max_frequency = 0
-for cls in classifications:
-    cls_data = overall_df[overall_df["Cell Type"] == cls]["AF568: Cell: Mean"]
-    if not cls_data.empty:
-        frequencies, _ = np.histogram(cls_data, bins=20, range=(x_min, x_max))
-        max_frequency = max(max_frequency, frequencies.max())
-
-for cls in classifications:
-    cls_data = overall_df[overall_df["Cell Type"] == cls]["AF568: Cell: Mean"]
-    if not cls_data.empty:
-        plt.hist(
-            cls_data,
-            bins=20,
-            alpha=0.5,  # Transparency for overlay effect
-            label=cls,
-            color=colors[cls],
-            range=(x_min, x_max),
-            density=False  # Use absolute frequencies
-        )
+# Maximum frequency for consistent y-axis
+max_frequency = y_max
+
+for cls in summary.non_empty():
+    plt.hist(
+        summary.edges[:-1],
+        bins=summary.edges,
+        weights=summary.counts[cls],
+        alpha=0.5,  # Transparency for overlay effect
+        label=cls,
+        color=colors[cls],
+        density=False  # Use absolute frequencies
+    )
 
 # plt.title("Overlayed Histogram of OPRM1 Intensity Per Cell Type", fontsize=14)
 # plt.xlabel("OPRM1 Intensity")
@@ -188,17 +177,19 @@ for cls in classifications:
 # plt.close()
 
 # print(f"Overlay histogram with absolute frequency saved to {overlay_histogram_path}.")
+plt.close()
 
 # Generate and save a box plot for distributions across classifications
 plt.figure(figsize=(10, 6))
 
-# Use seaborn's boxplot for distribution representation
-sns.boxplot(
-    data=overall_df,
-    x="Cell Type",
-    y="AF568: Cell: Mean",
-    palette=colors
+# Box plot drawn from the precomputed quartiles, whiskers and outliers
+boxes = plt.gca().bxp(
+    [summary.boxplot_stats(cls) for cls in summary.non_empty()],
+    patch_artist=True,
+    flierprops={"marker": "d", "markersize": 4}
 )
+for patch, cls in zip(boxes["boxes"], summary.non_empty()):
+    patch.set_facecolor(colors[cls])
 
 plt.title("Distribution of OPRM1 Intensity Per Cell Type", fontsize=14)
 plt.xlabel("Cell Type")
@@ -226,16 +217,14 @@ density_data = []
 bins = 50  # More bins for finer granularity
 bin_edges = np.linspace(x_min, x_max, bins + 1)
 
-for cls in classifications:
-    cls_data = overall_df[overall_df["Cell Type"] == cls]["AF568: Cell: Mean"]
-    if not cls_data.empty:
-        # Calculate histogram for frequencies
-        frequencies, edges = np.histogram(cls_data, bins=bin_edges)
-        bin_centers = (edges[:-1] + edges[1:]) / 2  # Bin centers
+bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2  # Bin centers
+for cls in summary.non_empty():
+    # Histogram for frequencies, read off the sorted values
+    frequencies = summary.histogram(cls, bin_edges)
 
-        # Append data for visualization
-        for center, freq in zip(bin_centers, frequencies):
-            density_data.append({"Cell Type": cls, "Intensity": center, "Frequency": freq})
+    # Append data for visualization
+    for center, freq in zip(bin_centers, frequencies):
+        density_data.append({"Cell Type": cls, "Intensity": center, "Frequency": freq})
 
 # Convert density data into a DataFrame
 density_df = pd.DataFrame(density_data)
@@ -267,5 +256,4 @@ plt.close()
 
 print(f"Density scatter plot saved to {heatmap_scatter_path}.")
 
-
-
+instrumentation.report()
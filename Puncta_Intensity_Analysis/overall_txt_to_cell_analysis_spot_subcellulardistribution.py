@@ -1,8 +1,14 @@
 import os
-import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
 
+from aggregate_cube import AggregateCube
+from cell_store import CellStore
+from distribution_engine import DistributionSummary
+from incremental import path_fingerprint
+import instrumentation
+from qupath_io import collect_values, list_exports
+
 # Specify directories
 input_directory = "/Volumes/backup driv/VP_qp_LF - ITERATION4 - OPRM1TRAINING_WITHCOMPOSITES/detections_withMu_12.6.24_csv"
 overall_plots_directory = "/Volumes/backup driv/VP_qp_LF - ITERATION4 - OPRM1TRAINING_WITHCOMPOSITES/output_overall_plots"
@@ -19,82 +25,89 @@ classifications = [
 ]
 metric_column = "Num spots"
 
-# Initialize a list to store overall data for all classifications
-overall_distribution_data = []
-
-# Read all CSV files and combine data
-for file in os.listdir(input_directory):
-    if file.endswith(".csv"):
+# Stage timings, memory and rows read are reported when PUNCTA_PROFILE is set (see instrumentation.py)
+instrumentation.phase("load values")
+
+# Per-cell values of every file go into a compact on-disk store (float32 values, small
+# integer class and sample codes); if no export changed since the last run the store is
+# memory-mapped instead of re-reading the exports
+exports = list_exports(input_directory, extensions=(".csv",))
+fingerprints = {file: path_fingerprint(os.path.join(input_directory, file)) for file in exports}
+store = CellStore(os.path.join(overall_data_directory, "cell_store"), classifications, metric_column)
+
+if store.is_current(fingerprints):
+    print(f"Using stored values of {len(exports)} files from {store.store_dir}")
+else:
+    store.reset()
+    # Read all CSV files and combine data
+    for file in exports:
         try:
-            # Load file and normalize headers
+            # Stream only the two needed columns in bounded-size chunks
             file_path = os.path.join(input_directory, file)
-            df = pd.read_csv(file_path, encoding="utf-8")
-            df.columns = df.columns.str.strip()  # Normalize column names
-
-            if "Parent" not in df.columns or metric_column not in df.columns:
-                print(f"Skipping file {file}: Missing required columns.")
-                continue
-
-            df["Parent"] = df["Parent"].str.strip()  # Normalize Parent values
-
-            # Append relevant data to the overall dataset
-            for cls in classifications:
-                parent_data = df[df["Parent"] == cls][metric_column].dropna()
-                overall_distribution_data.extend([(cls, spots) for spots in parent_data])
-
+            with instrumentation.stage("collect values", file=file):
+                values_by_parent = collect_values(file_path, "Parent", metric_column, classifications)
+            store.append(file, values_by_parent, fingerprints[file])
+
+        except KeyError:
+            print(f"Skipping file {file}: Missing required columns.")
+            # Stored without cells so an unchanged file is not re-read next time
+            store.append(file, {}, fingerprints[file])
         except Exception as e:
             print(f"Error processing file {file}: {e}")
-
-# Convert overall data to DataFrame
-overall_df = pd.DataFrame(overall_distribution_data, columns=["Cell Type", "Num Spots"])
+            # Also stored without cells, else the store would be rebuilt on every run
+            store.append(file, {}, fingerprints[file])
+    store.save()
+
+# Mergeable per-(sample, class) partials (count, sums, min/max, histogram, quantile sketch),
+# so the same statistics can be rolled up by date, slide or any metadata column with
+# aggregate_cube.py instead of re-reading the exports
+instrumentation.phase("aggregate cube")
+cube = AggregateCube(classifications, [metric_column], histograms={metric_column: (0, 64, 64)})
+cube.add_cells(metric_column, store.values(), store.class_codes(), classifications,
+               store.sample_ids(), store.sample_names())
+cube.save(os.path.join(overall_data_directory, "aggregate_cube.npz"))
+cube.sketches.save(os.path.join(overall_data_directory, "quantile_sketches.json"))
+
+# Sort every cell type's values once; statistics, histograms and CDFs all come from this summary
+instrumentation.phase("statistics and plots")
+summary = DistributionSummary(store.values(), store.class_codes(), classifications, bins=20)
 
 # Calculate overall descriptive statistics
-overall_statistics_data = []
-for cls in classifications:
-    cls_data = overall_df[overall_df["Cell Type"] == cls]["Num Spots"]
-    if not cls_data.empty:
-        overall_statistics = {
-            "Cell Type": cls,
-            "Min": cls_data.min(),
-            "Max": cls_data.max(),
-            "Mean": cls_data.mean(),
-            "25th Percentile": np.percentile(cls_data, 25),
-            "Median": cls_data.median(),
-            "75th Percentile": np.percentile(cls_data, 75),
-            "Standard Deviation": cls_data.std(),
-            "Variance": cls_data.var()
-        }
-        overall_statistics_data.append(overall_statistics)
-
-        # Generate and save histogram for this cell type
-        plt.figure()
-        cls_data.hist(bins=20, edgecolor="black", alpha=0.7)
-        plt.title(f"Overall Distribution of Spots Per Cell\n{cls}", fontsize=10)
-        plt.xlabel("Number of Spots Per Cell")
-        plt.ylabel("Frequency")
-        plt.tight_layout()
-
-        histogram_path = os.path.join(overall_plots_directory, f"Overall_{cls.replace(': ', '_').replace(' ', '_')}_Histogram.png")
-        plt.savefig(histogram_path)
-        plt.close()
-
-        # Generate and save CDF plot for this cell type
-        sorted_data = np.sort(cls_data)
-        cdf = np.arange(1, len(sorted_data) + 1) / len(sorted_data)
-
-        plt.figure()
-        plt.plot(sorted_data, cdf, marker="o", linestyle="--", color="blue")
-        plt.title(f"CDF of Spots Per Cell\n{cls}", fontsize=10)
-        plt.xlabel("Number of Spots Per Cell")
-        plt.ylabel("CDF")
-        plt.tight_layout()
-
-        cdf_path = os.path.join(overall_plots_directory, f"Overall_{cls.replace(': ', '_').replace(' ', '_')}_CDF.png")
-        plt.savefig(cdf_path)
-        plt.close()
+overall_statistics_df = summary.statistics_table()
+for cls in summary.non_empty():
+    # Generate and save histogram for this cell type (20 bins over this cell type's own range)
+    sorted_data, cdf = summary.ecdf(cls)
+    low, high = sorted_data[0], sorted_data[-1]
+    if low == high:
+        low, high = low - 0.5, high + 0.5  # Same range np.histogram uses for constant data
+    edges = np.linspace(low, high, 21)
+    plt.figure()
+    plt.hist(edges[:-1], bins=edges, weights=summary.histogram(cls, edges), edgecolor="black", alpha=0.7)
+    plt.grid(True)
+    plt.title(f"Overall Distribution of Spots Per Cell\n{cls}", fontsize=10)
+    plt.xlabel("Number of Spots Per Cell")
+    plt.ylabel("Frequency")
+    plt.tight_layout()
+
+    histogram_path = os.path.join(overall_plots_directory, f"Overall_{cls.replace(': ', '_').replace(' ', '_')}_Histogram.png")
+    plt.savefig(histogram_path)
+    plt.close()
+
+    # Generate and save CDF plot for this cell type
+    plt.figure()
+    plt.plot(sorted_data, cdf, marker="o", linestyle="--", color="blue")
+    plt.title(f"CDF of Spots Per Cell\n{cls}", fontsize=10)
+    plt.xlabel("Number of Spots Per Cell")
+    plt.ylabel("CDF")
+    plt.tight_layout()
+
+    cdf_path = os.path.join(overall_plots_directory, f"Overall_{cls.replace(': ', '_').replace(' ', '_')}_CDF.png")
+    plt.savefig(cdf_path)
+    plt.close()
 
 # Save overall descriptive statistics to CSV
-overall_statistics_df = pd.DataFrame(overall_statistics_data)
 overall_statistics_output_path = os.path.join(overall_data_directory, "overall_descriptive_statistics.csv")
 overall_statistics_df.to_csv(overall_statistics_output_path, index=False)
 print(f"Overall descriptive statistics saved to {overall_statistics_output_path}.")
+
+instrumentation.report()
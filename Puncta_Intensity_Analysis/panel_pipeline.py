@@ -0,0 +1,453 @@
+import argparse
+import json
+import os
+from functools import partial
+import numpy as np
+import pandas as pd
+
+from aggregate_cube import SAMPLE_NAME_PATTERN, AggregateCube, sample_metadata
+from density_maps import DEFAULT_PIXEL_UM, DEFAULT_SIGMA_UM, cell_positions, write_density_maps
+import instrumentation
+from parallel_processing import N_WORKERS, run_per_file
+from plot_renderer import PlotQueue
+from quantile_sketch import SketchStore
+from qupath_io import ClassIndex, list_exports, read_export
+from reclassification import reclassify
+from spatial_neighbors import export_composition, pooled_composition
+from summary_engine import annotation_area, detection_columns, summarize_samples
+from threshold_sweep import candidate_thresholds, write_sweep
+
+'''
+Single-read pipeline for one marker panel (e.g. VGAT/OPRM1 or VGLUT2/OPRM1).
+
+A panel config (JSON, see the panels folder) lists the marker names and their channels,
+the class labels, the input/output paths and the analyses to run. Every detection export
+is read exactly once; the loaded table is handed to each requested analysis stage, which
+keeps only what it needs (a summary sample, per-class values, ...). After all files are
+done each stage writes its outputs from the collected records.
+
+Usage:
+    python panel_pipeline.py panels/vgat_oprm1.json [--workers N] [--profile [trace.json]]
+
+An optional "reclassify" entry (marker -> positivity rule, see reclassification.py; the rule's
+"column" defaults to the marker's Cell: Mean channel) recomputes the cell classifications
+from the exported measurements right after each export is read, so every stage sees the new
+classes without a QuPath round trip.
+
+With --profile (or PUNCTA_PROFILE set) the reading and every stage's collect and finish
+are timed per export and summarized at the end (see instrumentation.py).
+
+Stages register themselves in STAGES with the register_stage decorator. A stage has:
+    collect(panel, filename, det_data, ano_data) -> record for one export (None to skip)
+    finish(panel, records)                       -> writes the stage outputs
+and sets needs_annotation if it needs the matching annotation export.
+'''
+
+STAGES = {}
+
+
+def register_stage(name):
+    """
+    Class decorator adding an analysis stage to STAGES under the given name.
+    """
+    def register(stage_class):
+        STAGES[name] = stage_class
+        return stage_class
+    return register
+
+
+def channel_column(panel, marker, measurement="Cell: Mean"):
+    """
+    Returns the measurement column of a marker, e.g. "AF568: Cell: Mean" for oprm1.
+    """
+    return f"{panel['markers'][marker]}: {measurement}"
+
+
+def load_panel(config_path):
+    """
+    Loads a panel config and resolves marker references to channel columns.
+
+    Parameters:
+        config_path (str): Path to the panel JSON file.
+
+    Returns:
+        dict: The panel, with cell_groups[...]["intensity"], the plot "column" entries and the
+        reclassify rule columns filled in from the marker names.
+    """
+    with open(config_path, encoding="utf-8") as file:
+        panel = json.load(file)
+
+    for group in panel.get("cell_groups", {}).values():
+        if group.get("marker"):
+            group["intensity"] = channel_column(panel, group["marker"])
+    for stage in panel.get("stages", {}).values():
+        if stage.get("marker") and not stage.get("column"):
+            stage["column"] = channel_column(panel, stage["marker"])
+    for marker, rule in panel.get("reclassify", {}).items():
+        if not {"column", "all", "any", "not"} & set(rule):
+            rule["column"] = channel_column(panel, marker)
+
+    unknown = [name for name in panel["analyses"] if name not in STAGES]
+    if unknown:
+        raise KeyError(f"Unknown analyses in {config_path}: {unknown} (available: {sorted(STAGES)})")
+    return panel
+
+
+def stage_settings(panel, name):
+    return panel.get("stages", {}).get(name, {})
+
+
+def output_dir(panel, name):
+    directory = os.path.join(panel["paths"]["output"], stage_settings(panel, name).get("output_dirname", name))
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def process_export(panel, file):
+    """
+    Reads one detection export (and its annotation export when a stage needs it) once and
+    runs every requested stage on it.
+
+    Returns:
+        dict: Stage name -> record, or None when no stage produced anything.
+    """
+    stages = {name: STAGES[name]() for name in panel["analyses"]}
+    filename = file.replace(" Detections", "")
+    with instrumentation.stage("read", file=file):
+        det_data = read_export(os.path.join(panel["paths"]["raw_detection"], file))
+
+        ano_data = None
+        if any(stage.needs_annotation for stage in stages.values()):
+            ano_file = os.path.join(panel["paths"]["raw_annotation"], filename)
+            if os.path.exists(ano_file):
+                ano_data = read_export(ano_file)
+
+    if panel.get("reclassify"):
+        with instrumentation.stage("reclassify", file=file):
+            det_data = reclassify(det_data, panel["reclassify"])
+
+    records = {}
+    for name, stage in stages.items():
+        if stage.needs_annotation and ano_data is None:
+            continue
+        try:
+            with instrumentation.stage(f"collect {name}", file=file):
+                records[name] = stage.collect(panel, filename, det_data, ano_data)
+        except Exception as e:
+            print(f"Error in {name} for {file}: {e}")
+    return records or None
+
+
+def run_panel(panel, n_workers=N_WORKERS):
+    """
+    Runs all requested analyses of a panel over its detection directory.
+    """
+    filelist = list_exports(panel["paths"]["raw_detection"])
+    print(f"{panel['name']}: {len(filelist)} exports, analyses: {', '.join(panel['analyses'])}")
+
+    with instrumentation.stage("process exports"):
+        results = run_per_file(partial(process_export, panel), filelist, n_workers=n_workers)
+    for name in panel["analyses"]:
+        records = [result[name] for result in results if result and result.get(name) is not None]
+        with instrumentation.stage(f"finish {name}"):
+            STAGES[name]().finish(panel, records)
+
+
+@register_stage("counts")
+class CountsStage:
+    """
+    Per-sample cell counts, densities, areas, intensities and subcellular sums
+    (the table of the *_txt_to_cell_analysis_withRNAmetrics.py scripts).
+    """
+    needs_annotation = True
+
+    def collect(self, panel, filename, det_data, ano_data):
+        metrics = panel.get("subcellular_metrics", [])
+        needed = [col for col in detection_columns(panel["cell_groups"], metrics)
+                  if col in det_data.columns or col not in metrics]
+        return filename, det_data[needed], annotation_area(ano_data)
+
+    def finish(self, panel, records):
+        summary = summarize_samples(
+            records, panel["cell_groups"], panel.get("subcellular_classes", []),
+            panel.get("subcellular_metrics", []), **panel.get("summary_options", {}),
+        )
+        stem = os.path.join(output_dir(panel, "counts"), f"{panel['name']}_subcellular_metrics")
+        summary.to_csv(stem + ".csv", index=False)
+        summary.to_excel(stem + ".xlsx", index=False)
+        print(f"Summary of {len(summary)} samples saved to {stem}.csv")
+
+
+class ClassValuesStage:
+    """
+    Collects one measurement per cell type (a set of labels in label_column) across all
+    exports and plots a histogram and a CDF per cell type.
+    """
+    needs_annotation = False
+    name = None
+    label_column = "Classification"
+
+    def collect(self, panel, filename, det_data, ano_data):
+        settings = stage_settings(panel, self.name)
+        index = ClassIndex(det_data, self.label_column)
+        return {
+            cell_type: pd.to_numeric(index.select(labels)[settings["column"]], errors="coerce").dropna().to_numpy()
+            for cell_type, labels in settings["cell_types"].items()
+        }
+
+    def pooled(self, panel, records):
+        return {
+            cell_type: np.concatenate([record[cell_type] for record in records]) if records else np.empty(0)
+            for cell_type in stage_settings(panel, self.name)["cell_types"]
+        }
+
+
+@register_stage("intensity_plots")
+class IntensityPlotsStage(ClassValuesStage):
+    """
+    Histogram and CDF of a marker's mean cell intensity per cell type
+    (the *_oprm1intensityplots.py scripts).
+    """
+    name = "intensity_plots"
+
+    def finish(self, panel, records):
+        settings = stage_settings(panel, self.name)
+        plots_dir = output_dir(panel, self.name)
+        values_by_type = self.pooled(panel, records)
+        non_empty = [values for values in values_by_type.values() if len(values)]
+        if not non_empty:
+            print(f"No {settings['column']} data available.")
+            return
+        x_min = min(values.min() for values in non_empty)
+        label = settings.get("xlabel", "Intensity")
+        file_label = settings.get("file_label", "intensity")
+
+        plots = PlotQueue()
+        for cell_type, values in values_by_type.items():
+            title_type = cell_type.replace("_", ":").title()
+            if not len(values):
+                print(f"No {settings['column']} data available for {title_type}.")
+                continue
+            color = settings["colors"][cell_type]
+            plots.add(
+                "hist", os.path.join(plots_dir, f"Distribution_of_{file_label}_{cell_type}.png"), values,
+                title=f"Distribution of {label} for {title_type}", xlabel=label, ylabel="Frequency",
+                xlim=(x_min, settings.get("hist_x_max", values.max())), ylim=(0, settings.get("y_max")),
+                bins=30, color=color, edgecolor="black", alpha=0.7, figsize=(10, 6), grid=True,
+            )
+            plots.add(
+                "cdf", os.path.join(plots_dir, f"{file_label}_CDF_{cell_type}.png"), values,
+                title=f"CDF of {label} for {title_type}", xlabel=label, ylabel="Cumulative Probability",
+                xlim=(x_min, settings.get("cdf_x_max", values.max())),
+                marker=".", linestyle="none", color=color, figsize=(10, 6), grid=True,
+            )
+        plots.render()
+        print(f"Intensity plots saved to {plots_dir}")
+
+
+@register_stage("puncta_plots")
+class PunctaPlotsStage(ClassValuesStage):
+    """
+    Histogram and CDF of spot counts per cell type, with cells picked by their Parent
+    (the *_oprm1punctaplots.py scripts).
+    """
+    name = "puncta_plots"
+    label_column = "Parent"
+
+    def finish(self, panel, records):
+        settings = stage_settings(panel, self.name)
+        plots_dir = output_dir(panel, self.name)
+        x_max = settings.get("x_max", 30)
+
+        plots = PlotQueue()
+        for cell_type, values in self.pooled(panel, records).items():
+            if not len(values):
+                print(f"No data for {cell_type}.")
+                continue
+            print(f"\nSummary for {cell_type}:")
+            print(f"  Count: {len(values)}")
+            print(f"  Min: {np.min(values)}")
+            print(f"  Max: {np.max(values)}")
+            print(f"  Mean: {np.mean(values)}")
+
+            color = settings["colors"][cell_type]
+            title_type = cell_type.replace("_", " ").title()
+            plots.add(
+                "hist", os.path.join(plots_dir, f"{cell_type}_histogram.png"), values,
+                title=f"Distribution of Puncta Counts for {title_type}", xlabel="Num Spots", ylabel="Frequency",
+                xlim=(0, x_max), bins=30, color=color, edgecolor="black", alpha=0.7, figsize=(10, 6), grid=True,
+            )
+            plots.add(
+                "cdf", os.path.join(plots_dir, f"{cell_type}_cdf.png"), values,
+                title=f"CDF for {title_type}", xlabel="Num Spots", ylabel="Cumulative Probability",
+                xlim=(0, x_max), color=color, figsize=(10, 6), grid=True,
+            )
+        plots.render()
+
+
+def measurement_columns(panel, settings):
+    """
+    Returns the measurement columns of a stage: its "columns" plus the channel columns of
+    its "markers".
+    """
+    return settings.get("columns", []) + [channel_column(panel, marker) for marker in settings.get("markers", [])]
+
+
+def cells_by_type(settings, det_data):
+    """
+    Returns cell type -> its cells, for the label sets in the stage's "cell_types".
+    """
+    index = ClassIndex(det_data, settings.get("label_column", "Classification"))
+    return {cell_type: index.select(labels) for cell_type, labels in settings["cell_types"].items()}
+
+
+@register_stage("quantile_sketches")
+class QuantileSketchStage:
+    """
+    Mergeable quantile sketches per (sample, cell type, measurement), saved as JSON with the
+    pooled percentiles of every cell type and measurement.
+    """
+    needs_annotation = False
+
+    def collect(self, panel, filename, det_data, ano_data):
+        settings = stage_settings(panel, "quantile_sketches")
+        columns = measurement_columns(panel, settings)
+        sketches = SketchStore()
+        for cell_type, cells in cells_by_type(settings, det_data).items():
+            for column in columns:
+                if column in cells.columns:
+                    sketches.add(filename, cell_type, column, pd.to_numeric(cells[column], errors="coerce"))
+        return sketches
+
+    def finish(self, panel, records):
+        sketches = SketchStore()
+        for record in records:
+            sketches.merge(record)
+        stem = os.path.join(output_dir(panel, "quantile_sketches"), panel["name"])
+        sketches.save(f"{stem}_quantile_sketches.json")
+        sketches.percentiles().to_csv(f"{stem}_pooled_percentiles.csv", index=False)
+        print(f"Quantile sketches of {len(records)} exports saved to {stem}_quantile_sketches.json")
+
+
+@register_stage("aggregate_cube")
+class AggregateCubeStage:
+    """
+    Mergeable per-(sample, cell type, measurement) partials (count, sums, min/max, histogram,
+    quantile sketch), saved as an .npz cube, plus one roll-up table per grouping in "rollups"
+    (lists of metadata columns parsed from the sample names or read from "metadata_csv").
+    """
+    needs_annotation = False
+
+    def new_cube(self, panel):
+        settings = stage_settings(panel, "aggregate_cube")
+        return AggregateCube(settings["cell_types"], measurement_columns(panel, settings),
+                             histograms=settings.get("histograms"))
+
+    def collect(self, panel, filename, det_data, ano_data):
+        cube = self.new_cube(panel)
+        cube.add_frame(filename, cells_by_type(stage_settings(panel, "aggregate_cube"), det_data))
+        return cube
+
+    def finish(self, panel, records):
+        settings = stage_settings(panel, "aggregate_cube")
+        cube = self.new_cube(panel)
+        for record in records:
+            cube.merge(record)
+        stem = os.path.join(output_dir(panel, "aggregate_cube"), panel["name"])
+        cube.save(f"{stem}_aggregate_cube.npz")
+        print(f"Aggregate cube of {len(cube.samples)} exports saved to {stem}_aggregate_cube.npz")
+
+        metadata = sample_metadata(cube.samples, settings.get("sample_pattern", SAMPLE_NAME_PATTERN),
+                                   settings.get("metadata_csv"))
+        for by in settings.get("rollups", []):
+            table = cube.rollup(by, metadata)
+            table.to_csv(f"{stem}_by_{'_'.join(by) or 'all'}.csv", index=False)
+
+
+@register_stage("threshold_sweep")
+class ThresholdSweepStage(ClassValuesStage):
+    """
+    Positive-cell counts, percentages, densities and mean intensities of a marker per cell
+    type for every candidate threshold ("thresholds": [start, stop, num]), with a sensitivity
+    plot marking the "reference" thresholds (see threshold_sweep.py).
+    """
+    needs_annotation = True
+    name = "threshold_sweep"
+
+    def collect(self, panel, filename, det_data, ano_data):
+        return filename, super().collect(panel, filename, det_data, ano_data), annotation_area(ano_data)
+
+    def finish(self, panel, records):
+        settings = stage_settings(panel, self.name)
+        samples = [(filename, values) for filename, values, _ in records]
+        areas = {filename: area for filename, _, area in records}
+        if "thresholds" in settings:
+            start, stop, num = settings["thresholds"]
+            thresholds = candidate_thresholds(start=start, stop=stop, num=int(num))
+        else:
+            pooled = [values for values in self.pooled(panel, [values for _, values in samples]).values() if len(values)]
+            if not pooled:
+                print(f"No {settings['column']} data available.")
+                return
+            thresholds = candidate_thresholds(np.concatenate(pooled))
+        write_sweep(samples, areas, thresholds, output_dir(panel, self.name), panel["name"],
+                    reference=settings.get("reference"), xlabel=settings.get("xlabel", settings["column"]),
+                    inclusive=settings.get("inclusive", False))
+
+
+@register_stage("neighborhoods")
+class NeighborhoodStage:
+    """
+    Neighborhood composition of every cell type: the cell types among each cell's "k"
+    nearest neighbors (or all neighbors within "radius" µm), per sample and pooled
+    (see spatial_neighbors.py).
+    """
+    needs_annotation = False
+
+    def collect(self, panel, filename, det_data, ano_data):
+        settings = stage_settings(panel, "neighborhoods")
+        return export_composition(det_data, filename, settings["cell_types"], settings.get("k"), settings.get("radius"))
+
+    def finish(self, panel, records):
+        if not records:
+            print("No neighborhood data available.")
+            return
+        table = pd.concat(records, ignore_index=True)
+        stem = os.path.join(output_dir(panel, "neighborhoods"), panel["name"])
+        table.to_csv(f"{stem}_neighborhood_composition.csv", index=False)
+        pooled_composition(table).to_csv(f"{stem}_neighborhood_composition_pooled.csv", index=False)
+        print(f"Neighborhood composition of {len(records)} exports saved to {stem}_neighborhood_composition.csv")
+
+
+@register_stage("density_maps")
+class DensityMapStage:
+    """
+    Smoothed cell-density heatmaps (cells/mm^2) of every cell type per image and pooled,
+    on a "pixel_um" grid smoothed with a "sigma_um" Gaussian; the pooled maps register the
+    images by bounding box unless "register" is false (see density_maps.py).
+    """
+    needs_annotation = False
+
+    def collect(self, panel, filename, det_data, ano_data):
+        positions, box = cell_positions(det_data, stage_settings(panel, "density_maps")["cell_types"])
+        return filename.replace(".txt", ""), positions, box
+
+    def finish(self, panel, records):
+        settings = stage_settings(panel, "density_maps")
+        write_density_maps(records, output_dir(panel, "density_maps"), panel["name"],
+                           settings.get("pixel_um", DEFAULT_PIXEL_UM), settings.get("sigma_um", DEFAULT_SIGMA_UM),
+                           settings.get("register", True), settings.get("per_image_plots", True))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run every analysis of a marker panel with one read per export.")
+    parser.add_argument("config", help="Panel config (JSON)")
+    parser.add_argument("--workers", type=int, default=N_WORKERS, help="Worker processes (1 = serial)")
+    parser.add_argument("--profile", nargs="?", const="", metavar="TRACE",
+                        help="Print per-stage timings and memory (and write a Chrome trace to TRACE)")
+    args = parser.parse_args()
+
+    if args.profile is not None:
+        instrumentation.enable(args.profile or None)
+    run_panel(load_panel(args.config), n_workers=args.workers)
+    instrumentation.report()
@@ -0,0 +1,72 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import instrumentation
+
+'''
+Runs per-image work for the txt_to_cell_analysis pipelines in a process pool.
+
+The worker must be a module-level function (so it can be pickled) that takes one file name
+and returns a result record, or None to skip the file. Results come back in the same order
+as the input files no matter which worker finishes first, and a failing file is reported
+the same way the serial loops did ("Error processing <file>: <error>") without stopping
+the other files.
+
+With profiling on (see instrumentation.py) every file is timed as a stage named after the
+worker, in the process that ran it, and the events travel back with the result.
+'''
+
+# Default number of worker processes (all cores)
+N_WORKERS = os.cpu_count() or 1
+
+
+def _worker_name(worker):
+    return getattr(worker, "__name__", None) or getattr(getattr(worker, "func", None), "__name__", "worker")
+
+
+def _call_safely(worker, file):
+    start = instrumentation.checkpoint()
+    try:
+        with instrumentation.stage(_worker_name(worker), file=file):
+            result, error = worker(file), None
+    except Exception as e:
+        result, error = None, str(e)
+    return result, error, instrumentation.take_events(start)
+
+
+def run_per_file(worker, files, n_workers=N_WORKERS, chunksize=None):
+    """
+    Applies worker to every file, in parallel when n_workers > 1.
+
+    Parameters:
+        worker (callable): Module-level function taking a file name and returning a record.
+        files (list): File names to process, in the order results should be returned.
+        n_workers (int): Number of processes; 1 runs everything in the current process.
+        chunksize (int): Files handed to a worker at a time (default: spread evenly).
+
+    Returns:
+        list: One entry per file, None for skipped or failed files.
+    """
+    files = list(files)
+    task = partial(_call_safely, worker)
+
+    if n_workers is None or n_workers <= 1 or len(files) <= 1:
+        outcomes = map(task, files)
+        return _report(files, outcomes)
+
+    if chunksize is None:
+        chunksize = max(1, len(files) // (n_workers * 4))
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        outcomes = executor.map(task, files, chunksize=chunksize)
+        return _report(files, outcomes)
+
+
+def _report(files, outcomes):
+    results = []
+    for file, (result, error, events) in zip(files, outcomes):
+        instrumentation.absorb(events)
+        if error is not None:
+            print(f"Error processing {file}: {error}")
+        results.append(result)
+    return results
@@ -0,0 +1,195 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+import instrumentation
+from parallel_processing import N_WORKERS
+
+'''
+Queued, parallel and cached rendering of histogram/CDF plots and heatmaps.
+
+Scripts describe each plot as a lightweight spec (kind, output path, style options and the
+values to plot) instead of drawing it right away. PlotQueue.render() then draws all queued
+plots with the Agg canvas in a pool of worker processes. A plot is skipped when its PNG
+already exists and was made from the same values and the same spec, which is recorded in a
+small index file (.plot_index.json) next to the PNGs.
+
+Scripts that render in a process pool must run their work under if __name__ == "__main__".
+'''
+
+INDEX_FILENAME = ".plot_index.json"
+
+# Bump when the drawing code changes so existing plots get redrawn
+RENDERER_VERSION = 1
+
+# Style options understood by the renderer (anything else is rejected when queueing)
+STYLE_OPTIONS = {
+    "title", "xlabel", "ylabel", "xlim", "ylim", "color", "bins", "range", "alpha", "edgecolor",
+    "marker", "linestyle", "figsize", "grid", "tight_layout", "fontsize", "extent", "cmap", "vmax",
+    "colorbar_label",
+}
+
+
+def plot_key(kind, values, style):
+    """
+    Returns the hash identifying a plot: renderer version, kind, style and the values.
+    """
+    digest = hashlib.sha1()
+    spec = {"version": RENDERER_VERSION, "kind": kind, "style": style}
+    digest.update(json.dumps(spec, sort_keys=True, default=str).encode("utf-8"))
+    values = np.ascontiguousarray(values)
+    digest.update(str(values.dtype).encode("utf-8"))
+    digest.update(values.tobytes())
+    return digest.hexdigest()
+
+
+def draw_plot(job):
+    """
+    Draws one plot spec and saves it (temp file + rename). Runs in a worker process.
+
+    Parameters:
+        job (tuple): (kind, output path, values, style) with kind "hist", "cdf" or "heatmap"
+            (values: a 2D array, drawn with its first row at the bottom).
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    kind, output_path, values, style = job
+    fig = Figure(figsize=style.get("figsize", (6.4, 4.8)))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+
+    if kind == "hist":
+        ax.hist(values, bins=style.get("bins", 20), range=style.get("range"), color=style.get("color"),
+                alpha=style.get("alpha", 0.7), edgecolor=style.get("edgecolor", "black"))
+    elif kind == "cdf":
+        sorted_data = np.sort(values)
+        cdf = np.arange(1, len(sorted_data) + 1) / len(sorted_data)
+        ax.plot(sorted_data, cdf, color=style.get("color"), marker=style.get("marker"),
+                linestyle=style.get("linestyle", "-"))
+    elif kind == "heatmap":
+        image = ax.imshow(values, origin="lower", extent=style.get("extent"), cmap=style.get("cmap", "magma"),
+                          vmin=0, vmax=style.get("vmax"), aspect="equal")
+        fig.colorbar(image, ax=ax, label=style.get("colorbar_label", ""))
+    else:
+        raise ValueError(f"Unknown plot kind: {kind}")
+
+    ax.set_title(style.get("title", ""), fontsize=style.get("fontsize"))
+    ax.set_xlabel(style.get("xlabel", ""))
+    ax.set_ylabel(style.get("ylabel", {"hist": "Frequency", "cdf": "CDF"}.get(kind, "")))
+    if style.get("xlim") is not None:
+        ax.set_xlim(*style["xlim"])
+    if style.get("ylim") is not None:
+        ax.set_ylim(*style["ylim"])
+    if style.get("grid"):
+        ax.grid(True)
+    if style.get("tight_layout"):
+        fig.tight_layout()
+
+    tmp_path = output_path + ".tmp.png"
+    fig.savefig(tmp_path)
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+def _draw_safely(job):
+    try:
+        return draw_plot(job), None
+    except Exception as e:
+        return None, str(e)
+
+
+class PlotQueue:
+    """
+    Collects plot specs and renders the changed ones in parallel.
+
+    Parameters:
+        n_workers (int): Worker processes used by render (1 draws in the current process).
+    """
+
+    def __init__(self, n_workers=N_WORKERS):
+        self.n_workers = n_workers
+        self.jobs = []
+
+    def add(self, kind, output_path, values, **style):
+        """
+        Queues a plot.
+
+        Parameters:
+            kind (str): "hist", "cdf" or "heatmap".
+            output_path (str): PNG to write.
+            values (array-like): Values to plot.
+            **style: Title, labels, limits, color, bins, ... (see STYLE_OPTIONS).
+        """
+        unknown = set(style) - STYLE_OPTIONS
+        if unknown:
+            raise ValueError(f"Unknown plot style options: {sorted(unknown)}")
+        # Tuples and lists hash the same way once stored as JSON
+        style = {name: list(value) if isinstance(value, tuple) else value for name, value in style.items()}
+        values = np.asarray(values, dtype=float)
+        self.jobs.append((kind, os.path.abspath(output_path), values, style))
+
+    @instrumentation.timed("render plots")
+    def render(self):
+        """
+        Draws every queued plot whose output is missing or out of date, then empties the queue.
+
+        Returns:
+            dict: Numbers of plots "rendered", "skipped" (unchanged) and "failed".
+        """
+        indexes = {}
+        pending = []
+        keys = {}
+        skipped = 0
+        for kind, output_path, values, style in self.jobs:
+            directory, name = os.path.split(output_path)
+            if directory not in indexes:
+                indexes[directory] = _load_index(directory)
+            key = plot_key(kind, values, style)
+            if indexes[directory].get(name) == key and os.path.exists(output_path):
+                skipped += 1
+                continue
+            keys[output_path] = key
+            pending.append((kind, output_path, values, style))
+        self.jobs = []
+
+        if self.n_workers is None or self.n_workers <= 1 or len(pending) <= 1:
+            outcomes = map(_draw_safely, pending)
+            results = list(outcomes)
+        else:
+            chunksize = max(1, len(pending) // (self.n_workers * 4))
+            with ProcessPoolExecutor(max_workers=self.n_workers) as executor:
+                results = list(executor.map(_draw_safely, pending, chunksize=chunksize))
+
+        failed = 0
+        for (_, output_path, _, _), (result, error) in zip(pending, results):
+            directory, name = os.path.split(output_path)
+            if error is not None:
+                print(f"Error rendering {output_path}: {error}")
+                indexes[directory].pop(name, None)
+                failed += 1
+            else:
+                indexes[directory][name] = keys[output_path]
+        for directory, index in indexes.items():
+            _save_index(directory, index)
+
+        counts = {"rendered": len(pending) - failed, "skipped": skipped, "failed": failed}
+        print(f"Plots: {counts['rendered']} rendered, {counts['skipped']} unchanged, {counts['failed']} failed")
+        return counts
+
+
+def _load_index(directory):
+    index_path = os.path.join(directory, INDEX_FILENAME)
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path) as file:
+        return json.load(file)
+
+
+def _save_index(directory, index):
+    index_path = os.path.join(directory, INDEX_FILENAME)
+    with open(index_path + ".tmp", "w") as file:
+        json.dump(index, file, indent=1, sort_keys=True)
+    os.replace(index_path + ".tmp", index_path)
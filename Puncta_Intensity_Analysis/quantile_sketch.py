@@ -0,0 +1,346 @@
+import argparse
+import json
+import os
+import numpy as np
+import pandas as pd
+
+'''
+Mergeable quantile sketches (t-digest) for pooled percentiles without keeping every value.
+
+A TDigest summarizes any number of values in at most about compression / 2 weighted
+centroids, small near the tails and larger around the median (k1 scale function), so the
+quantile error is bounded and smallest for extreme quantiles. Digests of different files
+merge into the digest of the pooled values, up to the same error bound. Repeated values
+are kept as one exact centroid, so data with few distinct values (e.g. puncta counts)
+give exact percentiles.
+
+A SketchStore keeps one digest per (sample, class, measurement) and is saved as JSON next
+to the summary outputs. Stores of several runs (animals, iterations) can be loaded and
+merged, and pooled percentiles of any subset of samples/classes are read off the merged
+digests without re-reading the raw exports:
+
+    python quantile_sketch.py run1/quantile_sketches.json run2/quantile_sketches.json
+'''
+
+# Default compression (about compression / 2 centroids per digest)
+COMPRESSION = 200
+
+# Values buffered before they are folded into the centroids, relative to the compression
+BUFFER_FACTOR = 5
+
+SKETCH_FORMAT_VERSION = 1
+
+
+def _scale(q, compression):
+    # k1 scale function: centroids may span at most one unit of k
+    return compression / (2 * np.pi) * np.arcsin(2 * q - 1)
+
+
+class TDigest:
+    """
+    Merging t-digest of a stream of values.
+
+    Parameters:
+        compression (float): Accuracy/size trade-off (about compression / 2 centroids).
+    """
+
+    def __init__(self, compression=COMPRESSION):
+        self.compression = compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        # Whether all values of a centroid are identical (it then spans its whole rank range)
+        self.exact = np.empty(0, dtype=bool)
+        self.min = np.inf
+        self.max = -np.inf
+        self._pending = []
+        self._n_pending = 0
+
+    @property
+    def count(self):
+        """
+        Number of values added.
+        """
+        return float(self.weights.sum()) + self._n_pending
+
+    def add(self, values):
+        """
+        Adds an array of values (NaNs and infinities are ignored).
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[np.isfinite(values)]
+        if not len(values):
+            return
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self._pending.append((values, np.ones(len(values)), np.ones(len(values), dtype=bool)))
+        self._n_pending += len(values)
+        if self._n_pending > BUFFER_FACTOR * self.compression:
+            self._compress()
+
+    def merge(self, other):
+        """
+        Adds all values summarized by another digest.
+        """
+        other._compress()
+        if not len(other.weights):
+            return
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._pending.append((other.means, other.weights, other.exact))
+        self._n_pending += float(other.weights.sum())
+        self._compress()
+
+    def _compress(self):
+        """
+        Folds the pending values/centroids into the centroids: everything is sorted by mean,
+        identical values are combined, then neighbours whose cumulative-weight midpoints
+        fall into the same unit of k are combined (np.add.reduceat, no per-value loop).
+        """
+        if not self._pending:
+            return
+        means = np.concatenate([self.means] + [part[0] for part in self._pending])
+        weights = np.concatenate([self.weights] + [part[1] for part in self._pending])
+        exact = np.concatenate([self.exact] + [part[2] for part in self._pending])
+        self._pending = []
+        self._n_pending = 0
+
+        order = np.argsort(means, kind="stable")
+        means, weights, exact = means[order], weights[order], exact[order]
+        starts = np.flatnonzero(np.r_[True, means[1:] != means[:-1]])
+        means, weights, exact = means[starts], np.add.reduceat(weights, starts), np.logical_and.reduceat(exact, starts)
+
+        midpoints = (np.cumsum(weights) - weights / 2) / weights.sum()
+        k = np.floor(_scale(midpoints, self.compression))
+        starts = np.flatnonzero(np.r_[True, k[1:] != k[:-1]])
+        sizes = np.diff(np.r_[starts, len(means)])
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / self.weights
+        self.exact = exact[starts] & (sizes == 1)
+
+    def quantile(self, q):
+        """
+        Returns the q-quantiles (0-1). With only exact centroids this matches np.percentile
+        (linear interpolation between closest ranks).
+        """
+        self._compress()
+        q = np.asarray(q, dtype=np.float64)
+        if not len(self.weights):
+            return np.full(q.shape, np.nan)
+        # Rank range covered by every centroid: exact centroids from their first to their
+        # last value, the others at their midpoint
+        n = self.weights.sum()
+        end = np.cumsum(self.weights)
+        start = end - self.weights
+        first = np.where(self.exact, start + 0.5, start + self.weights / 2)
+        last = np.where(self.exact, end - 0.5, start + self.weights / 2)
+        positions = np.concatenate([[0], np.column_stack([first, last]).ravel(), [n]])
+        values = np.concatenate([[self.min], np.repeat(self.means, 2), [self.max]])
+        return np.interp(q * (n - 1) + 0.5, positions, values)
+
+    def to_dict(self):
+        """
+        Returns the digest as a JSON-serializable dict.
+        """
+        self._compress()
+        return {
+            "compression": self.compression,
+            "min": self.min,
+            "max": self.max,
+            "means": self.means.tolist(),
+            "weights": self.weights.tolist(),
+            "exact": self.exact.astype(int).tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, record):
+        """
+        Rebuilds a digest written by to_dict.
+        """
+        digest = cls(record["compression"])
+        digest.min, digest.max = record["min"], record["max"]
+        digest.means = np.asarray(record["means"], dtype=np.float64)
+        digest.weights = np.asarray(record["weights"], dtype=np.float64)
+        digest.exact = np.asarray(record["exact"], dtype=bool)
+        return digest
+
+
+def merge_digests(digests, compression=COMPRESSION):
+    """
+    Returns one digest of all values summarized by the given digests, compressed once
+    (instead of once per merge).
+    """
+    merged = TDigest(compression)
+    for digest in digests:
+        digest._compress()
+        if len(digest.weights):
+            merged.min = min(merged.min, digest.min)
+            merged.max = max(merged.max, digest.max)
+            merged._pending.append((digest.means, digest.weights, digest.exact))
+    merged._compress()
+    return merged
+
+
+def _matches(value, selection):
+    # None selects everything, a string one value, any other collection several values
+    if selection is None:
+        return True
+    if isinstance(selection, str):
+        return value == selection
+    return value in selection
+
+
+class SketchStore:
+    """
+    Quantile sketches keyed by (sample, class, measurement).
+
+    Parameters:
+        compression (float): Compression of new digests.
+    """
+
+    def __init__(self, compression=COMPRESSION):
+        self.compression = compression
+        self.sketches = {}
+
+    def add(self, sample, cls, measurement, values):
+        """
+        Adds the values of one (sample, class, measurement); empty inputs add nothing.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        if not len(values):
+            return
+        key = (sample, cls, measurement)
+        if key not in self.sketches:
+            self.sketches[key] = TDigest(self.compression)
+        self.sketches[key].add(values)
+
+    def add_cells(self, measurement, values, class_codes, classes, sample_ids, samples):
+        """
+        Adds per-cell values grouped by class code and sample id (e.g. a CellStore's arrays).
+
+        Parameters:
+            measurement (str): Measurement name.
+            values, class_codes, sample_ids (array-like): One entry per cell.
+            classes (list): Class labels (class code -> label).
+            samples (list): Sample names (sample id -> name).
+        """
+        values = np.asarray(values, dtype=np.float64)
+        class_codes = np.asarray(class_codes)
+        sample_ids = np.asarray(sample_ids)
+        order = np.lexsort((class_codes, sample_ids))
+        values, class_codes, sample_ids = values[order], class_codes[order], sample_ids[order]
+        starts = np.flatnonzero(np.r_[True, (class_codes[1:] != class_codes[:-1]) | (sample_ids[1:] != sample_ids[:-1])])
+        for start, end in zip(starts, np.r_[starts[1:], len(values)]):
+            self.add(samples[sample_ids[start]], classes[class_codes[start]], measurement, values[start:end])
+
+    def merge(self, other):
+        """
+        Merges another store into this one (digests with the same key are combined).
+        """
+        for key, sketch in other.sketches.items():
+            if key not in self.sketches:
+                self.sketches[key] = TDigest(self.compression)
+            self.sketches[key].merge(sketch)
+
+    def keys(self, samples=None, classes=None, measurements=None):
+        """
+        Returns the (sample, class, measurement) keys matching the selections.
+        """
+        return [key for key in self.sketches
+                if _matches(key[0], samples) and _matches(key[1], classes) and _matches(key[2], measurements)]
+
+    def select(self, samples=None, classes=None, measurements=None):
+        """
+        Returns one digest of all values of the selected samples, classes and measurements
+        (None selects all; a string one; a list several).
+        """
+        return merge_digests([self.sketches[key] for key in self.keys(samples, classes, measurements)],
+                             self.compression)
+
+    def percentiles(self, q=(0.25, 0.5, 0.75), by=("class", "measurement"), samples=None, classes=None,
+                    measurements=None):
+        """
+        Returns pooled percentiles of the selected sketches, one row per group.
+
+        Parameters:
+            q (list): Quantiles (0-1).
+            by (tuple): Key fields to group by ("sample", "class", "measurement").
+            samples, classes, measurements: Selections as in select.
+
+        Returns:
+            pd.DataFrame: Group fields, "Count" and one "<q>th Percentile" column per quantile.
+        """
+        fields = ("sample", "class", "measurement")
+        groups = {}
+        for key in self.keys(samples, classes, measurements):
+            group = tuple(key[fields.index(field)] for field in by)
+            groups.setdefault(group, []).append(self.sketches[key])
+
+        rows = []
+        for group, digests in groups.items():
+            digest = merge_digests(digests, self.compression)
+            row = {field.title(): value for field, value in zip(by, group)}
+            row["Count"] = int(round(digest.count))
+            row.update({f"{quantile * 100:g}th Percentile": value
+                        for quantile, value in zip(q, digest.quantile(q))})
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+    def to_dict(self):
+        """
+        Returns the store as a JSON-serializable dict.
+        """
+        records = [{"sample": sample, "class": cls, "measurement": measurement, **sketch.to_dict()}
+                   for (sample, cls, measurement), sketch in self.sketches.items()]
+        return {"version": SKETCH_FORMAT_VERSION, "compression": self.compression, "sketches": records}
+
+    @classmethod
+    def from_dict(cls, content):
+        """
+        Rebuilds a store written by to_dict.
+        """
+        store = cls(content["compression"])
+        for record in content["sketches"]:
+            key = (record["sample"], record["class"], record["measurement"])
+            store.sketches[key] = TDigest.from_dict(record)
+        return store
+
+    def save(self, path):
+        """
+        Writes the store as JSON (temp file + rename).
+        """
+        with open(path + ".tmp", "w") as file:
+            json.dump(self.to_dict(), file)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads a store written by save.
+        """
+        with open(path) as file:
+            return cls.from_dict(json.load(file))
+
+
+def load_sketches(paths, compression=COMPRESSION):
+    """
+    Loads and merges several saved stores (e.g. of different animals or iterations).
+    """
+    store = SketchStore(compression)
+    for path in paths:
+        store.merge(SketchStore.load(path))
+    return store
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pooled percentiles from saved quantile sketches.")
+    parser.add_argument("stores", nargs="+", help="Sketch files (JSON) to merge")
+    parser.add_argument("--classes", nargs="*", help="Only these classes")
+    parser.add_argument("--samples", nargs="*", help="Only these samples")
+    parser.add_argument("--by", nargs="+", default=["class", "measurement"], help="Key fields to group by")
+    parser.add_argument("--output", help="Write the merged store to this file")
+    args = parser.parse_args()
+
+    merged = load_sketches(args.stores)
+    print(merged.percentiles(by=tuple(args.by), samples=args.samples, classes=args.classes).to_string(index=False))
+    if args.output:
+        merged.save(args.output)
@@ -0,0 +1,410 @@
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+
+import instrumentation
+
+'''
+Shared reader for QuPath measurement exports (detection/annotation .txt or .csv files).
+
+The first time an export is read it is parsed once and written to a compressed columnar
+cache file (Parquet when pyarrow is installed, a compressed pickle otherwise). Later reads
+are served from the cache as long as the export has not changed. An export counts as
+unchanged when its size and modification time match the cached fingerprint, or, if only
+the modification time moved (e.g. after copying to another volume), when its content hash
+still matches.
+'''
+
+try:
+    import pyarrow  # noqa: F401
+    CACHE_FORMAT = "parquet"
+except ImportError:
+    CACHE_FORMAT = "pickle"
+
+# Cache files live in this folder next to the exports unless a cache_dir is given
+CACHE_DIRNAME = ".qupath_cache"
+
+# Bump when the cached layout changes so stale cache files get rebuilt
+CACHE_VERSION = 2
+
+# Label columns stored as categoricals (one small integer code per row instead of a string)
+CATEGORICAL_COLUMNS = ("Classification", "Parent", "Object type")
+
+HASH_BLOCK_SIZE = 1 << 20
+
+# Rows held in memory at once by the streaming reader
+DEFAULT_CHUNKSIZE = 200_000
+
+
+def list_exports(directory, extensions=(".txt",)):
+    """
+    Lists the export files in a directory, skipping macOS "._" resource files.
+
+    Parameters:
+        directory (str): Directory containing the exports.
+        extensions (tuple): File endings to include.
+
+    Returns:
+        list: Sorted file names (not full paths).
+    """
+    return sorted(
+        f for f in os.listdir(directory)
+        if f.endswith(tuple(extensions)) and not f.startswith("._")
+    )
+
+
+def sniff_delimiter(file_path, n_lines=20):
+    """
+    Guesses the delimiter of an export (tab for QuPath .txt exports).
+
+    A candidate wins if it splits the header and the next lines into the same number of
+    fields; otherwise the candidate found most often in the header is used.
+    """
+    with open(file_path, "r", encoding="utf-8", errors="replace") as file:
+        lines = [line.rstrip("\r\n") for _, line in zip(range(n_lines), file)]
+    lines = [line for line in lines if line]
+    candidates = ("\t", ",", ";", " ")
+    if lines:
+        for delimiter in candidates:
+            counts = {line.count(delimiter) for line in lines}
+            if len(counts) == 1 and counts.pop() > 0:
+                return delimiter
+        best = max(candidates, key=lambda delimiter: lines[0].count(delimiter))
+        if lines[0].count(best) > 0:
+            return best
+    return "\t" if file_path.endswith(".txt") else ","
+
+
+def content_hash(file_path):
+    """
+    Returns the SHA-1 hex digest of a file, read in fixed-size blocks.
+    """
+    digest = hashlib.sha1()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_fingerprint(file_path, with_hash=False):
+    """
+    Returns the fingerprint used to key cached exports: absolute path, size and mtime,
+    plus the content hash when with_hash is True.
+    """
+    file_path = os.path.abspath(file_path)
+    stat = os.stat(file_path)
+    fingerprint = {"path": file_path, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if with_hash:
+        fingerprint["sha1"] = content_hash(file_path)
+    return fingerprint
+
+
+def cache_paths(file_path, cache_dir=None):
+    """
+    Returns the (data, metadata) file paths of the cache entry for an export.
+    """
+    file_path = os.path.abspath(file_path)
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(file_path), CACHE_DIRNAME)
+    stem = os.path.splitext(os.path.basename(file_path))[0]
+    key = hashlib.sha1(file_path.encode("utf-8")).hexdigest()[:12]
+    base = os.path.join(cache_dir, f"{stem}-{key}")
+    return base + ".data", base + ".json"
+
+
+def parse_export(file_path, **read_csv_kwargs):
+    """
+    Parses an export straight from text, bypassing the cache.
+    """
+    read_csv_kwargs.setdefault("sep", sniff_delimiter(file_path))
+    read_csv_kwargs.setdefault("encoding", "utf-8")
+    return pd.read_csv(file_path, **read_csv_kwargs)
+
+
+def encode_categoricals(df, columns=CATEGORICAL_COLUMNS):
+    """
+    Converts the label columns of an export to categoricals with whitespace-stripped labels.
+
+    Stripping works on the (few) categories rather than on every row.
+    """
+    for column in columns:
+        if column not in df.columns:
+            continue
+        labels = df[column]
+        if not isinstance(labels.dtype, pd.CategoricalDtype):
+            labels = labels.astype("category")
+        stripped = labels.cat.categories.astype(str).str.strip()
+        if stripped.is_unique:
+            labels = labels.cat.rename_categories(stripped)
+        else:
+            labels = labels.astype(str).str.strip().astype("category")
+        df[column] = labels
+    return df
+
+
+class ClassIndex:
+    """
+    Row positions of every label of a categorical column, built once per file.
+
+    Selecting the rows of one or more labels is then a slice of precomputed positions
+    instead of a string comparison over the whole column.
+
+    Parameters:
+        df (pd.DataFrame): Export table (label column categorical or plain strings).
+        column (str): Label column to index, e.g. "Classification" or "Parent".
+    """
+
+    def __init__(self, df, column="Classification"):
+        self.df = df
+        labels = df[column]
+        if not isinstance(labels.dtype, pd.CategoricalDtype):
+            labels = labels.astype("category")
+        codes = labels.cat.codes.to_numpy()
+        # Stable sort of the small integer codes keeps file order within each label
+        order = np.argsort(codes, kind="stable")
+        bounds = np.searchsorted(codes[order], np.arange(len(labels.cat.categories) + 1))
+        self.positions = {
+            label: order[bounds[i]:bounds[i + 1]]
+            for i, label in enumerate(labels.cat.categories)
+        }
+
+    def rows(self, labels):
+        """
+        Returns the sorted row positions of all rows carrying any of the labels.
+        """
+        if isinstance(labels, str):
+            labels = [labels]
+        parts = [self.positions[label] for label in labels if label in self.positions]
+        if not parts:
+            return np.empty(0, dtype=np.intp)
+        return parts[0] if len(parts) == 1 else np.sort(np.concatenate(parts))
+
+    def select(self, labels):
+        """
+        Returns the rows carrying any of the labels (same result as df[df[column].isin(labels)]).
+        """
+        return self.df.iloc[self.rows(labels)]
+
+    def count(self, labels):
+        """
+        Returns the number of rows carrying any of the labels.
+        """
+        if isinstance(labels, str):
+            labels = [labels]
+        return sum(len(self.positions.get(label, ())) for label in labels)
+
+
+def _load_cached(data_path, cache_format, columns=None):
+    if cache_format == "parquet":
+        return pd.read_parquet(data_path, columns=columns)
+    df = pd.read_pickle(data_path, compression="gzip")
+    return df[columns] if columns is not None else df
+
+
+def _temp_path(path):
+    # Unique temp file next to path, so processes caching the same export do not collide
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    os.close(fd)
+    return tmp_path
+
+
+def _replace_atomically(path, write):
+    # Writes through a temp file + rename, so concurrent readers never see a partly written file
+    tmp_path = _temp_path(path)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _write_cache(df, data_path, meta_path, meta):
+    os.makedirs(os.path.dirname(data_path), exist_ok=True)
+    cache_format = CACHE_FORMAT
+    if cache_format == "parquet":
+        try:
+            _replace_atomically(data_path, lambda path: df.to_parquet(path, compression="zstd", index=False))
+        except Exception:
+            # Mixed-type object columns cannot always be stored as Parquet
+            cache_format = "pickle"
+    if cache_format == "pickle":
+        _replace_atomically(data_path, lambda path: df.to_pickle(path, compression="gzip"))
+
+    _write_meta(meta_path, dict(meta, format=cache_format, version=CACHE_VERSION))
+
+
+def _write_meta(meta_path, meta):
+    def dump(path):
+        with open(path, "w") as file:
+            json.dump(meta, file)
+    _replace_atomically(meta_path, dump)
+
+
+def _valid_cache_meta(file_path, data_path, meta_path):
+    """
+    Returns the cache metadata if the cache entry still matches the export, else None.
+    """
+    if not (os.path.exists(meta_path) and os.path.exists(data_path)):
+        return None
+    try:
+        with open(meta_path) as file:
+            meta = json.load(file)
+    except (OSError, ValueError):
+        # Unreadable or partly written metadata: treat as a cache miss
+        return None
+    if meta.get("version") != CACHE_VERSION:
+        return None
+
+    fingerprint = file_fingerprint(file_path)
+    if meta["size"] != fingerprint["size"]:
+        return None
+    if meta["mtime_ns"] != fingerprint["mtime_ns"]:
+        # Touched or copied but possibly unchanged: fall back to the content hash
+        if content_hash(file_path) != meta["sha1"]:
+            return None
+        meta["mtime_ns"] = fingerprint["mtime_ns"]
+        try:
+            _write_meta(meta_path, meta)
+        except OSError:
+            # Read-only cache: the entry stays valid, the hash is just checked again next time
+            pass
+    return meta
+
+
+def read_export(file_path, columns=None, cache_dir=None, use_cache=True):
+    """
+    Reads a QuPath export, using the columnar cache when it is still valid.
+
+    Parameters:
+        file_path (str): Path to the .txt or .csv export.
+        columns (list): Optional subset of columns to return.
+        cache_dir (str): Where to keep cache files (default: .qupath_cache next to the export).
+        use_cache (bool): Set to False to always parse the text file.
+
+    Returns:
+        pd.DataFrame: The export's measurement table, with Classification, Parent and
+        Object type as categoricals.
+    """
+    if not use_cache:
+        return _counted(encode_categoricals(parse_export(file_path, usecols=columns)), file_path)
+
+    data_path, meta_path = cache_paths(file_path, cache_dir)
+    meta = _valid_cache_meta(file_path, data_path, meta_path)
+    if meta is not None:
+        try:
+            return _counted(encode_categoricals(_load_cached(data_path, meta["format"], columns)), data_path)
+        except Exception as e:
+            print(f"Rebuilding unreadable cache for {file_path}: {e}")
+
+    df = encode_categoricals(parse_export(file_path))
+    try:
+        _write_cache(df, data_path, meta_path, file_fingerprint(file_path, with_hash=True))
+    except Exception as e:
+        # A read-only or full volume only costs the cache, not the read
+        print(f"Could not cache {file_path}: {e}")
+    return _counted(df[columns] if columns is not None else df, file_path)
+
+
+def _counted(df, source_path):
+    # Rows returned and bytes of the file they were read from, for the profiler
+    if instrumentation.enabled():
+        instrumentation.count(rows=len(df), bytes_read=os.path.getsize(source_path))
+    return df
+
+
+def export_columns(file_path):
+    """
+    Returns the stripped column names of an export without parsing its rows.
+    """
+    delimiter = sniff_delimiter(file_path)
+    with open(file_path, "r", encoding="utf-8", errors="replace") as file:
+        header = file.readline().rstrip("\r\n")
+    return [column.strip().strip('"') for column in header.split(delimiter)]
+
+
+def iter_export_chunks(file_path, columns, chunksize=DEFAULT_CHUNKSIZE, cache_dir=None):
+    """
+    Streams only the requested columns of an export in chunks of at most chunksize rows.
+
+    Works the same for .txt and .csv exports. When a valid Parquet cache exists the chunks
+    come from it; otherwise the text is parsed chunk by chunk without building a cache, so
+    peak memory stays bounded by the chunk size. Column names are matched after stripping
+    surrounding whitespace.
+
+    Parameters:
+        file_path (str): Path to the .txt or .csv export.
+        columns (list): Columns to keep; missing columns raise a KeyError.
+        chunksize (int): Maximum number of rows per chunk.
+        cache_dir (str): Cache location used by read_export.
+
+    Yields:
+        pd.DataFrame: Chunks with exactly the requested columns.
+    """
+    columns = list(columns)
+    missing = [column for column in columns if column not in export_columns(file_path)]
+    if missing:
+        raise KeyError(f"Missing required columns: {missing}")
+
+    data_path, meta_path = cache_paths(file_path, cache_dir)
+    meta = _valid_cache_meta(file_path, data_path, meta_path)
+    if meta is not None and meta["format"] == "parquet":
+        import pyarrow.parquet as pq
+
+        if instrumentation.enabled():
+            instrumentation.count(bytes_read=os.path.getsize(data_path))
+        parquet_file = pq.ParquetFile(data_path)
+        stripped = {name.strip(): name for name in parquet_file.schema_arrow.names}
+        for batch in parquet_file.iter_batches(batch_size=chunksize, columns=[stripped[c] for c in columns]):
+            chunk = batch.to_pandas()
+            chunk.columns = columns
+            instrumentation.count(rows=len(chunk))
+            yield chunk
+        return
+
+    if instrumentation.enabled():
+        instrumentation.count(bytes_read=os.path.getsize(file_path))
+    wanted = set(columns)
+    reader = pd.read_csv(
+        file_path,
+        sep=sniff_delimiter(file_path),
+        encoding="utf-8",
+        usecols=lambda name: name.strip() in wanted,
+        chunksize=chunksize,
+    )
+    for chunk in reader:
+        chunk.columns = chunk.columns.str.strip()
+        instrumentation.count(rows=len(chunk))
+        yield chunk[columns]
+
+
+def collect_values(file_path, group_column, value_column, groups, chunksize=DEFAULT_CHUNKSIZE, cache_dir=None):
+    """
+    Streams an export and gathers the non-missing values of one measurement per group.
+
+    Parameters:
+        file_path (str): Path to the .txt or .csv export.
+        group_column (str): Column holding the group labels (e.g. "Classification" or "Parent").
+        value_column (str): Measurement column to collect (e.g. "AF568: Cell: Mean").
+        groups (list): Group labels to keep; labels are compared after stripping whitespace.
+        chunksize (int): Maximum number of rows held in memory at once.
+
+    Returns:
+        dict: Group label -> NumPy array of values, in file order.
+    """
+    parts = {group: [] for group in groups}
+    for chunk in iter_export_chunks(file_path, [group_column, value_column], chunksize, cache_dir):
+        index = ClassIndex(encode_categoricals(chunk[[group_column]].copy(), [group_column]), group_column)
+        values = pd.to_numeric(chunk[value_column], errors="coerce").to_numpy(dtype=float)
+        for group in groups:
+            group_values = values[index.rows(group)]
+            group_values = group_values[~np.isnan(group_values)]
+            if len(group_values):
+                parts[group].append(group_values)
+    return {
+        group: np.concatenate(arrays) if arrays else np.empty(0)
+        for group, arrays in parts.items()
+    }
@@ -0,0 +1,181 @@
+import argparse
+import json
+import os
+import numpy as np
+import pandas as pd
+
+from hierarchy_join import HierarchyIndex, parent_labels
+from qupath_io import list_exports, read_export
+
+'''
+Offline reclassification of cells from the measurements already in the QuPath exports, so
+a new positivity threshold is a recompute over the cached tables instead of re-running the
+classifiers in QuPath and re-exporting every image.
+
+Rules map every marker (in the order its name appears in the class labels) to a positivity
+rule:
+
+    {"column": "AF647: Cell: Mean", "threshold": 150}          value > threshold
+    {"column": "...: Num spots estimated", "threshold": 3,
+     "inclusive": true}                                         value >= threshold
+    {"all": [rule, ...]}, {"any": [rule, ...]}, {"not": rule}   combined rules
+
+e.g. {"vglut2": {"column": "AF488: Cell: Mean", "threshold": 120},
+      "vgat": {"column": "AF647: Cell: Mean", "threshold": 150}}
+
+Missing values are negative. Every cell gets the composite label of its markers
+("vglut2_Pos: vgat_Neg", as QuPath writes it): the positivity of each marker is one bit of
+an integer code, and the labels are a categorical built from the codes, so the whole table
+is classified with a few vectorized comparisons. Child rows (spots, clusters) keep pointing
+to their cell: their Parent ("Cell (<classification>)") is rewritten with the new class.
+'''
+
+# Object types reclassified (other rows, e.g. spots and clusters, are children)
+CELL_OBJECT_TYPES = ("Cell", "PathCellObject")
+
+
+def rule_columns(rules):
+    """
+    Returns the measurement columns the rules read, in first-use order.
+    """
+    columns = []
+
+    def visit(rule):
+        if "column" in rule:
+            columns.append(rule["column"])
+        for part in rule.get("all", []) + rule.get("any", []):
+            visit(part)
+        if "not" in rule:
+            visit(rule["not"])
+    for rule in rules.values():
+        visit(rule)
+    return list(dict.fromkeys(columns))
+
+
+def marker_positive(frame, rule):
+    """
+    Returns True for the rows of frame that are positive under a rule.
+    """
+    if "all" in rule:
+        return np.logical_and.reduce([marker_positive(frame, part) for part in rule["all"]])
+    if "any" in rule:
+        return np.logical_or.reduce([marker_positive(frame, part) for part in rule["any"]])
+    if "not" in rule:
+        return ~marker_positive(frame, rule["not"])
+    values = pd.to_numeric(frame[rule["column"]], errors="coerce").to_numpy(dtype=np.float64)
+    with np.errstate(invalid="ignore"):
+        return values >= rule["threshold"] if rule.get("inclusive") else values > rule["threshold"]
+
+
+def class_labels(markers):
+    """
+    Returns the composite label of every class code (bit i set = marker i positive).
+    """
+    return [": ".join(f"{marker}_{'Pos' if code >> i & 1 else 'Neg'}" for i, marker in enumerate(markers))
+            for code in range(2 ** len(markers))]
+
+
+def classify(frame, rules):
+    """
+    Returns the composite classification of every row of frame under the rules.
+
+    Returns:
+        pd.Categorical: One label per row (categories: every combination of the markers).
+    """
+    markers = list(rules)
+    codes = np.zeros(len(frame), dtype=np.int64)
+    for bit, marker in enumerate(markers):
+        codes |= marker_positive(frame, rules[marker]).astype(np.int64) << bit
+    return pd.Categorical.from_codes(codes, categories=class_labels(markers))
+
+
+def cell_rows(det_data, class_column="Classification"):
+    """
+    Returns True for the cell rows of a detection export (by Object type when exported,
+    else the rows that have a classification).
+    """
+    if "Object type" in det_data.columns:
+        return det_data["Object type"].astype(str).isin(CELL_OBJECT_TYPES).to_numpy()
+    return det_data[class_column].notna().to_numpy()
+
+
+def reclassify(det_data, rules, class_column="Classification", update_children=True):
+    """
+    Returns a copy of a detection export with the cells reclassified under the rules.
+
+    Parameters:
+        det_data (pd.DataFrame): Detection export (cells and, optionally, their child rows).
+        rules (dict): Marker -> positivity rule (see the module docstring).
+        class_column (str): Classification column to overwrite.
+        update_children (bool): Rewrite the Parent of child rows to the new cell classes.
+
+    Returns:
+        pd.DataFrame: Same rows; class_column (categorical) holds the new labels for cell
+        rows and stays empty for the others.
+    """
+    is_cell = cell_rows(det_data, class_column)
+    cells = det_data[is_cell]
+    labels = classify(cells, rules)
+
+    result = det_data.copy()
+    new_classes = pd.Categorical.from_codes(np.full(len(det_data), -1), categories=labels.categories)
+    new_classes[is_cell] = labels
+    result[class_column] = new_classes
+
+    if update_children and "Parent" in det_data.columns and not is_cell.all():
+        children = det_data[~is_cell]
+        parents = HierarchyIndex(cells, class_column).locate(children)
+        found = parents >= 0
+        new_names = parent_labels(result[is_cell], class_column).to_numpy()
+        parent = det_data["Parent"].astype(object).to_numpy().copy()
+        child_positions = np.flatnonzero(~is_cell)
+        parent[child_positions[found]] = new_names[parents[found]]
+        result["Parent"] = pd.Categorical(parent)
+    return result
+
+
+def reclassify_export(file_path, rules, columns=None, class_column="Classification"):
+    """
+    Reads one detection export (from the columnar cache) and reclassifies its cells.
+
+    Parameters:
+        columns (list): Columns to keep besides the ones the rules and the hierarchy need
+            (default: all).
+    """
+    det_data = read_export(file_path)
+    if columns is not None:
+        keep = list(columns) + rule_columns(rules) + [
+            class_column, "Object type", "Object ID", "Parent", "Parent ID", "Name", "Image",
+            "Centroid X µm", "Centroid Y µm"]
+        det_data = det_data[[column for column in dict.fromkeys(keep) if column in det_data.columns]]
+    return reclassify(det_data, rules, class_column)
+
+
+def class_changes(before, after):
+    """
+    Returns the counts of cells per (old class, new class).
+    """
+    table = pd.crosstab(pd.Series(np.asarray(before, dtype=object), name="Before").fillna("Unclassified"),
+                        pd.Series(np.asarray(after, dtype=object), name="After").fillna("Unclassified"))
+    return table.stack().rename("Cells").reset_index().query("Cells > 0")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reclassify the cells of detection exports with new rules.")
+    parser.add_argument("rules", help="Rules (JSON): marker -> positivity rule")
+    parser.add_argument("detections", help="Directory of detection exports")
+    parser.add_argument("--output", help="Write the class changes (per export) to this CSV file")
+    args = parser.parse_args()
+
+    with open(args.rules, encoding="utf-8") as file:
+        rules = json.load(file)
+    changes = []
+    for file in list_exports(args.detections):
+        det_data = read_export(os.path.join(args.detections, file))
+        is_cell = cell_rows(det_data)
+        new_classes = classify(det_data[is_cell], rules)
+        changes.append(class_changes(det_data["Classification"][is_cell], new_classes).assign(Sample=file))
+    changes = pd.concat(changes, ignore_index=True) if changes else pd.DataFrame(columns=["Before", "After", "Cells", "Sample"])
+    print(changes.groupby(["Before", "After"], as_index=False)["Cells"].sum().to_string(index=False))
+    if args.output:
+        changes.to_csv(args.output, index=False)
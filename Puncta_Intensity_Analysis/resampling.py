@@ -0,0 +1,377 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+from parallel_processing import N_WORKERS
+
+'''
+Permutation tests and bootstrap confidence intervals for two-group comparisons
+(e.g. OPRM1 intensity or puncta counts of VGAT+ vs VGLUT2+ cells).
+
+Both groups are sorted once. A batch of resamples is then drawn as a whole and every
+statistic is computed for all rows of the batch with array operations:
+    - discrete data (few unique values, e.g. spot counts): a resample is a row of counts
+      per unique value, drawn directly from the hypergeometric (permutation) or multinomial
+      (bootstrap) distribution.
+    - continuous data, permutations: a row is a mask over the pooled cells in sorted
+      order (the k smallest of one random key per cell); the sums and the rank sum behind
+      Cliff's delta are one matrix product with the mask, the quantiles are located from
+      per-block counts of the mask.
+    - continuous data, bootstrap: each group is resampled as counts over its own sorted
+      values; quantiles come from the cumulative counts.
+
+Batches are spread over worker processes. Each batch gets its own child of one seed
+(np.random.SeedSequence), so the results depend only on the seed, not on the number of
+workers. Scripts that use more than one worker must run under if __name__ == "__main__".
+
+Statistics (group A minus group B):
+    "mean"          difference of the means
+    "median"        difference of the medians
+    a number q      difference of the q-quantiles (0 < q < 1, linear interpolation)
+    "cohens_d"      mean difference / pooled standard deviation
+    "cliffs_delta"  P(A > B) - P(A < B)
+'''
+
+DEFAULT_STATISTICS = ("mean", "median", 0.25, 0.75, "cohens_d", "cliffs_delta")
+
+# Values (cells or unique values) per resample batch, bounds the memory of one batch
+BATCH_ELEMENTS = 2 ** 21
+
+# Cells per block when locating order statistics of permuted groups
+BLOCK_SIZE = 256
+
+# Relative tolerance when counting null statistics at least as extreme as the observed one
+P_VALUE_TOLERANCE = 1e-12
+
+_worker_data = {}
+
+
+def statistic_name(statistic):
+    """
+    Returns the label of a statistic in the results table.
+    """
+    if not isinstance(statistic, str):
+        return f"{statistic * 100:g}th percentile difference"
+    return {
+        "mean": "Mean difference",
+        "median": "Median difference",
+        "cohens_d": "Cohen's d",
+        "cliffs_delta": "Cliff's delta",
+    }[statistic]
+
+
+def _support(values_a, values_b, shift):
+    # Sorted values of both groups with what the count-based statistics need: centered values
+    # for the sums and, for every value of A, how many values of B lie below / not above it
+    return {
+        "values_a": values_a,
+        "values_b": values_b,
+        "moments_a": np.column_stack([values_a - shift, (values_a - shift) ** 2]),
+        "moments_b": np.column_stack([values_b - shift, (values_b - shift) ** 2]),
+        "below": np.searchsorted(values_b, values_a, side="left"),
+        "not_above": np.searchsorted(values_b, values_a, side="right"),
+        # Whether any value occurs in both groups (else below == not_above)
+        "shared": bool(np.intersect1d(values_a, values_b).size),
+    }
+
+
+def _prepare(a, b, statistics):
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    a, b = a[~np.isnan(a)], b[~np.isnan(b)]
+    if len(a) < 2 or len(b) < 2:
+        raise ValueError("Each group needs at least two values")
+    for statistic in statistics:
+        if isinstance(statistic, str):
+            statistic_name(statistic)
+        elif not 0 < statistic < 1:
+            raise ValueError(f"Quantiles must be between 0 and 1, got {statistic}")
+
+    n_a, n_b = len(a), len(b)
+    pooled = np.sort(np.concatenate([a, b]))
+    # Centering keeps the sums of squares accurate (variance is shift invariant)
+    shift = pooled.mean()
+    values, pooled_ids, counts = np.unique(pooled, return_inverse=True, return_counts=True)
+    values_a, counts_a = np.unique(a, return_counts=True)
+    values_b, counts_b = np.unique(b, return_counts=True)
+    quantiles = sorted({0.5 if statistic == "median" else statistic
+                        for statistic in statistics if not isinstance(statistic, str) or statistic == "median"})
+
+    data = {
+        "n_a": n_a,
+        "n_b": n_b,
+        "statistics": list(statistics),
+        "quantiles": quantiles,
+        # Few unique values (discrete data): draw counts per value instead of per cell
+        "by_value": len(values) * 16 <= n_a + n_b,
+        # Counts over the pooled unique values (observed statistics, discrete resamples)
+        "pooled": _support(values, values, shift),
+        "pooled_counts_a": np.bincount(np.searchsorted(values, values_a), counts_a, len(values)).astype(np.int64),
+        "pooled_counts_b": np.bincount(np.searchsorted(values, values_b), counts_b, len(values)).astype(np.int64),
+        # Counts over each group's own values (continuous bootstrap)
+        "own": _support(values_a, values_b, shift),
+        "own_counts_a": counts_a,
+        "own_counts_b": counts_b,
+        "own_ids_a": np.repeat(np.arange(len(values_a)), counts_a),
+        "own_ids_b": np.repeat(np.arange(len(values_b)), counts_b),
+    }
+    if not data["by_value"]:
+        # Every cell in pooled sorted order (continuous permutations), padded to whole blocks
+        midranks = np.cumsum(counts) - (counts - 1) / 2
+        moments = np.column_stack([pooled - shift, (pooled - shift) ** 2, midranks[pooled_ids]])
+        data["cells"] = {
+            "values": pooled,
+            "moments": moments,
+            "total_moments": moments.sum(axis=0),
+            "n_blocks": -(-len(pooled) // BLOCK_SIZE),
+        }
+    return data
+
+
+def _row_counts(ids, rows, n_values):
+    # Counts per value of every row of a (rows, k) array of value ids
+    offsets = np.arange(rows)[:, None] * n_values
+    return np.bincount((ids + offsets).ravel(), minlength=rows * n_values).reshape(rows, n_values)
+
+
+def _quantile_ranks(n, quantiles):
+    # Ranks and weights for linear interpolation between closest ranks (as np.percentile)
+    position = np.asarray(quantiles) * (n - 1)
+    lower = np.floor(position).astype(np.int64)
+    upper = np.minimum(lower + 1, n - 1)
+    return np.concatenate([lower, upper]), position - lower
+
+
+def _interpolate(at_ranks, fraction):
+    low, high = np.hsplit(at_ranks, 2)
+    return low + (high - low) * fraction
+
+
+def _count_quantiles(cumulative, n, quantiles, values):
+    # Quantiles of every row from its cumulative counts over the sorted values; one
+    # searchsorted per row avoids building another (rows, values) array
+    ranks, fraction = _quantile_ranks(n, quantiles)
+    ids = np.empty((len(cumulative), len(ranks)), dtype=np.intp)
+    for row, row_cumulative in enumerate(cumulative):
+        ids[row] = np.searchsorted(row_cumulative, ranks, side="right")
+    return _interpolate(values[ids], fraction)
+
+
+def count_statistics(data, counts_a, counts_b, support="pooled"):
+    """
+    Computes the requested statistics for rows of counts over the sorted values.
+
+    Parameters:
+        data (dict): Prepared groups (see _prepare).
+        counts_a, counts_b (np.ndarray): (rows, values) counts of both groups.
+        support (str): "pooled" (counts over the pooled unique values) or "own" (counts over
+            each group's own unique values).
+
+    Returns:
+        np.ndarray: (rows, statistics) array.
+    """
+    n_a, n_b = data["n_a"], data["n_b"]
+    values = data[support]
+    parts = {
+        "sums_a": counts_a @ values["moments_a"],
+        "sums_b": counts_b @ values["moments_b"],
+    }
+
+    cumulative_b = np.cumsum(counts_b, axis=1)
+    if data["quantiles"]:
+        parts["quantiles_a"] = _count_quantiles(np.cumsum(counts_a, axis=1), n_a, data["quantiles"], values["values_a"])
+        parts["quantiles_b"] = _count_quantiles(cumulative_b, n_b, data["quantiles"], values["values_b"])
+
+    if "cliffs_delta" in data["statistics"]:
+        # Pairs with B below minus pairs with B above every value of A
+        padded = np.concatenate([np.zeros((len(counts_b), 1), dtype=cumulative_b.dtype), cumulative_b], axis=1)
+        if values["shared"]:
+            below_plus_not_above = padded[:, values["below"]] + padded[:, values["not_above"]]
+        else:
+            below_plus_not_above = 2 * padded[:, values["below"]]
+        parts["cliffs_delta"] = (np.einsum("ij,ij->i", counts_a, below_plus_not_above, dtype=np.float64)
+                                 - n_a * n_b) / (n_a * n_b)
+    return _finish(data, parts)
+
+
+def _finish(data, parts):
+    # Statistics from the group sums (of centered values and their squares), quantiles and
+    # Cliff's delta of every row
+    n_a, n_b = data["n_a"], data["n_b"]
+    sums_a, sums_b = parts["sums_a"], parts["sums_b"]
+    mean_difference = sums_a[:, 0] / n_a - sums_b[:, 0] / n_b
+    ss = sums_a[:, 1] - sums_a[:, 0] ** 2 / n_a + sums_b[:, 1] - sums_b[:, 0] ** 2 / n_b
+    pooled_sd = np.sqrt(np.maximum(ss, 0) / (n_a + n_b - 2))
+
+    columns = {"mean": mean_difference, "cliffs_delta": parts.get("cliffs_delta")}
+    with np.errstate(divide="ignore", invalid="ignore"):
+        columns["cohens_d"] = np.where(pooled_sd > 0, mean_difference / pooled_sd, np.nan)
+    for i, q in enumerate(data["quantiles"]):
+        columns[q] = parts["quantiles_a"][:, i] - parts["quantiles_b"][:, i]
+    if 0.5 in columns:
+        columns["median"] = columns[0.5]
+    return np.column_stack([columns[statistic] for statistic in data["statistics"]])
+
+
+def _block_order_statistics(mask, block_counts, ranks):
+    """
+    Positions of the cells with the given 0-based ranks among the True cells of every row.
+
+    The block holding a rank is found from the cumulative block counts; only that block of
+    the mask is then scanned.
+    """
+    rows = len(mask)
+    cumulative = np.cumsum(block_counts, axis=1)
+    blocks = np.empty((rows, len(ranks)), dtype=np.intp)
+    for row, row_cumulative in enumerate(cumulative):
+        blocks[row] = np.searchsorted(row_cumulative, ranks, side="right")
+    before = np.take_along_axis(cumulative, blocks, axis=1) - np.take_along_axis(block_counts, blocks, axis=1)
+
+    starts = blocks * BLOCK_SIZE
+    segments = mask[np.arange(rows)[:, None, None], starts[:, :, None] + np.arange(BLOCK_SIZE)]
+    within = np.argmax(np.cumsum(segments, axis=2) > (ranks - before)[:, :, None], axis=2)
+    return starts + within
+
+
+def permutation_statistics(data, rng, rows):
+    """
+    Statistics of rows random relabelings of the pooled cells (group sizes kept).
+    """
+    n_a, n_b = data["n_a"], data["n_b"]
+    if data["by_value"]:
+        counts_a = rng.multivariate_hypergeometric(data["pooled_counts_a"] + data["pooled_counts_b"], n_a, size=rows)
+        counts_b = data["pooled_counts_a"] + data["pooled_counts_b"] - counts_a
+        return count_statistics(data, counts_a, counts_b)
+
+    cells = data["cells"]
+    n = n_a + n_b
+    # Draw the cells of the smaller group: the k smallest of one random key per cell
+    k = min(n_a, n_b)
+    padded = cells["n_blocks"] * BLOCK_SIZE
+    keys = rng.random((rows, n), dtype=np.float32)
+    kth = np.partition(keys, k - 1, axis=1)[:, k - 1]
+    mask = np.zeros((rows, padded), dtype=bool)
+    mask[:, :n] = keys <= kth[:, None]
+    # Keys tied with the k-th one: drop random ones until exactly k cells are drawn
+    for row in np.flatnonzero(np.count_nonzero(mask, axis=1) != k):
+        tied = np.flatnonzero(keys[row] == kth[row])
+        mask[row, rng.choice(tied, len(tied) - (k - np.count_nonzero(keys[row] < kth[row])), replace=False)] = False
+    if k != n_a:
+        mask[:, :n] = ~mask[:, :n]
+
+    # Sums of the centered values, their squares and the midranks of A in one product
+    sums_a = mask[:, :n] @ cells["moments"]
+    sums_b = cells["total_moments"] - sums_a
+    parts = {"sums_a": sums_a[:, :2], "sums_b": sums_b[:, :2]}
+    # Mann-Whitney U of A from its rank sum; Cliff's delta = 2U / (n_a n_b) - 1
+    parts["cliffs_delta"] = 2 * (sums_a[:, 2] - n_a * (n_a + 1) / 2) / (n_a * n_b) - 1
+
+    if data["quantiles"]:
+        block_size = np.full(cells["n_blocks"], BLOCK_SIZE)
+        block_size[-1] -= padded - n
+        counts_a = mask.reshape(rows, -1, BLOCK_SIZE).sum(axis=2)
+        for group, group_mask, block_counts, group_n in (
+            ("a", mask, counts_a, n_a),
+            ("b", ~mask, block_size - counts_a, n_b),
+        ):
+            ranks, fraction = _quantile_ranks(group_n, data["quantiles"])
+            positions = _block_order_statistics(group_mask, block_counts, ranks)
+            parts[f"quantiles_{group}"] = _interpolate(cells["values"][positions], fraction)
+    return _finish(data, parts)
+
+
+def bootstrap_statistics(data, rng, rows):
+    """
+    Statistics of rows bootstrap resamples (each group drawn with replacement from itself).
+    """
+    if data["by_value"]:
+        counts = [rng.multinomial(data[f"n_{group}"], data[f"pooled_counts_{group}"] / data[f"n_{group}"], size=rows)
+                  for group in ("a", "b")]
+        return count_statistics(data, counts[0], counts[1])
+
+    counts = []
+    for group in ("a", "b"):
+        n, n_values = data[f"n_{group}"], len(data[f"own_counts_{group}"])
+        picked = rng.integers(0, n, size=(rows, n))
+        # Cells with tied values share one value id
+        ids = data[f"own_ids_{group}"][picked] if n_values < n else picked
+        counts.append(_row_counts(ids, rows, n_values))
+    return count_statistics(data, counts[0], counts[1], support="own")
+
+
+def _set_worker_data(data):
+    _worker_data.clear()
+    _worker_data.update(data)
+
+
+def _resample_batch(task):
+    """
+    Draws one batch of permutations or bootstrap resamples and returns their statistics.
+
+    Parameters:
+        task (tuple): ("permutation" or "bootstrap", np.random.SeedSequence, rows).
+    """
+    kind, seed_sequence, rows = task
+    rng = np.random.default_rng(seed_sequence)
+    if kind == "permutation":
+        return kind, permutation_statistics(_worker_data, rng, rows)
+    return kind, bootstrap_statistics(_worker_data, rng, rows)
+
+
+def compare_groups(a, b, statistics=DEFAULT_STATISTICS, n_resamples=10000, confidence=0.95,
+                   seed=0, n_workers=N_WORKERS, batch_size=None, permutation=True, bootstrap=True):
+    """
+    Permutation tests and percentile bootstrap confidence intervals for group A vs group B.
+
+    Parameters:
+        a, b (array-like): Values of the two groups (NaNs are dropped).
+        statistics (list): Statistics to compute (see the module docstring).
+        n_resamples (int): Number of permutations and of bootstrap resamples.
+        confidence (float): Confidence level of the bootstrap intervals.
+        seed (int): Seed of all resamples.
+        n_workers (int): Worker processes (1 runs everything in the current process).
+        batch_size (int): Resamples per batch (default: about BATCH_ELEMENTS values per batch).
+        permutation (bool): Run the permutation tests.
+        bootstrap (bool): Compute the bootstrap intervals.
+
+    Returns:
+        pd.DataFrame: One row per statistic with the observed value, the two-sided
+        permutation p-value and the bootstrap interval.
+    """
+    data = _prepare(a, b, statistics)
+    observed = count_statistics(data, data["pooled_counts_a"][None, :], data["pooled_counts_b"][None, :])[0]
+
+    if batch_size is None:
+        per_row = len(data["pooled"]["values_a"]) if data["by_value"] else data["n_a"] + data["n_b"]
+        batch_size = max(1, min(1024, BATCH_ELEMENTS // per_row))
+    n_batches = -(-n_resamples // batch_size)
+    kinds = [kind for kind, wanted in (("permutation", permutation), ("bootstrap", bootstrap)) if wanted]
+    tasks = []
+    for kind, kind_seed in zip(kinds, np.random.SeedSequence(seed).spawn(len(kinds))):
+        for i, batch_seed in enumerate(kind_seed.spawn(n_batches)):
+            tasks.append((kind, batch_seed, min(batch_size, n_resamples - i * batch_size)))
+
+    if n_workers is None or n_workers <= 1 or len(tasks) <= 1:
+        _set_worker_data(data)
+        batches = list(map(_resample_batch, tasks))
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_set_worker_data, initargs=(data,)) as executor:
+            batches = list(executor.map(_resample_batch, tasks))
+    resampled = {kind: np.concatenate([result for batch_kind, result in batches if batch_kind == kind])
+                 for kind in kinds}
+
+    results = pd.DataFrame({
+        "Statistic": [statistic_name(statistic) for statistic in data["statistics"]],
+        "Observed": observed,
+    })
+    if permutation:
+        null = resampled["permutation"]
+        extreme = np.abs(null) >= np.abs(observed) * (1 - P_VALUE_TOLERANCE)
+        results["Permutation p-value"] = (extreme.sum(axis=0) + 1) / (len(null) + 1)
+    if bootstrap:
+        alpha = (1 - confidence) / 2
+        low, high = np.nanquantile(resampled["bootstrap"], [alpha, 1 - alpha], axis=0)
+        results[f"CI {confidence:.0%} low"] = low
+        results[f"CI {confidence:.0%} high"] = high
+    results["Resamples"] = n_resamples
+    return results
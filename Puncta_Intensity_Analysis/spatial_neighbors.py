@@ -0,0 +1,215 @@
+import argparse
+import os
+from functools import partial
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from hierarchy_join import CENTROID_COLUMNS, IMAGE_COLUMN
+from parallel_processing import N_WORKERS, run_per_file
+from qupath_io import list_exports, read_export
+from reclassification import cell_rows
+
+'''
+Spatial neighborhood composition of cells from the detection centroids: for every cell, the
+classes of its k nearest neighbors or of all neighbors within a radius (µm), aggregated per
+sample and cell type, e.g. the fraction of vglut2+ cells around vgat+: oprm1+ cells.
+
+Neighbors are counted per classification label (the labels are disjoint; cells of other
+labels count as neighbors too, in one "other" column), with one KD-tree per image. k nearest
+neighbors come from one batched tree query; radius neighbors from one query for all close
+pairs, so there is no per-cell Python loop. Per-cell counts are built with np.bincount on
+(cell, neighbor label) codes, and cell types (sets of labels, which may overlap, e.g.
+"vglut2+" = every vglut2_Pos label) are sums of label columns.
+
+Tables are tidy, one row per sample, cell type and neighbor type:
+
+    Sample, Cell Type, Neighbor Type, Cells, Sample Cells, Cells With Neighbors,
+    Mean Neighbors, Mean Neighbor Count, Mean Fraction, Expected Fraction, Enrichment
+
+Mean Fraction is the mean over the cells of the type (with at least one neighbor) of the
+share of their neighbors that are of the neighbor type; Expected Fraction is the share of
+the neighbor type among all cells of the sample, and Enrichment their ratio (> 1: the neighbor
+type is over-represented around the cell type). Sample Cells, the number of cells of the
+sample, weights the expected fractions when samples are pooled.
+
+    python spatial_neighbors.py <detections> --k 10 \
+        --cell-type "vgat+: oprm1+" "vgat_Pos: oprm1_Pos" \
+        --cell-type "vgat+" "vgat_Pos" "vgat_Pos: oprm1_Pos" "vgat_Pos: oprm1_Neg"
+'''
+
+# Columns of the composition tables
+COMPOSITION_COLUMNS = ["Sample", "Cell Type", "Neighbor Type", "Cells", "Sample Cells", "Cells With Neighbors",
+                       "Mean Neighbors", "Mean Neighbor Count", "Mean Fraction", "Expected Fraction", "Enrichment"]
+
+DEFAULT_K = 10
+
+
+def neighbor_counts(points, codes, n_classes, k=None, radius=None):
+    """
+    Counts the neighbors of every point per class, within one image.
+
+    Parameters:
+        points (np.ndarray): [n, 2] centroids (µm).
+        codes (np.ndarray): Class code of every point (negative = not counted as a neighbor).
+        n_classes (int): Number of classes.
+        k (int): Number of nearest neighbors (the point itself excluded).
+        radius (float): Neighbors within this distance (used when given, instead of k).
+
+    Returns:
+        np.ndarray: [n, n_classes] neighbor counts.
+    """
+    n = len(points)
+    if n < 2:
+        return np.zeros((n, n_classes), dtype=np.int64)
+    tree = cKDTree(points)
+    if radius is not None:
+        pairs = tree.query_pairs(radius, output_type="ndarray")
+        first, second = pairs[:, 0], pairs[:, 1]
+        centers = np.concatenate([first, second])
+        neighbors = np.concatenate([second, first])
+    else:
+        k = min(k or DEFAULT_K, n - 1)
+        _, nearest = tree.query(points, k=k + 1, workers=-1)
+        nearest = nearest.reshape(n, k + 1)
+        # Drop the point itself (not always in the first column when centroids coincide)
+        keep = nearest != np.arange(n)[:, None]
+        keep[keep.all(axis=1), -1] = False
+        neighbors = nearest[keep]
+        centers = np.repeat(np.arange(n), k)
+    labelled = codes[neighbors] >= 0
+    counts = np.bincount(centers[labelled] * n_classes + codes[neighbors[labelled]], minlength=n * n_classes)
+    return counts.reshape(n, n_classes)
+
+
+def cell_neighbor_counts(cells, labels, k=None, radius=None, class_column="Classification"):
+    """
+    Counts the neighbors of every cell per classification label, one KD-tree per image.
+
+    Parameters:
+        cells (pd.DataFrame): Cell rows with the centroid columns (and "Image" for exports
+            of several images).
+        labels (list): Classification labels counted one by one.
+
+    Returns:
+        np.ndarray: [cells, labels + 1] neighbor counts, in the row order of cells; the last
+        column counts the neighbors with any other label.
+    """
+    codes = pd.Index(labels).get_indexer(cells[class_column].astype(object))
+    codes[codes < 0] = len(labels)
+    points = cells[list(CENTROID_COLUMNS)].to_numpy(dtype=np.float64)
+    counts = np.zeros((len(cells), len(labels) + 1), dtype=np.int64)
+    if IMAGE_COLUMN in cells.columns:
+        image_codes, images = pd.factorize(cells[IMAGE_COLUMN])
+    else:
+        image_codes, images = np.zeros(len(cells), dtype=np.intp), [None]
+    for image in range(len(images)):
+        rows = np.flatnonzero(image_codes == image) if len(images) > 1 else np.arange(len(cells))
+        valid = rows[~np.isnan(points[rows]).any(axis=1)]
+        counts[valid] = neighbor_counts(points[valid], codes[valid], len(labels) + 1, k, radius)
+    return counts
+
+
+def composition_table(sample, cell_labels, counts, labels, cell_types):
+    """
+    Aggregates per-cell neighbor counts of one sample per cell type and neighbor type.
+
+    Parameters:
+        sample (str): Sample name.
+        cell_labels (array-like): Classification label of every cell.
+        counts (np.ndarray): [cells, labels + 1] neighbor counts (cell_neighbor_counts).
+        labels (list): Labels of the count columns.
+        cell_types (dict): Cell type -> labels; used for the centers and the neighbors.
+
+    Returns:
+        pd.DataFrame: One row per cell type and neighbor type (COMPOSITION_COLUMNS).
+    """
+    cell_labels = np.asarray(cell_labels, dtype=object)
+    label_position = {label: i for i, label in enumerate(labels)}
+    type_counts = {name: counts[:, [label_position[label] for label in type_labels if label in label_position]].sum(axis=1)
+                   for name, type_labels in cell_types.items()}
+    total = counts.sum(axis=1)
+    is_type = {name: np.isin(cell_labels, type_labels) for name, type_labels in cell_types.items()}
+    records = []
+    for cell_type, centers in is_type.items():
+        with_neighbors = centers & (total > 0)
+        for neighbor_type, neighbor_count in type_counts.items():
+            expected = is_type[neighbor_type].sum() / max(len(cell_labels), 1)
+            fraction = (neighbor_count[with_neighbors] / total[with_neighbors]).mean() if with_neighbors.any() else np.nan
+            records.append((sample, cell_type, neighbor_type, int(centers.sum()), len(cell_labels), int(with_neighbors.sum()),
+                            total[centers].mean() if centers.any() else np.nan,
+                            neighbor_count[centers].mean() if centers.any() else np.nan,
+                            fraction, expected, fraction / expected if expected > 0 else np.nan))
+    return pd.DataFrame(records, columns=COMPOSITION_COLUMNS)
+
+
+def type_labels(cell_types):
+    """
+    Returns every label of the cell types, in first-use order.
+    """
+    return list(dict.fromkeys(label for labels in cell_types.values() for label in labels))
+
+
+def export_composition(det_data, sample, cell_types, k=None, radius=None, class_column="Classification"):
+    """
+    Neighborhood composition table of one detection export.
+    """
+    cells = det_data[cell_rows(det_data, class_column)]
+    labels = type_labels(cell_types)
+    counts = cell_neighbor_counts(cells, labels, k, radius, class_column)
+    return composition_table(sample, cells[class_column].astype(object).to_numpy(), counts, labels, cell_types)
+
+
+def pooled_composition(table):
+    """
+    Pools per-sample composition tables over the samples: means are weighted by the cells
+    they were taken over, and the expected fraction is the share of the neighbor type among
+    the cells of all samples.
+    """
+    weighted = table.assign(
+        _neighbors=table["Mean Neighbors"] * table["Cells"],
+        _count=table["Mean Neighbor Count"] * table["Cells"],
+        _fraction=table["Mean Fraction"].fillna(0) * table["Cells With Neighbors"],
+        _expected=table["Expected Fraction"] * table["Sample Cells"],
+    )
+    grouped = weighted.groupby(["Cell Type", "Neighbor Type"], sort=False)
+    pooled = grouped[["Cells", "Sample Cells", "Cells With Neighbors", "_neighbors", "_count", "_fraction",
+                      "_expected"]].sum()
+    with np.errstate(invalid="ignore", divide="ignore"):
+        pooled["Mean Neighbors"] = pooled["_neighbors"] / pooled["Cells"]
+        pooled["Mean Neighbor Count"] = pooled["_count"] / pooled["Cells"]
+        pooled["Mean Fraction"] = pooled["_fraction"] / pooled["Cells With Neighbors"]
+        pooled["Expected Fraction"] = pooled["_expected"] / pooled["Sample Cells"]
+        pooled["Enrichment"] = pooled["Mean Fraction"] / pooled["Expected Fraction"]
+    return pooled.reset_index().assign(Sample="All")[COMPOSITION_COLUMNS]
+
+
+def _composition_of(detections, cell_types, k, radius, class_column, file):
+    # Composition table of one export (run in a worker process)
+    det_data = read_export(os.path.join(detections, file))
+    return export_composition(det_data, file.replace(" Detections", ""), cell_types, k, radius, class_column)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Neighborhood composition of cell types from detection centroids.")
+    parser.add_argument("detections", help="Directory of detection exports")
+    parser.add_argument("--cell-type", nargs="+", action="append", required=True, metavar=("NAME", "LABEL"),
+                        help="Cell type name followed by its class labels (repeatable)")
+    parser.add_argument("--k", type=int, default=DEFAULT_K, help="Nearest neighbors per cell")
+    parser.add_argument("--radius", type=float, help="Count all neighbors within this distance (µm) instead")
+    parser.add_argument("--class-column", default="Classification", help="Column of the class labels")
+    parser.add_argument("--output", default="neighborhood_composition.csv", help="Per-sample table (CSV)")
+    parser.add_argument("--workers", type=int, default=N_WORKERS, help="Worker processes (1 = serial)")
+    args = parser.parse_args()
+
+    cell_types = {cell_type[0]: cell_type[1:] for cell_type in args.cell_type}
+    files = list_exports(args.detections)
+    tables = [table for table in run_per_file(partial(_composition_of, args.detections, cell_types, args.k,
+                                                      args.radius, args.class_column), files, n_workers=args.workers)
+              if table is not None]
+    table = pd.concat(tables, ignore_index=True) if tables else pd.DataFrame(columns=COMPOSITION_COLUMNS)
+    table.to_csv(args.output, index=False)
+    pooled = pooled_composition(table)
+    pooled.to_csv(args.output.replace(".csv", "_pooled.csv"), index=False)
+    print(pooled.to_string(index=False))
+    print(f"Neighborhood composition of {len(tables)} samples saved to {args.output}")
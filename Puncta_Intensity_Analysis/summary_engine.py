@@ -0,0 +1,142 @@
+import numpy as np
+import pandas as pd
+
+from qupath_io import ClassIndex
+
+'''
+Vectorized per-sample summary tables (the DataDraft tables of the txt_to_cell_analysis pipelines).
+
+Instead of masking each detection table once per cell population and writing the results
+cell by cell, the detections of all samples are concatenated once, every row is tagged with
+its cell population, and counts, areas, mean intensities and subcellular sums come out of
+one grouped aggregation over (Sample, population). The result is pivoted back to the wide
+column layout the pipelines have always written:
+
+    "<population> Cell Density (cells/mm^2)", "<population> Cell Count",
+    "<population> Cell Area (mm^2)", "<population> Cell Percentage", "<population> Intensity",
+    ..., "Total Cell Area (mm^2)", ["Total Cell Count",] "Total Annotation Area (mm^2)",
+    "<subcellular metric> (<classification>)", ...
+'''
+
+AREA_COLUMN = "Cell: Area µm^2"
+CLASS_COLUMN = "Classification"
+
+
+def detection_columns(cell_groups, subcellular_metrics=()):
+    """
+    Returns the detection columns the summary needs, so workers can drop everything else.
+    """
+    columns = [CLASS_COLUMN, AREA_COLUMN]
+    for group in cell_groups.values():
+        if group.get("intensity") and group["intensity"] not in columns:
+            columns.append(group["intensity"])
+    return columns + [metric for metric in subcellular_metrics if metric not in columns]
+
+
+def annotation_area(ano_data):
+    """
+    Returns the total area (mm^2) of the real annotation objects in an annotation export.
+    """
+    real_annotations = ano_data[ano_data["Object type"].isin(["Annotation", "PathAnnotationObject"])]
+    return real_annotations["Area µm^2"].sum() / 1e6 if not real_annotations.empty else 0
+
+
+def summarize_samples(samples, cell_groups, subcellular_classes=(), subcellular_metrics=(),
+                      area_groups=None, count_groups=None, include_total_count=False):
+    """
+    Builds the wide per-sample summary table in one grouped pass.
+
+    Parameters:
+        samples (list): (sample name, detection DataFrame, annotation area in mm^2) tuples.
+        cell_groups (dict): Column prefix -> {"labels": [classifications], "intensity": column or None}.
+        subcellular_classes (list): Classifications whose subcellular metrics are summed.
+        subcellular_metrics (list): Subcellular measurement columns to sum.
+        area_groups (list): Prefixes whose areas make up "Total Cell Area" (default: all groups).
+        count_groups (list): Prefixes whose counts are the denominator of the percentages
+            (default: all groups).
+        include_total_count (bool): Also write a "Total Cell Count" column.
+
+    Returns:
+        pd.DataFrame: One row per sample, in input order.
+    """
+    area_groups = list(cell_groups) if area_groups is None else list(area_groups)
+    count_groups = list(cell_groups) if count_groups is None else list(count_groups)
+    sample_names = [name for name, _, _ in samples]
+    index = pd.Index(sample_names, name="Sample")
+
+    # Which subcellular metrics each sample actually exported (missing ones are reported as None)
+    has_metric = pd.DataFrame(
+        {metric: [metric in det.columns for _, det, _ in samples] for metric in subcellular_metrics},
+        index=index, dtype=bool,
+    )
+
+    # Concatenate once; only rows of a reported classification matter. Rows are picked through
+    # each file's class index and recoded to one shared category list, so the concatenated
+    # Classification column stays categorical
+    group_names = list(cell_groups)
+    label_to_group = {label: prefix for prefix, group in cell_groups.items() for label in group["labels"]}
+    wanted = list(dict.fromkeys(list(label_to_group) + list(subcellular_classes)))
+    frames = []
+    for name, det, _ in samples:
+        det = ClassIndex(det, CLASS_COLUMN).select(wanted)
+        labels = pd.Categorical(det[CLASS_COLUMN].astype(str), categories=wanted)
+        frames.append(det.assign(**{CLASS_COLUMN: labels, "Sample": name}))
+    detections = pd.concat(frames, ignore_index=True, sort=False) if frames else pd.DataFrame({"Sample": []})
+    for column in detection_columns(cell_groups, subcellular_metrics):
+        if column not in detections.columns:
+            detections[column] = np.nan
+    detections[CLASS_COLUMN] = pd.Categorical(detections[CLASS_COLUMN], categories=wanted)
+    detections["Sample"] = pd.Categorical(detections["Sample"], categories=sample_names)
+
+    # Tag every row with its population through the category codes (no string comparisons)
+    code_to_group = np.array(
+        [group_names.index(label_to_group[label]) if label in label_to_group else -1 for label in wanted] + [-1]
+    )
+    group_codes = code_to_group[detections[CLASS_COLUMN].cat.codes.to_numpy()]
+    detections["Group"] = pd.Categorical.from_codes(group_codes, categories=group_names)
+
+    # Per-population counts, areas and mean intensities
+    intensity = np.full(len(detections), np.nan)
+    for i, group in enumerate(cell_groups.values()):
+        if group.get("intensity"):
+            in_group = group_codes == i
+            intensity[in_group] = pd.to_numeric(detections.loc[in_group, group["intensity"]], errors="coerce")
+    detections["_intensity"] = intensity
+
+    grouped = detections.dropna(subset=["Group"]).groupby(["Sample", "Group"], observed=False, sort=False)
+    stats = grouped.agg(count=(AREA_COLUMN, "size"), area=(AREA_COLUMN, "sum"), intensity=("_intensity", "mean"))
+    counts = stats["count"].unstack("Group").reindex(index=index, columns=list(cell_groups)).fillna(0).astype(int)
+    areas = stats["area"].unstack("Group").reindex(index=index, columns=list(cell_groups)).fillna(0) / 1e6
+    intensities = stats["intensity"].unstack("Group").reindex(index=index, columns=list(cell_groups))
+
+    total_area = areas[area_groups].sum(axis=1)
+    total_cells = counts[count_groups].sum(axis=1)
+    density = counts.div(total_area.where(total_area > 0), axis=0)
+    percentage = counts.div(total_cells.where(total_cells > 0), axis=0) * 100
+
+    summary = {"Sample": sample_names}
+    for prefix, group in cell_groups.items():
+        summary[f"{prefix} Cell Density (cells/mm^2)"] = density[prefix].to_numpy()
+        summary[f"{prefix} Cell Count"] = counts[prefix].to_numpy()
+        summary[f"{prefix} Cell Area (mm^2)"] = areas[prefix].to_numpy()
+        summary[f"{prefix} Cell Percentage"] = percentage[prefix].to_numpy()
+        if group.get("intensity"):
+            summary[f"{prefix} Intensity"] = intensities[prefix].to_numpy()
+    summary["Total Cell Area (mm^2)"] = total_area.to_numpy()
+    if include_total_count:
+        summary["Total Cell Count"] = total_cells.to_numpy()
+    summary["Total Annotation Area (mm^2)"] = [area for _, _, area in samples]
+
+    # Subcellular sums per (Sample, Classification)
+    if subcellular_classes and subcellular_metrics:
+        subcellular = detections[detections[CLASS_COLUMN].isin(subcellular_classes)]
+        sums = subcellular.groupby(["Sample", CLASS_COLUMN], observed=False)[list(subcellular_metrics)].sum(min_count=0)
+        for cls in subcellular_classes:
+            if cls in sums.index.get_level_values(CLASS_COLUMN):
+                cls_sums = sums.xs(cls, level=CLASS_COLUMN).reindex(index).fillna(0)
+            else:
+                cls_sums = pd.DataFrame(0, index=index, columns=list(subcellular_metrics))
+            for metric in subcellular_metrics:
+                summary[f"{metric} ({cls})"] = cls_sums[metric].where(has_metric[metric]).to_numpy()
+
+    return pd.DataFrame(summary)
@@ -0,0 +1,180 @@
+import argparse
+import os
+import zlib
+import numpy as np
+import pandas as pd
+
+'''
+Synthetic QuPath detection and annotation exports, for testing and benchmarking the pipelines
+without the imaging data.
+
+Every image gets one annotation export (a square annotation with its area) and one detection
+export with the columns the pipelines read:
+
+    Image, Object ID, Object type, Name, Classification, Parent, ROI, Centroid X µm,
+    Centroid Y µm, Cell: Area µm^2, "<channel>: Cell: Mean" per marker,
+    Subcellular: Channel 2: Num spots estimated / Num single spots / Num clusters,
+    Subcellular cluster: Channel 2: Area / Mean channel intensity
+
+plus, optionally, one child row per spot or cluster (Parent "Cell (<classification>)",
+Parent ID, centroid inside the cell, "Num spots"), whose spot counts add up to the cell's
+"Num spots estimated". Classes are "<marker>_Pos/_Neg" combinations drawn with a given mix;
+positive cells are brighter in the marker's channel, and cells positive for the spot marker
+(the last marker) have more spots. File names follow the CZI scene exports
+("<date>__<slide>.czi - Scene #<n> Detections.txt"), one date per animal:
+
+    python synthetic_exports.py /tmp/synthetic --images 8 --cells 20000
+'''
+
+# Marker -> channel of the default panel (the spot channel belongs to the last marker)
+DEFAULT_MARKERS = {"vgat": "AF647", "oprm1": "AF568"}
+
+# Cells per mm^2 of annotation
+CELL_DENSITY = 1500
+
+# Mean spots per cell for cells negative/positive for the spot marker
+SPOT_RATES = (1.0, 6.0)
+
+# Fraction of a cell's spots that sit in clusters (of at least 2 spots)
+CLUSTERED_FRACTION = 0.3
+
+IMAGES_PER_ANIMAL = 4
+
+
+def class_labels(markers):
+    """
+    Returns every "<marker>_Pos/_Neg: ..." combination of the markers.
+    """
+    labels = [""]
+    for marker in markers:
+        labels = [f"{label}: {marker}_{state}" if label else f"{marker}_{state}"
+                  for label in labels for state in ("Pos", "Neg")]
+    return labels
+
+
+def sample_name(index):
+    """
+    Returns the export name (without " Detections.txt") of the image with this index.
+    """
+    animal, scene = divmod(index, IMAGES_PER_ANIMAL)
+    return f"2024_{1 + animal // 28:02d}_{1 + animal % 28:02d}__Animal{animal}-Slide.czi - Scene #{scene + 1}"
+
+
+def generate_image(rng, image, n_cells, markers=None, class_mix=None, spots=True):
+    """
+    Generates the exports of one image.
+
+    Parameters:
+        rng (np.random.Generator): Random generator.
+        image (str): Image (sample) name.
+        n_cells (int): Number of cells.
+        markers (dict): Marker -> channel (default: DEFAULT_MARKERS).
+        class_mix (dict): Class label -> relative frequency (default: all classes equally).
+        spots (bool): Also generate the child rows of the spots and clusters.
+
+    Returns:
+        tuple: (detection DataFrame, annotation DataFrame).
+    """
+    markers = DEFAULT_MARKERS if markers is None else markers
+    labels = class_labels(markers)
+    mix = np.array([(class_mix or {}).get(label, 0 if class_mix else 1) for label in labels], dtype=np.float64)
+    classification = np.array(labels, dtype=object)[rng.choice(len(labels), n_cells, p=mix / mix.sum())]
+
+    side = np.sqrt(n_cells / CELL_DENSITY) * 1000
+    x, y = rng.uniform(0, side, n_cells), rng.uniform(0, side, n_cells)
+    prefix = f"{zlib.crc32(image.encode('utf-8')):08x}"
+    object_ids = np.char.add(f"{prefix}-", np.arange(n_cells).astype(str)).astype(object)
+    cells = {
+        "Image": image,
+        "Object ID": object_ids,
+        "Object type": "Cell",
+        "Name": np.nan,
+        "Classification": classification,
+        "Parent": "Annotation",
+        "ROI": "Polygon",
+        "Centroid X µm": x,
+        "Centroid Y µm": y,
+        "Cell: Area µm^2": rng.lognormal(np.log(100), 0.35, n_cells),
+    }
+    for marker, channel in markers.items():
+        positive = np.char.find(classification.astype(str), f"{marker}_Pos") >= 0
+        cells[f"{channel}: Cell: Mean"] = np.where(positive, rng.gamma(4, 40, n_cells), rng.gamma(2, 20, n_cells))
+
+    # Spots of the last marker: singles plus clusters of at least 2 spots
+    spot_marker = list(markers)[-1]
+    positive = np.char.find(classification.astype(str), f"{spot_marker}_Pos") >= 0
+    estimated = rng.poisson(np.where(positive, SPOT_RATES[1], SPOT_RATES[0]))
+    clustered = rng.binomial(estimated, CLUSTERED_FRACTION)
+    n_clusters = clustered // 2
+    clustered = np.where(n_clusters > 0, clustered, 0)
+    singles = estimated - clustered
+    cells["Subcellular: Channel 2: Num spots estimated"] = estimated.astype(np.float64)
+    cells["Subcellular: Channel 2: Num single spots"] = singles.astype(np.float64)
+    cells["Subcellular: Channel 2: Num clusters"] = n_clusters.astype(np.float64)
+    cells["Subcellular cluster: Channel 2: Area"] = np.where(n_clusters > 0, rng.gamma(2, 1.5, n_cells) * n_clusters, np.nan)
+    cells["Subcellular cluster: Channel 2: Mean channel intensity"] = np.where(n_clusters > 0, rng.gamma(6, 50, n_cells), np.nan)
+    det = pd.DataFrame(cells)
+
+    if spots:
+        # One row per single spot (1 spot) and per cluster (2 spots, the rest in its first cluster)
+        owner = np.concatenate([np.repeat(np.arange(n_cells), singles), np.repeat(np.arange(n_cells), n_clusters)])
+        n_spots = np.concatenate([np.ones(singles.sum()), np.full(n_clusters.sum(), 2.0)])
+        first_cluster = singles.sum() + np.concatenate([[0], np.cumsum(n_clusters)[:-1]])
+        has_clusters = n_clusters > 0
+        n_spots[first_cluster[has_clusters]] += (clustered - 2 * n_clusters)[has_clusters]
+        radius = np.sqrt(det["Cell: Area µm^2"].to_numpy()[owner] / np.pi) / 2
+        angle = rng.uniform(0, 2 * np.pi, len(owner))
+        children = pd.DataFrame({
+            "Image": image,
+            "Object ID": np.char.add(f"{prefix}-s", np.arange(len(owner)).astype(str)).astype(object),
+            "Object type": "Detection",
+            "Name": np.where(n_spots > 1, "Subcellular cluster: Channel 2", "Subcellular spot: Channel 2"),
+            "Classification": np.nan,
+            "Parent": "Cell (" + classification[owner] + ")",
+            "Parent ID": object_ids[owner],
+            "ROI": "Ellipse",
+            "Centroid X µm": x[owner] + radius * np.cos(angle),
+            "Centroid Y µm": y[owner] + radius * np.sin(angle),
+            "Num spots": n_spots,
+        })
+        det = pd.concat([det, children], ignore_index=True, sort=False)
+
+    ano = pd.DataFrame({
+        "Image": [image], "Object ID": [f"{prefix}-a"], "Object type": ["Annotation"],
+        "Name": ["VP"], "Classification": [np.nan], "Parent": ["Root object"], "ROI": ["Polygon"],
+        "Centroid X µm": [side / 2], "Centroid Y µm": [side / 2], "Num Detections": [n_cells],
+        "Area µm^2": [side ** 2], "Perimeter µm": [4 * side],
+    })
+    return det, ano
+
+
+def write_exports(output_dir, n_images=4, cells_per_image=5000, markers=None, class_mix=None, spots=True, seed=0):
+    """
+    Writes the detection and annotation exports of n_images synthetic images.
+
+    Returns:
+        dict: "raw_detection" and "raw_annotation" directories (as in the panel configs).
+    """
+    paths = {"raw_detection": os.path.join(output_dir, "detections"), "raw_annotation": os.path.join(output_dir, "annotations")}
+    for directory in paths.values():
+        os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    for index in range(n_images):
+        name = sample_name(index)
+        det, ano = generate_image(rng, name, cells_per_image, markers, class_mix, spots)
+        det.to_csv(os.path.join(paths["raw_detection"], f"{name} Detections.txt"), sep="\t", index=False)
+        ano.to_csv(os.path.join(paths["raw_annotation"], f"{name}.txt"), sep="\t", index=False)
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write synthetic QuPath detection and annotation exports.")
+    parser.add_argument("output_dir", help="Directory for the detections and annotations folders")
+    parser.add_argument("--images", type=int, default=4, help="Number of images")
+    parser.add_argument("--cells", type=int, default=5000, help="Cells per image")
+    parser.add_argument("--no-spots", action="store_true", help="Do not write the spot/cluster child rows")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    written = write_exports(args.output_dir, args.images, args.cells, spots=not args.no_spots, seed=args.seed)
+    print(f"{args.images} images with {args.cells} cells each written to {args.output_dir}")
@@ -0,0 +1,249 @@
+import argparse
+import os
+from functools import partial
+import numpy as np
+import pandas as pd
+
+from parallel_processing import N_WORKERS, run_per_file
+from qupath_io import ClassIndex, list_exports, read_export
+from summary_engine import annotation_area
+
+'''
+Threshold sensitivity sweep: positive-cell counts, percentages, densities and mean
+intensities for hundreds of candidate thresholds at once, instead of one pipeline run per
+threshold.
+
+The values of every group (e.g. sample and cell type) are sorted once. For a threshold t the
+positive cells of a group are the tail of its sorted values above t, so their number is the
+group size minus the searchsorted position of t and their summed intensity is a difference
+of the cumulative sum. Every candidate threshold then costs one binary search per group.
+
+Tables are tidy (one row per group and threshold):
+
+    <group columns>, Threshold, Cells, Positive Cells, Positive Percentage,
+    [Positive Density (cells/mm^2),] Mean Positive Intensity
+
+and plot_sensitivity draws the positive percentage and the mean positive intensity against
+the threshold, one line per cell type (median over samples with the interquartile band),
+with reference thresholds (e.g. the current fixed or KDE threshold) marked.
+
+    python threshold_sweep.py <detections> --annotations <annotations> --column "AF568: Cell: Mean" \
+        --cell-type "oprm1+" "vgat_Neg: oprm1_Pos" --cell-type "Double Positive" "vgat_Pos: oprm1_Pos" \
+        --thresholds 0 400 201 --reference 120
+'''
+
+# Columns of the sweep tables after the group columns
+SWEEP_COLUMNS = ["Threshold", "Cells", "Positive Cells", "Positive Percentage", "Mean Positive Intensity"]
+
+DENSITY_COLUMN = "Positive Density (cells/mm^2)"
+
+
+def candidate_thresholds(values=None, start=None, stop=None, num=201, spacing="linear"):
+    """
+    Returns sorted candidate thresholds: num points from start to stop (default: the range
+    of values), evenly spaced ("linear") or at evenly spaced quantiles of values ("quantile").
+    """
+    if spacing == "quantile":
+        values = np.asarray(values, dtype=np.float64)
+        return np.unique(np.nanquantile(values, np.linspace(0, 1, num)))
+    if start is None or stop is None:
+        values = np.asarray(values, dtype=np.float64)
+        start = np.nanmin(values) if start is None else start
+        stop = np.nanmax(values) if stop is None else stop
+    return np.linspace(start, stop, num)
+
+
+def sweep_counts(values, codes, n_groups, thresholds, inclusive=False):
+    """
+    Positive counts and summed positive values of every group at every threshold.
+
+    Parameters:
+        values (array-like): Measurement of every cell (NaNs are left out).
+        codes (array-like): Group code of every cell (negative = no group).
+        n_groups (int): Number of groups.
+        thresholds (array-like): Candidate thresholds.
+        inclusive (bool): Positive means value >= threshold (default: value > threshold).
+
+    Returns:
+        tuple: (cells per group, positive counts [group, threshold], positive sums [group, threshold]).
+    """
+    values = np.asarray(values, dtype=np.float64)
+    codes = np.asarray(codes, dtype=np.intp)
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    valid = ~np.isnan(values) & (codes >= 0)
+    values, codes = values[valid], codes[valid]
+
+    order = np.lexsort((values, codes))
+    sorted_values = values[order]
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=n_groups))])
+    cumulative = np.concatenate([[0.0], np.cumsum(sorted_values)])
+    side = "left" if inclusive else "right"
+
+    positive = np.empty((n_groups, len(thresholds)), dtype=np.int64)
+    sums = np.empty((n_groups, len(thresholds)), dtype=np.float64)
+    for group in range(n_groups):
+        start, end = bounds[group], bounds[group + 1]
+        cut = start + np.searchsorted(sorted_values[start:end], thresholds, side=side)
+        positive[group] = end - cut
+        sums[group] = cumulative[end] - cumulative[cut]
+    return np.diff(bounds), positive, sums
+
+
+def sweep_table(frame, value_column, by, thresholds, areas=None, sample_column="Sample", inclusive=False):
+    """
+    Sweeps the thresholds over the cells of every group of a cell table.
+
+    Parameters:
+        frame (pd.DataFrame): One row per cell with the by columns and value_column.
+        value_column (str): Measurement to threshold.
+        by (list): Group columns (e.g. ["Sample", "Cell Type"] or ["Cell Type"]).
+        thresholds (array-like): Candidate thresholds.
+        areas (dict): Sample -> annotation area (mm^2), for the densities. Groups without
+            the sample column are divided by the total area of all samples.
+
+    Returns:
+        pd.DataFrame: One row per group and threshold (group columns + SWEEP_COLUMNS).
+    """
+    by = list(by)
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    grouped = frame.groupby(by, sort=True, observed=True)
+    codes = grouped.ngroup().to_numpy()
+    keys = grouped.size().index.to_frame(index=False)
+    cells, positive, sums = sweep_counts(frame[value_column].to_numpy(dtype=np.float64), codes, len(keys),
+                                         thresholds, inclusive)
+    return _table(keys, thresholds, cells, positive, sums, areas, sample_column)
+
+
+def _table(keys, thresholds, cells, positive, sums, areas, sample_column):
+    n_thresholds = len(thresholds)
+    table = keys.loc[np.repeat(np.arange(len(keys)), n_thresholds)].reset_index(drop=True)
+    table["Threshold"] = np.tile(thresholds, len(keys))
+    table["Cells"] = np.repeat(cells, n_thresholds)
+    table["Positive Cells"] = positive.ravel()
+    with np.errstate(invalid="ignore", divide="ignore"):
+        table["Positive Percentage"] = 100 * positive.ravel() / table["Cells"].to_numpy()
+        table["Mean Positive Intensity"] = sums.ravel() / positive.ravel()
+        if areas is not None:
+            if sample_column in keys.columns:
+                area = table[sample_column].map(areas).to_numpy(dtype=np.float64)
+            else:
+                area = np.full(len(table), float(sum(areas.values())))
+            table[DENSITY_COLUMN] = np.where(area > 0, positive.ravel() / area, np.nan)
+    columns = list(keys.columns) + SWEEP_COLUMNS[:4] + ([DENSITY_COLUMN] if areas is not None else []) + SWEEP_COLUMNS[4:]
+    return table[columns]
+
+
+def plot_sensitivity(table, output_path, by="Cell Type", sample_column="Sample", reference=None, xlabel="Threshold"):
+    """
+    Plots the positive percentage and the mean positive intensity against the threshold,
+    one line per by group: the median over samples with the interquartile band when the
+    table is per sample, the pooled value otherwise. Reference thresholds get dashed lines.
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    metrics = ["Positive Percentage", "Mean Positive Intensity"]
+    fig, axes = plt.subplots(1, len(metrics), figsize=(14, 5))
+    for (group, rows), color in zip(table.groupby(by, sort=False), plt.rcParams["axes.prop_cycle"].by_key()["color"] * 10):
+        per_threshold = rows.groupby("Threshold")
+        for ax, metric in zip(axes, metrics):
+            if sample_column in table.columns:
+                quartiles = per_threshold[metric].quantile([0.25, 0.5, 0.75]).unstack()
+                ax.fill_between(quartiles.index, quartiles[0.25], quartiles[0.75], color=color, alpha=0.2)
+                ax.plot(quartiles.index, quartiles[0.5], color=color, label=str(group))
+            else:
+                line = per_threshold[metric].first()
+                ax.plot(line.index, line.to_numpy(), color=color, label=str(group))
+    for ax, metric in zip(axes, metrics):
+        for threshold in reference or []:
+            ax.axvline(threshold, color="black", linestyle="--", linewidth=1)
+        ax.set_xlabel(xlabel)
+        ax.set_ylabel(metric)
+        ax.grid(True)
+    axes[0].legend(title=by)
+    fig.tight_layout()
+    fig.savefig(output_path)
+    plt.close(fig)
+
+
+def _read_sample(detections, annotations, value_column, cell_types, class_column, file):
+    # Per-cell values of every cell type of one export, with the annotation area
+    det_data = read_export(os.path.join(detections, file))
+    index = ClassIndex(det_data, class_column)
+    values = {cell_type: pd.to_numeric(index.select(labels)[value_column], errors="coerce").to_numpy(dtype=np.float64)
+              for cell_type, labels in cell_types.items()}
+    area = None
+    if annotations:
+        ano_file = os.path.join(annotations, file.replace(" Detections", ""))
+        if os.path.exists(ano_file):
+            area = annotation_area(read_export(ano_file))
+    return values, area
+
+
+def cell_frame(records):
+    """
+    Returns the cell table (Sample, Cell Type, Value) of (sample, {cell type: values}) records.
+    """
+    samples, types, values = [], [], []
+    for sample, values_by_type in records:
+        for cell_type, type_values in values_by_type.items():
+            samples.append(np.full(len(type_values), sample, dtype=object))
+            types.append(np.full(len(type_values), cell_type, dtype=object))
+            values.append(type_values)
+    if not values:
+        return pd.DataFrame(columns=["Sample", "Cell Type", "Value"])
+    return pd.DataFrame({"Sample": np.concatenate(samples), "Cell Type": np.concatenate(types),
+                         "Value": np.concatenate(values)})
+
+
+def write_sweep(records, areas, thresholds, output_dir, stem, reference=None, xlabel="Threshold", inclusive=False):
+    """
+    Writes the per-sample and pooled sweep tables and the sensitivity plot.
+
+    Parameters:
+        records (list): (sample, {cell type: values}) per export.
+        areas (dict): Sample -> annotation area (mm^2), or None.
+    """
+    cells = cell_frame(records)
+    per_sample = sweep_table(cells, "Value", ["Sample", "Cell Type"], thresholds, areas, inclusive=inclusive)
+    pooled = sweep_table(cells, "Value", ["Cell Type"], thresholds, areas, inclusive=inclusive)
+    os.makedirs(output_dir, exist_ok=True)
+    per_sample.to_csv(os.path.join(output_dir, f"{stem}_per_sample.csv"), index=False)
+    pooled.to_csv(os.path.join(output_dir, f"{stem}_pooled.csv"), index=False)
+    plot_sensitivity(per_sample, os.path.join(output_dir, f"{stem}_sensitivity.png"), reference=reference, xlabel=xlabel)
+    print(f"Threshold sweep over {len(thresholds)} thresholds and {len(records)} samples saved to {output_dir}")
+    return per_sample, pooled
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sweep positivity thresholds over the cells of detection exports.")
+    parser.add_argument("detections", help="Directory of detection exports")
+    parser.add_argument("--annotations", help="Directory of annotation exports (for the densities)")
+    parser.add_argument("--column", required=True, help="Measurement to threshold, e.g. 'AF568: Cell: Mean'")
+    parser.add_argument("--cell-type", nargs="+", action="append", required=True, metavar=("NAME", "LABEL"),
+                        help="Cell type name followed by its class labels (repeatable)")
+    parser.add_argument("--class-column", default="Classification", help="Column of the class labels")
+    parser.add_argument("--thresholds", nargs=3, type=float, metavar=("START", "STOP", "NUM"),
+                        help="Evenly spaced thresholds (default: 201 over the value range)")
+    parser.add_argument("--reference", nargs="*", type=float, default=[], help="Thresholds to mark in the plot")
+    parser.add_argument("--inclusive", action="store_true", help="Positive means value >= threshold")
+    parser.add_argument("--output-dir", default="threshold_sweep", help="Output directory")
+    parser.add_argument("--workers", type=int, default=N_WORKERS, help="Worker processes (1 = serial)")
+    args = parser.parse_args()
+
+    cell_types = {cell_type[0]: cell_type[1:] for cell_type in args.cell_type}
+    files = list_exports(args.detections)
+    worker = partial(_read_sample, args.detections, args.annotations, args.column, cell_types, args.class_column)
+    results = run_per_file(worker, files, n_workers=args.workers)
+    records = [(file.replace(" Detections", ""), result[0]) for file, result in zip(files, results) if result]
+    areas = None
+    if args.annotations:
+        areas = {file.replace(" Detections", ""): result[1] for file, result in zip(files, results) if result and result[1] is not None}
+        records = [record for record in records if record[0] in areas]
+
+    if args.thresholds:
+        thresholds = candidate_thresholds(start=args.thresholds[0], stop=args.thresholds[1], num=int(args.thresholds[2]))
+    else:
+        thresholds = candidate_thresholds(cell_frame(records)["Value"])
+    write_sweep(records, areas, thresholds, args.output_dir, "threshold_sweep", args.reference, args.column, args.inclusive)
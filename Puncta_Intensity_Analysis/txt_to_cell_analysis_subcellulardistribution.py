@@ -1,7 +1,8 @@
 import os
 import pandas as pd
-import matplotlib.pyplot as plt
-import numpy as np  # Required for cumulative calculations
+
+import instrumentation
+from plot_renderer import PlotQueue
 
 # Specify directories
 input_directory = "/Volumes/backup driv/VP_qp_LF - ITERATION4 - OPRM1TRAINING_WITHCOMPOSITES/detections_withMu_12.6.24_csv"
@@ -21,89 +22,77 @@ classifications = [
 ]
 metric_column = "Num spots"
 
-# Initialize a list to store distribution data for all images
-distribution_data = []
-
-# Read CSV files and process data
-for file in os.listdir(input_directory):
-    if file.endswith(".csv"):
-        try:
-            # Load file and normalize headers
-            file_path = os.path.join(input_directory, file)
-            df = pd.read_csv(file_path, encoding="utf-8")
-            df.columns = df.columns.str.strip()  # Normalize column names
-
-            # Debug: Check columns and unique values
-            print(f"Processing {file}...")
-            if "Parent" not in df.columns or metric_column not in df.columns:
-                print(f"Skipping file {file}: Missing required columns.")
-                continue
-
-            df["Parent"] = df["Parent"].str.strip()  # Normalize Parent values
-
-            # Process distribution for each classification
-            for cls in classifications:
-                parent_data = df[df["Parent"] == cls]
-                print(f"{file} - {cls}: {len(parent_data)} rows found.")
-
-                if not parent_data.empty:
-                    # Extract number of spots per cell
-                    spots_per_cell = parent_data[metric_column].dropna().tolist()
-
-                    # Record data for this classification and image
-                    for spots in spots_per_cell:
-                        distribution_data.append({
-                            "Image": file,
-                            "Cell Type": cls,
-                            "Num Spots Per Cell": spots
-                        })
-
-                    # Generate and save CDF plot for this cell type
-                    sorted_data = np.sort(spots_per_cell)
-                    cdf = np.arange(1, len(sorted_data) + 1) / len(sorted_data)
-
-                    plt.figure()
-                    plt.plot(sorted_data, cdf, marker="o", linestyle="--", color="blue")
-                    plt.title(f"CDF of Spots Per Cell\n{cls} ({file})", fontsize=10)
-                    plt.xlabel("Number of Spots Per Cell")
-                    plt.ylabel("CDF")
-                    plt.xlim(0, 20)  # Adjust as needed
-                    plt.tight_layout()
-
-                    # Save the CDF plot
-                    cdf_plot_path = os.path.join(
-                        cdf_directory,
-                        f"{file.replace('.csv', '')}_{cls.replace(': ', '_').replace(' ', '_')}_Num_Spots_CDF.png"
-                    )
-                    plt.savefig(cdf_plot_path)
-                    plt.close()
-
-                    # Generate and save histogram for this cell type
-                    plt.figure()
-                    plt.hist(spots_per_cell, bins=20, color="green", alpha=0.7, edgecolor="black")
-                    plt.title(f"Histogram of Spots Per Cell\n{cls} ({file})", fontsize=10)
-                    plt.xlabel("Number of Spots Per Cell")
-                    plt.ylabel("Frequency")
-                    plt.xlim(0, 20)  # Adjust as needed
-                    plt.tight_layout()
-
-                    # Save the histogram plot
-                    histogram_plot_path = os.path.join(
-                        plots_directory,
-                        f"{file.replace('.csv', '')}_{cls.replace(': ', '_').replace(' ', '_')}_Num_Spots_Histogram.png"
-                    )
-                    plt.savefig(histogram_plot_path)
-                    plt.close()
-
-        except UnicodeDecodeError:
-            print(f"Encoding error with file {file}. Skipping.")
-        except Exception as e:
-            print(f"Error processing {file}: {e}")
-
-# Convert distribution data to DataFrame
-distribution_df = pd.DataFrame(distribution_data)
-
-# Save the distribution data to CSV
-output_path = os.path.join(output_directory, "spots_per_cell_per_image.csv")
-distribution_df.to_csv(output_path, index=False)
-print(f"Distribution data saved to {output_path}.")
+if __name__ == "__main__":
+    instrumentation.phase("read exports")
+    # Initialize a list to store distribution data for all images
+    distribution_data = []
+
+    # Plots are queued per file and class, then rendered in a worker pool; plots whose data
+    # and style did not change since the last run are skipped
+    plots = PlotQueue()
+
+    # Read CSV files and process data
+    for file in os.listdir(input_directory):
+        if file.endswith(".csv"):
+            try:
+                # Load file and normalize headers
+                file_path = os.path.join(input_directory, file)
+                df = pd.read_csv(file_path, encoding="utf-8")
+                df.columns = df.columns.str.strip()  # Normalize column names
+
+                # Debug: Check columns and unique values
+                print(f"Processing {file}...")
+                if "Parent" not in df.columns or metric_column not in df.columns:
+                    print(f"Skipping file {file}: Missing required columns.")
+                    continue
+
+                df["Parent"] = df["Parent"].str.strip()  # Normalize Parent values
+
+                # Process distribution for each classification
+                for cls in classifications:
+                    parent_data = df[df["Parent"] == cls]
+                    print(f"{file} - {cls}: {len(parent_data)} rows found.")
+
+                    if not parent_data.empty:
+                        # Extract number of spots per cell
+                        spots_per_cell = parent_data[metric_column].dropna().tolist()
+
+                        # Record data for this classification and image
+                        for spots in spots_per_cell:
+                            distribution_data.append({
+                                "Image": file,
+                                "Cell Type": cls,
+                                "Num Spots Per Cell": spots
+                            })
+
+                        # Queue the CDF and histogram for this cell type (drawn later, in parallel)
+                        plot_name = f"{file.replace('.csv', '')}_{cls.replace(': ', '_').replace(' ', '_')}"
+                        plots.add(
+                            "cdf", os.path.join(cdf_directory, f"{plot_name}_Num_Spots_CDF.png"), spots_per_cell,
+                            title=f"CDF of Spots Per Cell\n{cls} ({file})", fontsize=10,
+                            xlabel="Number of Spots Per Cell", ylabel="CDF", xlim=(0, 20),  # Adjust as needed
+                            marker="o", linestyle="--", color="blue", tight_layout=True
+                        )
+                        plots.add(
+                            "hist", os.path.join(plots_directory, f"{plot_name}_Num_Spots_Histogram.png"), spots_per_cell,
+                            title=f"Histogram of Spots Per Cell\n{cls} ({file})", fontsize=10,
+                            xlabel="Number of Spots Per Cell", ylabel="Frequency", xlim=(0, 20),  # Adjust as needed
+                            bins=20, color="green", alpha=0.7, edgecolor="black", tight_layout=True
+                        )
+
+            except UnicodeDecodeError:
+                print(f"Encoding error with file {file}. Skipping.")
+            except Exception as e:
+                print(f"Error processing {file}: {e}")
+
+    plots.render()
+
+    instrumentation.phase("write table")
+    # Convert distribution data to DataFrame
+    distribution_df = pd.DataFrame(distribution_data)
+
+    # Save the distribution data to CSV
+    output_path = os.path.join(output_directory, "spots_per_cell_per_image.csv")
+    distribution_df.to_csv(output_path, index=False)
+    print(f"Distribution data saved to {output_path}.")
+    instrumentation.report()
@@ -1,12 +1,17 @@
 import os
 import pandas as pd
 
+from incremental import SampleManifest, path_fingerprint, settings_hash
+import instrumentation
+from parallel_processing import N_WORKERS, run_per_file
+from qupath_io import list_exports, read_export
+from reclassification import reclassify
+from summary_engine import annotation_area, detection_columns, summarize_samples
+
 # Define all paths in a single dictionary (Windows-style)
 paths = {
     "raw_detection": r"/Volumes/hnaskolab/Jamie Anne Mortel/BACKUPFROMDRIVE/VP_qp_LF - ITERATION4/detections_iteration4_withMu_SPOTSIZE_12.13.24",
-    "raw_annotation": r"/Volumes/hnaskolab/Jamie Anne Mortel/BACKUPFROMDRIVE/VP_qp_LF - ITERATION4/annotations_iteration4_withMu_SPOTSIZE_12.13.24",
-    "detection_csv": r"/Volumes/hnaskolab/Jamie Anne Mortel/BACKUPFROMDRIVE/VP_qp_LF - ITERATION4/detections_iteration4_withMu_SPOTSIZE_12.13.24_CSV",
-    "annotation_csv": r"/Volumes/hnaskolab/Jamie Anne Mortel/BACKUPFROMDRIVE/VP_qp_LF - ITERATION4/annotations_iteration4_withMu_SPOTSIZE_12.13.24_CSV"
+    "raw_annotation": r"/Volumes/hnaskolab/Jamie Anne Mortel/BACKUPFROMDRIVE/VP_qp_LF - ITERATION4/annotations_iteration4_withMu_SPOTSIZE_12.13.24"
 }
 
 # Function to convert Windows paths to Unix-like paths if running in a Unix environment
@@ -20,29 +25,6 @@ def convert_to_unix_path(win_path):
 # Convert all paths to Unix-like if necessary
 paths = {key: convert_to_unix_path(value) for key, value in paths.items()}
 
-# Ensure the output directories exist
-os.makedirs(paths["detection_csv"], exist_ok=True)
-os.makedirs(paths["annotation_csv"], exist_ok=True)
-
-# Function to convert text files to CSV
-def convert_text_to_csv(input_path, output_path):
-    for file in os.listdir(input_path):
-        if file.endswith(".txt"):
-            input_file = os.path.join(input_path, file)
-            output_file = os.path.join(output_path, file.replace(".txt", ".csv"))
-            try:
-                df = pd.read_csv(input_file, sep="\t")
-                df.to_csv(output_file, index=False)
-            except Exception as e:
-                print(f"Error converting {file}: {e}")
-
-# Convert raw detection and annotation files
-convert_text_to_csv(paths["raw_detection"], paths["detection_csv"])
-convert_text_to_csv(paths["raw_annotation"], paths["annotation_csv"])
-
-# Get all converted detection CSV files
-filelist = [f for f in os.listdir(paths["detection_csv"]) if f.endswith(".csv")]
-
 # Define Qupath colors and classifications
 QPink = "AF488"
 QPBlue = "AF647"
@@ -63,8 +45,8 @@ subcellular_metrics = [
     "Subcellular: Channel 2: Num clusters"
 ]
 
-# Initialize an empty dataframe with relevant columns
-DataDraft = pd.DataFrame(columns=[
+# Columns of the summary table, in output order
+summary_columns = [
     "Sample",
     "vglut2-: vgat+ Cell Density (cells/mm^2)",
     "vglut2-: vgat+ Cell Count",
@@ -86,84 +68,98 @@ DataDraft = pd.DataFrame(columns=[
     "Double Negative Cell Percentage",
     "Total Cell Area (mm^2)",
     "Total Annotation Area (mm^2)"
-] + [f"{metric} ({cls})" for metric in subcellular_metrics for cls in [Pink_posName_2, Blue_posName_2, double_positive]])
-
-# Process each file
-for k, file in enumerate(filelist):
-    try:
-        det_data = pd.read_csv(os.path.join(paths["detection_csv"], file))
-        filename = file.replace(" Detections", "")
-        ano_file = os.path.join(paths["annotation_csv"], filename)
-        if not os.path.exists(ano_file):
-            continue
-        ano_data = pd.read_csv(ano_file)
-
-        # Subset data for specific cell populations
-        QPpink_only = det_data[det_data['Classification'].isin([Pink_posName, Pink_posName_2])]
-        QPblue_only = det_data[det_data['Classification'].isin([Blue_posName, Blue_posName_2])]
-        QPboth = det_data[det_data['Classification'] == double_positive]
-        QPnone = det_data[det_data['Classification'] == double_negative]
-
-        # Calculate areas and statistics
-        posPinkArea = QPpink_only['Cell: Area µm^2'].sum() / 1e6 if not QPpink_only.empty else 0
-        posBlueArea = QPblue_only['Cell: Area µm^2'].sum() / 1e6 if not QPblue_only.empty else 0
-        posBothArea = QPboth['Cell: Area µm^2'].sum() / 1e6 if not QPboth.empty else 0
-        posNoneArea = QPnone['Cell: Area µm^2'].sum() / 1e6 if not QPnone.empty else 0
-        totalCellArea = posPinkArea + posBlueArea + posBothArea
-
-        realAnnotations = ano_data[ano_data['Object type'].isin(["Annotation", "PathAnnotationObject"])]
-        anoArea = realAnnotations['Area µm^2'].sum() / 1e6 if not realAnnotations.empty else 0
-
-        pinkIntensity = QPpink_only['AF488: Cell: Mean'].mean() if not QPpink_only.empty else None
-        blueIntensity = QPblue_only['AF647: Cell: Mean'].mean() if not QPblue_only.empty else None
-
-        pinkCellCount = len(QPpink_only)
-        blueCellCount = len(QPblue_only)
-        bothCellCount = len(QPboth)
-        noneCellCount = len(QPnone)
-        totalCells = pinkCellCount + blueCellCount + bothCellCount
-
-        pinkPercentage = (pinkCellCount / totalCells * 100) if totalCells > 0 else None
-        bluePercentage = (blueCellCount / totalCells * 100) if totalCells > 0 else None
-        bothPercentage = (bothCellCount / totalCells * 100) if totalCells > 0 else None
-        nonePercentage = (noneCellCount / totalCells * 100) if totalCells > 0 else None
-
-        # Populate DataDraft
-        DataDraft.loc[k, "Sample"] = filename
-        DataDraft.loc[k, "vglut2-: vgat+ Cell Density (cells/mm^2)"] = (blueCellCount / totalCellArea) if totalCellArea > 0 else None
-        DataDraft.loc[k, "vglut2-: vgat+ Cell Count"] = blueCellCount
-        DataDraft.loc[k, "vglut2-: vgat+ Cell Area (mm^2)"] = posBlueArea
-        DataDraft.loc[k, "vglut2-: vgat+ Cell Percentage"] = bluePercentage
-        DataDraft.loc[k, "vglut2-: vgat+ Intensity"] = blueIntensity
-
-        DataDraft.loc[k, "vglut2+: vgat- Cell Density (cells/mm^2)"] = (pinkCellCount / totalCellArea) if totalCellArea > 0 else None
-        DataDraft.loc[k, "vglut2+: vgat- Cell Count"] = pinkCellCount
-        DataDraft.loc[k, "vglut2+: vgat- Cell Area (mm^2)"] = posPinkArea
-        DataDraft.loc[k, "vglut2+: vgat- Cell Percentage"] = pinkPercentage
-        DataDraft.loc[k, "vglut2+: vgat- Intensity"] = pinkIntensity
-
-        DataDraft.loc[k, "Double Positive Cell Density (cells/mm^2)"] = (bothCellCount / totalCellArea) if totalCellArea > 0 else None
-        DataDraft.loc[k, "Double Positive Cell Count"] = bothCellCount
-        DataDraft.loc[k, "Double Positive Cell Area (mm^2)"] = posBothArea
-        DataDraft.loc[k, "Double Positive Cell Percentage"] = bothPercentage
-
-        DataDraft.loc[k, "Double Negative Cell Density (cells/mm^2)"] = (noneCellCount / totalCellArea) if totalCellArea > 0 else None
-        DataDraft.loc[k, "Double Negative Cell Count"] = noneCellCount
-        DataDraft.loc[k, "Double Negative Cell Area (mm^2)"] = posNoneArea
-        DataDraft.loc[k, "Double Negative Cell Percentage"] = nonePercentage
-
-        DataDraft.loc[k, "Total Cell Area (mm^2)"] = totalCellArea
-        DataDraft.loc[k, "Total Annotation Area (mm^2)"] = anoArea
-
-        # Subcellular metrics
-        for cls in [Pink_posName_2, Blue_posName_2, double_positive, double_negative]:
-            cls_data = det_data[det_data['Classification'] == cls]
-            for metric in subcellular_metrics:
-                DataDraft.loc[k, f"{metric} ({cls})"] = cls_data[metric].sum() if metric in cls_data.columns else None
-
-    except Exception as e:
-        print(f"Error processing {file}: {e}")
-
-# Write the results to CSV and XLSX
-DataDraft.to_csv("12.13.24_MU_SUBCELLULARMETRICS_WITHNEG_processed_data_with_subcellular_metrics.csv", index=False)
-DataDraft.to_excel("12.13.24_MU__SUBCELLULARMETRICS_WITHNEG_processed_data_with_subcellular_metrics.xlsx", index=False)
+] + [f"{metric} ({cls})" for metric in subcellular_metrics for cls in [Pink_posName_2, Blue_posName_2, double_positive]]
+
+# Cell populations reported in the summary, with the channel used for their mean intensity
+cell_groups = {
+    "vglut2-: vgat+": {"labels": [Blue_posName, Blue_posName_2], "intensity": f"{QPBlue}: Cell: Mean"},
+    "vglut2+: vgat-": {"labels": [Pink_posName, Pink_posName_2], "intensity": f"{QPink}: Cell: Mean"},
+    "Double Positive": {"labels": [double_positive]},
+    "Double Negative": {"labels": [double_negative]}
+}
+
+# Classifications whose subcellular metrics are summed
+subcellular_classes = [Pink_posName_2, Blue_posName_2, double_positive, double_negative]
+
+# Double negative cells are left out of the total cell area and of the percentage denominator
+summary_options = {
+    "area_groups": ["vglut2-: vgat+", "vglut2+: vgat-", "Double Positive"],
+    "count_groups": ["vglut2-: vgat+", "vglut2+: vgat-", "Double Positive"]
+}
+
+# Offline reclassification: marker -> positivity rule (see reclassification.py) to recompute the
+# classifications from the exported measurements instead of using QuPath's (None: keep QuPath's), e.g.
+# reclassification_rules = {"vglut2": {"column": f"{QPink}: Cell: Mean", "threshold": 120},
+#                           "vgat": {"column": f"{QPBlue}: Cell: Mean", "threshold": 150}}
+reclassification_rules = None
+
+# Incremental mode: only new or changed exports are processed, the rest of the table comes
+# from the manifest written next to the outputs (set to False to recompute every sample)
+incremental = True
+manifest_path = "12.13.24_MU_SUBCELLULARMETRICS_WITHNEG_processed_data_with_subcellular_metrics.manifest.json"
+
+# Samples keep the names of the CSV copies the table was built from before the .txt exports
+# were read directly ("... Scene #N.csv")
+sample_suffix = ".csv"
+
+# Process one image (run in a worker process): returns its one-row summary record, or None when
+# the image has no matching annotation export
+def process_sample(file):
+    filename = file.replace(" Detections", "")
+    ano_file = os.path.join(paths["raw_annotation"], filename)
+    if not os.path.exists(ano_file):
+        return None
+    det_data = read_export(os.path.join(paths["raw_detection"], file))
+    ano_data = read_export(ano_file)
+    if reclassification_rules:
+        det_data = reclassify(det_data, reclassification_rules, update_children=False)
+
+    # Missing subcellular metric columns are allowed (reported as None); anything else must exist
+    needed = [col for col in detection_columns(cell_groups, subcellular_metrics)
+              if col in det_data.columns or col not in subcellular_metrics]
+    sample = (os.path.splitext(filename)[0] + sample_suffix, det_data[needed], annotation_area(ano_data))
+    summary = summarize_samples([sample], cell_groups, subcellular_classes, subcellular_metrics, **summary_options)
+    return summary.to_dict("records")[0]
+
+
+# Fingerprint of one image's inputs (detection and annotation export) for the incremental manifest
+def sample_fingerprint(file):
+    ano_file = os.path.join(paths["raw_annotation"], file.replace(" Detections", ""))
+    return [path_fingerprint(os.path.join(paths["raw_detection"], file)), path_fingerprint(ano_file)]
+
+
+if __name__ == "__main__":
+    # Stage timings, memory and rows read are reported when PUNCTA_PROFILE is set (see instrumentation.py)
+    instrumentation.phase("scan")
+
+    # Get all raw detection exports (parsed once and served from the columnar cache afterwards)
+    filelist = list_exports(paths["raw_detection"])
+
+    # Work out which exports are new or changed since the last run
+    fingerprints = {file: sample_fingerprint(file) for file in filelist}
+    manifest = SampleManifest(manifest_path, settings_hash(cell_groups, subcellular_classes, subcellular_metrics, summary_options, reclassification_rules, sample_suffix))
+    removed = manifest.prune(filelist)
+    todo = manifest.stale(fingerprints) if incremental else filelist
+    print(f"Processing {len(todo)} of {len(filelist)} samples ({len(removed)} removed since the last run)")
+
+    # Read and summarize the images in a process pool (one summary row per image comes back,
+    # in todo order)
+    instrumentation.phase("summarize samples")
+    results = run_per_file(process_sample, todo, n_workers=N_WORKERS)
+    for file, row in zip(todo, results):
+        if row is None:
+            manifest.discard(file)
+        else:
+            manifest.update(file, fingerprints[file], row)
+    manifest.save()
+
+    # Rebuild the full table from the stored rows
+    DataDraft = pd.DataFrame(manifest.rows(filelist))
+    DataDraft = DataDraft.reindex(columns=summary_columns + [col for col in DataDraft.columns if col not in summary_columns])
+
+    # Write the results to CSV and XLSX
+    instrumentation.phase("write csv")
+    DataDraft.to_csv("12.13.24_MU_SUBCELLULARMETRICS_WITHNEG_processed_data_with_subcellular_metrics.csv", index=False)
+    instrumentation.phase("write xlsx")
+    DataDraft.to_excel("12.13.24_MU__SUBCELLULARMETRICS_WITHNEG_processed_data_with_subcellular_metrics.xlsx", index=False)
+    instrumentation.report()
@@ -1,38 +1,144 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 
+import instrumentation
+from qupath_io import CATEGORICAL_COLUMNS, export_columns, list_exports, sniff_delimiter
+
+'''
+Converts QuPath text exports to a binary columnar format (Parquet), or to CSV on request.
+
+Files are parsed with the multithreaded pyarrow CSV reader (or the pandas C parser when
+pyarrow is not installed) with the label columns (Classification, Parent, Object type)
+read as dictionary/categorical columns, and several files are converted at the same time.
+Without pyarrow the columnar output falls back to a compressed pickle (.pkl.gz).
+'''
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+    HAVE_PYARROW = True
+except ImportError:
+    HAVE_PYARROW = False
+
+# Files converted at the same time (the parsers release the GIL, so threads are enough)
+N_THREADS = 4
+
+OUTPUT_EXTENSIONS = {"parquet": ".parquet", "csv": ".csv", "pickle": ".pkl.gz"}
+
+
+def read_text_export(file_path):
+    """
+    Parses one text export with a C-level parser.
+
+    Returns:
+        pyarrow.Table or pd.DataFrame: The table (a Table when pyarrow is installed).
+    """
+    delimiter = sniff_delimiter(file_path)
+    label_columns = [column for column in export_columns(file_path) if column in CATEGORICAL_COLUMNS]
+    if HAVE_PYARROW:
+        return pa_csv.read_csv(
+            file_path,
+            read_options=pa_csv.ReadOptions(use_threads=True),
+            parse_options=pa_csv.ParseOptions(delimiter=delimiter),
+            convert_options=pa_csv.ConvertOptions(
+                column_types={column: pa.dictionary(pa.int32(), pa.string()) for column in label_columns},
+                # Empty fields (e.g. unclassified objects) are nulls, as with the pandas parser
+                strings_can_be_null=True,
+            ),
+        )
+    return pd.read_csv(file_path, sep=delimiter, engine="c", encoding="utf-8",
+                       dtype={column: "category" for column in label_columns})
+
+
+def write_table(table, output_path, output_format):
+    """
+    Writes a parsed export to Parquet, CSV or a compressed pickle.
+    """
+    if output_format == "parquet":
+        if isinstance(table, pd.DataFrame):
+            table.to_parquet(output_path, compression="zstd", index=False)
+        else:
+            pq.write_table(table, output_path, compression="zstd")
+    elif output_format == "csv":
+        if isinstance(table, pd.DataFrame):
+            table.to_csv(output_path, index=False)
+        else:
+            # Dictionary columns are written as their plain labels
+            pa_csv.write_csv(table.cast(pa.schema([
+                pa.field(field.name, field.type.value_type if pa.types.is_dictionary(field.type) else field.type)
+                for field in table.schema
+            ])), output_path)
+    elif output_format == "pickle":
+        table = table if isinstance(table, pd.DataFrame) else table.to_pandas()
+        table.to_pickle(output_path, compression="gzip")
+    else:
+        raise ValueError(f"Unknown output format: {output_format}")
+
+
+def convert_export(file_path, output_dir, output_format="parquet"):
+    """
+    Converts one text export; the output file is written to a temp name and renamed.
+
+    Returns:
+        str: Path of the converted file.
+    """
+    stem = os.path.splitext(os.path.basename(file_path))[0]
+    output_path = os.path.join(output_dir, stem + OUTPUT_EXTENSIONS[output_format])
+    write_table(read_text_export(file_path), output_path + ".tmp", output_format)
+    os.replace(output_path + ".tmp", output_path)
+    return output_path
+
+
+def convert_exports(input_dir, output_dir, output_format="parquet", n_threads=N_THREADS):
+    """
+    Converts all text files in a directory, several at a time.
+
+    Parameters:
+        input_dir (str): Directory containing the text files.
+        output_dir (str): Directory to save the converted files.
+        output_format (str): "parquet" (default), "csv", or "pickle".
+        n_threads (int): Files converted at the same time.
+
+    Returns:
+        list: Paths of the converted files (None for files that failed), in file order.
+    """
+    if output_format == "parquet" and not HAVE_PYARROW:
+        print("pyarrow is not installed: writing compressed pickles instead of Parquet")
+        output_format = "pickle"
+    os.makedirs(output_dir, exist_ok=True)
+
+    file_names = list_exports(input_dir)
+
+    def convert(file_name):
+        try:
+            output_file = convert_export(os.path.join(input_dir, file_name), output_dir, output_format)
+            print(f"Converted {file_name} to {output_file}")
+            return output_file
+        except Exception as e:
+            print(f"Failed to process {file_name}: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        return list(executor.map(convert, file_names))
+
+
 def reformat_txt_to_csv(input_dir, output_dir):
     """
     Converts all text files in a directory to CSV format.
-    
+
     Parameters:
         input_dir (str): Directory containing the text files.
         output_dir (str): Directory to save the CSV files.
     """
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    
-    for file_name in os.listdir(input_dir):
-        if file_name.endswith('.txt'):
-            file_path = os.path.join(input_dir, file_name)
-            
-            # Detect the delimiter (assuming tab-delimited files for now)
-            with open(file_path, 'r') as file:
-                first_line = file.readline()
-                delimiter = '\t' if '\t' in first_line else ' '
-
-            # Read the file into a DataFrame
-            try:
-                df = pd.read_csv(file_path, delimiter=delimiter, engine='python')
-                
-                # Save as CSV
-                output_file = os.path.join(output_dir, file_name.replace('.txt', '.csv'))
-                df.to_csv(output_file, index=False)
-                print(f"Converted {file_name} to {output_file}")
-            except Exception as e:
-                print(f"Failed to process {file_name}: {e}")
-
-# Example usage
-input_directory = "/Users/jamieannemortel/Downloads/RawData_Composite/annotation results"  # Replace with your input directory
-output_directory = "/Users/jamieannemortel/Downloads/annotation_csv"  # Replace with your output directory
-reformat_txt_to_csv(input_directory, output_directory)
+    return convert_exports(input_dir, output_dir, output_format="csv")
+
+
+if __name__ == "__main__":
+    instrumentation.phase("convert")
+    # Example usage
+    input_directory = "/Users/jamieannemortel/Downloads/RawData_Composite/annotation results"  # Replace with your input directory
+    output_directory = "/Users/jamieannemortel/Downloads/annotation_parquet"  # Replace with your output directory
+    convert_exports(input_directory, output_directory)  # output_format="csv" to write CSV files instead
+    instrumentation.report()
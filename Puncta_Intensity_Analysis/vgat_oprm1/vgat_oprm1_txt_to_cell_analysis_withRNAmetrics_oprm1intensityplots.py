@@ -1,9 +1,14 @@
 import os
-import pandas as pd
-import matplotlib.pyplot as plt
+import sys
 import numpy as np
 import seaborn as sns
 
+# Shared helpers live one level up in Puncta_Intensity_Analysis
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import instrumentation
+from plot_renderer import PlotQueue
+from qupath_io import ClassIndex, list_exports, read_export
+
 # Define all paths in a single dictionary (Windows-style)
 paths = {
     "raw_detection": r"/Volumes/backup driv/VP_qp_LF - ITERATION4 - VGAT_OPRM1_COMPOSITE/detections_iteration4_vgatwithMu_12.13.24",
@@ -26,7 +31,7 @@ plots_dir = os.path.join(os.path.dirname(paths["raw_detection"]), "intensity_plo
 os.makedirs(plots_dir, exist_ok=True)
 
 # Get all detection text files
-filelist = [f for f in os.listdir(paths["raw_detection"]) if f.endswith(".txt")]
+filelist = list_exports(paths["raw_detection"])
 
 # Define cell type classifications and their colors
 classifications = {
@@ -38,59 +43,54 @@ colors = {
     "vgat_positive_oprm1_positive": "green"
 }
 
-# Initialize a dictionary to collect intensities by cell type
-intensity_data = {key: [] for key in classifications.keys()}
-
-# Process each file to collect intensity data
-for file in filelist:
-    try:
-        det_data = pd.read_csv(os.path.join(paths["raw_detection"], file), sep="\t")
-        for cell_type, labels in classifications.items():
-            cell_data = det_data[det_data['Classification'].isin(labels)]
-            intensity_data[cell_type].extend(cell_data['AF568: Cell: Mean'].dropna())
-    except Exception as e:
-        print(f"Error processing {file}: {e}")
+if __name__ == "__main__":
+    instrumentation.phase("read exports")
+    # Initialize a dictionary to collect intensities by cell type
+    intensity_data = {key: [] for key in classifications.keys()}
 
-# Set y-axis maximum for histograms and CDF plots
-y_max = 800
+    # Process each file to collect intensity data
+    for file in filelist:
+        try:
+            det_data = read_export(os.path.join(paths["raw_detection"], file))
+            class_index = ClassIndex(det_data, "Classification")
+            for cell_type, labels in classifications.items():
+                cell_data = class_index.select(labels)
+                intensity_data[cell_type].extend(cell_data['AF568: Cell: Mean'].dropna())
+        except Exception as e:
+            print(f"Error processing {file}: {e}")
 
-# Calculate global min and max for x-axis
-x_min = min([min(values) for values in intensity_data.values() if values])
-x_max = max([max(values) for values in intensity_data.values() if values])
+    # Set y-axis maximum for histograms and CDF plots
+    y_max = 800
 
-# Generate plots for each cell type
-for cell_type, values in intensity_data.items():
-    if values:
-        values = np.array(values)
+    # Calculate global min and max for x-axis
+    x_min = min([min(values) for values in intensity_data.values() if values])
+    x_max = max([max(values) for values in intensity_data.values() if values])
 
-        # Create a histogram
-        plt.figure(figsize=(10, 6))
-        plt.hist(values, bins=30, color=colors[cell_type], edgecolor='black', alpha=0.7)
-        plt.title(f"Distribution of Oprm1 Intensity for {cell_type.replace('_', ':').title()}")
-        plt.xlabel("Oprm1 Intensity")
-        plt.ylabel("Frequency")
-        plt.xlim(x_min, 400)
-        plt.ylim(0, y_max)
-        plt.grid(True)
-        hist_path = os.path.join(plots_dir, f"Distribution_of_oprm1_intensity_{cell_type}.png")
-        plt.savefig(hist_path)
-        plt.close()
+    # Queue the plots for each cell type; they are drawn in parallel and unchanged plots are skipped
+    instrumentation.phase("plots")
+    plots = PlotQueue()
+    for cell_type, values in intensity_data.items():
+        if values:
+            values = np.array(values)
 
-        # Create a cumulative distribution function (CDF) plot
-        sorted_data = np.sort(values)
-        cdf = np.arange(1, len(sorted_data) + 1) / len(sorted_data)
+            # Histogram
+            plots.add(
+                "hist", os.path.join(plots_dir, f"Distribution_of_oprm1_intensity_{cell_type}.png"), values,
+                title=f"Distribution of Oprm1 Intensity for {cell_type.replace('_', ':').title()}",
+                xlabel="Oprm1 Intensity", ylabel="Frequency", xlim=(x_min, 400), ylim=(0, y_max),
+                bins=30, color=colors[cell_type], edgecolor="black", alpha=0.7, figsize=(10, 6), grid=True
+            )
 
-        plt.figure(figsize=(10, 6))
-        plt.plot(sorted_data, cdf, marker='.', linestyle='none', color=colors[cell_type])
-        plt.title(f"CDF of Oprm1 Intensity for {cell_type.replace('_', ':').title()}")
-        plt.xlabel("Oprm1 Intensity")
-        plt.ylabel("Cumulative Probability")
-        plt.xlim(x_min, 800)  # Set consistent x-axis
-        plt.grid(True)
-        cdf_path = os.path.join(plots_dir, f"Oprm1_intensity_CDF_{cell_type}.png")
-        plt.savefig(cdf_path)
-        plt.close()
+            # Cumulative distribution function (CDF)
+            plots.add(
+                "cdf", os.path.join(plots_dir, f"Oprm1_intensity_CDF_{cell_type}.png"), values,
+                title=f"CDF of Oprm1 Intensity for {cell_type.replace('_', ':').title()}",
+                xlabel="Oprm1 Intensity", ylabel="Cumulative Probability", xlim=(x_min, 800),  # Set consistent x-axis
+                marker=".", linestyle="none", color=colors[cell_type], figsize=(10, 6), grid=True
+            )
+        else:
+            print(f"No AF568: Cell: Mean data available for {cell_type.title()}.")
 
-        print(f"Plots for {cell_type.replace('_', ':').title()} saved to {plots_dir}")
-    else:
-        print(f"No AF568: Cell: Mean data available for {cell_type.title()}.")
+    plots.render()
+    print(f"Plots saved to {plots_dir}")
+    instrumentation.report()
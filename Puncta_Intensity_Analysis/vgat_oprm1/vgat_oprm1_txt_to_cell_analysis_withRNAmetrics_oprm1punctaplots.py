@@ -1,8 +1,13 @@
 import os
-import pandas as pd
-import matplotlib.pyplot as plt
+import sys
 import numpy as np
 
+# Shared helpers live one level up in Puncta_Intensity_Analysis
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import instrumentation
+from plot_renderer import PlotQueue
+from qupath_io import ClassIndex, list_exports, read_export
+
 # Define paths
 paths = {
     "raw_detection": r"/Volumes/backup driv/VP_qp_LF - ITERATION4 - VGAT_OPRM1_COMPOSITE/detections_iteration4_vgatwithMu_12.13.24"
@@ -13,7 +18,7 @@ plots_dir = os.path.join(os.path.dirname(paths["raw_detection"]), "punctacount_p
 os.makedirs(plots_dir, exist_ok=True)
 
 # List files in the detection directory
-filelist = [f for f in os.listdir(paths["raw_detection"]) if f.endswith(".txt") and not f.startswith("._")]
+filelist = list_exports(paths["raw_detection"])
 
 # Define corrected Parents and colors
 classifications = {
@@ -25,83 +30,80 @@ colors = {
     "vgat_positive_oprm1_positive": "green"
 }
 
-# Initialize data dictionary
-subcellular_data = {key: [] for key in classifications.keys()}
+if __name__ == "__main__":
+    instrumentation.phase("read exports")
+    # Initialize data dictionary
+    subcellular_data = {key: [] for key in classifications.keys()}
 
-# Process files
-for file in filelist:
-    try:
-        print(f"\nProcessing file: {file}")
+    # Process files
+    for file in filelist:
+        try:
+            print(f"\nProcessing file: {file}")
 
-        # Attempt to read the file
-        det_data = pd.read_csv(os.path.join(paths["raw_detection"], file), sep="\t", encoding="utf-8")
+            # Attempt to read the file
+            det_data = read_export(os.path.join(paths["raw_detection"], file))
 
-        # Print column names
-        print(f"Columns in {file}: {list(det_data.columns)}")
+            # Print column names
+            print(f"Columns in {file}: {list(det_data.columns)}")
         
-        # Debugging: Print unique classifications
-        unique_classifications = det_data["Parent"].unique()
-        print(f"Unique classifications in {file}: {unique_classifications}")
+            # Debugging: Print unique classifications
+            unique_classifications = det_data["Parent"].unique()
+            print(f"Unique classifications in {file}: {unique_classifications}")
+
+            # Row positions of every Parent label, built once per file
+            parent_index = ClassIndex(det_data, "Parent")
 
-        for cell_type, labels in classifications.items():
-            print(f"\nFiltering for {cell_type} using labels: {labels}")
+            for cell_type, labels in classifications.items():
+                print(f"\nFiltering for {cell_type} using labels: {labels}")
 
-            # Filter rows by classification
-            filtered_data = det_data[det_data["Parent"].isin(labels)]
+                # Filter rows by classification
+                filtered_data = parent_index.select(labels)
             
-            # Debugging: Show filtered rows
-            print(f"Filtered rows for {cell_type}:\n{filtered_data[['Parent', 'Num spots']].head()}")
-
-            if "Num spots" in filtered_data.columns:
-                extracted_values = filtered_data["Num spots"].dropna().tolist()
-            else:
-                print(f"'Num spots' column not found in {file}")
-                extracted_values = []
-
-            print(f"Extracted values for {cell_type} from {file}: {extracted_values}")
-            subcellular_data[cell_type].extend(extracted_values)
-    except Exception as e:
-        print(f"Error processing {file}: {e}")
-
-
-
-# Generate plots
-for cell_type, values in subcellular_data.items():
-    if values:
-        values = np.array(values)
-
-        # Debugging: Print summary statistics
-        print(f"\nSummary for {cell_type}:")
-        print(f"  Count: {len(values)}")
-        print(f"  Min: {np.min(values)}")
-        print(f"  Max: {np.max(values)}")
-        print(f"  Mean: {np.mean(values)}")
-
-        # Histogram
-        plt.figure(figsize=(10, 6))
-        plt.hist(values, bins=30, color=colors[cell_type], edgecolor="black", alpha=0.7)
-        plt.title(f"Distribution of Puncta Counts for {cell_type.replace('_', ' ').title()}")
-        plt.xlabel("Num Spots")
-        plt.xlim(0,30)
-        plt.ylabel("Frequency")
-        plt.grid(True)
-        plt.savefig(os.path.join(plots_dir, f"{cell_type}_histogram.png"))
-        plt.close()
-
-        # CDF
-        sorted_data = np.sort(values)
-        cdf = np.arange(1, len(sorted_data) + 1) / len(sorted_data)
-
-        plt.figure(figsize=(10, 6))
-        plt.plot(sorted_data, cdf, color=colors[cell_type])
-        plt.title(f"CDF for {cell_type.replace('_', ' ').title()}")
-        plt.xlabel("Num Spots")
-        plt.xlim(0,30)
-        plt.ylabel("Cumulative Probability")
-        plt.grid(True)
-        plt.savefig(os.path.join(plots_dir, f"{cell_type}_cdf.png"))
-        plt.close()
-
-        print(f"Plots for {cell_type} saved.")
-    else:
-        print(f"No data for {cell_type}.")
\ No newline at end of file
+                # Debugging: Show filtered rows
+                print(f"Filtered rows for {cell_type}:\n{filtered_data[['Parent', 'Num spots']].head()}")
+
+                if "Num spots" in filtered_data.columns:
+                    extracted_values = filtered_data["Num spots"].dropna().tolist()
+                else:
+                    print(f"'Num spots' column not found in {file}")
+                    extracted_values = []
+
+                print(f"Extracted values for {cell_type} from {file}: {extracted_values}")
+                subcellular_data[cell_type].extend(extracted_values)
+        except Exception as e:
+            print(f"Error processing {file}: {e}")
+
+
+
+    # Generate plots
+    instrumentation.phase("plots")
+    plots = PlotQueue()
+    for cell_type, values in subcellular_data.items():
+        if values:
+            values = np.array(values)
+
+            # Debugging: Print summary statistics
+            print(f"\nSummary for {cell_type}:")
+            print(f"  Count: {len(values)}")
+            print(f"  Min: {np.min(values)}")
+            print(f"  Max: {np.max(values)}")
+            print(f"  Mean: {np.mean(values)}")
+
+            # Histogram and CDF (drawn in parallel by the plot queue; unchanged plots are skipped)
+            plots.add(
+                "hist", os.path.join(plots_dir, f"{cell_type}_histogram.png"), values,
+                title=f"Distribution of Puncta Counts for {cell_type.replace('_', ' ').title()}",
+                xlabel="Num Spots", ylabel="Frequency", xlim=(0, 30),  # Set x-axis limits
+                bins=30, color=colors[cell_type], edgecolor="black", alpha=0.7, figsize=(10, 6), grid=True
+            )
+            plots.add(
+                "cdf", os.path.join(plots_dir, f"{cell_type}_cdf.png"), values,
+                title=f"CDF for {cell_type.replace('_', ' ').title()}",
+                xlabel="Num Spots", ylabel="Cumulative Probability", xlim=(0, 30),  # Set x-axis limits
+                color=colors[cell_type], figsize=(10, 6), grid=True
+            )
+        else:
+            print(f"No data for {cell_type}.")
+
+    plots.render()
+    instrumentation.report()
@@ -1,8 +1,18 @@
 import os
+import sys
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
 
+# Shared helpers live one level up in Puncta_Intensity_Analysis
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from incremental import SampleManifest, path_fingerprint, settings_hash
+import instrumentation
+from parallel_processing import N_WORKERS, run_per_file
+from qupath_io import list_exports, read_export
+from reclassification import reclassify
+from summary_engine import annotation_area, detection_columns, summarize_samples
+
 ##SPECIFIC TO vglut22: OPRM1 COMPOSITE
 ##IN PROGRESS!
 
@@ -10,9 +20,7 @@ import matplotlib.pyplot as plt
 # Define all paths in a single dictionary (Windows-style)
 paths = {
     "raw_detection": r"/Volumes/backup driv/VP_qp_LF - ITERATION4 - VGLUT2_OPRM1_COMPOSITE/detections_iteration4_vglut2withMu_12.13.24",
-    "raw_annotation": r"/Volumes/backup driv/VP_qp_LF - ITERATION4 - VGLUT2_OPRM1_COMPOSITE/annotations_iteration4_vglut2withMu_12.13.24",
-    "detection_csv": r"/Volumes/backup driv/VP_qp_LF - ITERATION4 - VGLUT2_OPRM1_COMPOSITE/detections_iteration4_vglut2withMu_12.13.24_csv",
-    "annotation_csv": r"/Volumes/backup driv/VP_qp_LF - ITERATION4 - VGLUT2_OPRM1_COMPOSITE/annotations_iteration4_vglut2withMu_12.13.24_csv"
+    "raw_annotation": r"/Volumes/backup driv/VP_qp_LF - ITERATION4 - VGLUT2_OPRM1_COMPOSITE/annotations_iteration4_vglut2withMu_12.13.24"
 }
 
 # Define directories for saving pie charts
@@ -36,29 +44,6 @@ def convert_to_unix_path(win_path):
 # Convert all paths to Unix-like if necessary
 paths = {key: convert_to_unix_path(value) for key, value in paths.items()}
 
-# Ensure the output directories exist
-os.makedirs(paths["detection_csv"], exist_ok=True)
-os.makedirs(paths["annotation_csv"], exist_ok=True)
-
-# Function to convert text files to CSV
-def convert_text_to_csv(input_path, output_path):
-    for file in os.listdir(input_path):
-        if file.endswith(".txt"):
-            input_file = os.path.join(input_path, file)
-            output_file = os.path.join(output_path, file.replace(".txt", ".csv"))
-            try:
-                df = pd.read_csv(input_file, sep="\t")
-                df.to_csv(output_file, index=False)
-            except Exception as e:
-                print(f"Error converting {file}: {e}")
-
-# Convert raw detection and annotation files
-convert_text_to_csv(paths["raw_detection"], paths["detection_csv"])
-convert_text_to_csv(paths["raw_annotation"], paths["annotation_csv"])
-
-# Get all converted detection CSV files
-filelist = [f for f in os.listdir(paths["detection_csv"]) if f.endswith(".csv")]
-
 # Define Qupath colors and classifications
 QYellow = "AF568"
 QPPink = "AF647"
@@ -79,8 +64,8 @@ subcellular_metrics = [
     "Subcellular: Channel 2: Num clusters"
 ]
 
-# Initialize an empty dataframe with relevant columns
-DataDraft = pd.DataFrame(columns=[
+# Columns of the summary table, in output order
+summary_columns = [
     "Sample",
     "oprm1-: vglut2+ Cell Density (cells/mm^2)",
     "oprm1-: vglut2+ Cell Count",
@@ -102,85 +87,64 @@ DataDraft = pd.DataFrame(columns=[
     "Double Negative Cell Percentage",
     "Total Cell Area (mm^2)",
     "Total Annotation Area (mm^2)"
-] + [f"{metric} ({cls})" for metric in subcellular_metrics for cls in [Yellow_posName_2, Pink_posName_2, double_positive]])
-
-# Process each file
-for k, file in enumerate(filelist):
-    try:
-        det_data = pd.read_csv(os.path.join(paths["detection_csv"], file))
-        filename = file.replace(" Detections", "")
-        ano_file = os.path.join(paths["annotation_csv"], filename)
-        if not os.path.exists(ano_file):
-            continue
-        ano_data = pd.read_csv(ano_file)
-
-        # Subset data for specific cell populations
-        QPYellow_only = det_data[det_data['Classification'].isin([Yellow_posName, Yellow_posName_2])]
-        QPPink_only = det_data[det_data['Classification'].isin([Pink_posName, Pink_posName_2])]
-        QPboth = det_data[det_data['Classification'] == double_positive]
-        QPnone = det_data[det_data['Classification'] == double_negative]
-
-        # Calculate areas and statistics
-        posYellowArea = QPYellow_only['Cell: Area µm^2'].sum() / 1e6 if not QPYellow_only.empty else 0
-        posPinkArea = QPPink_only['Cell: Area µm^2'].sum() / 1e6 if not QPPink_only.empty else 0
-        posBothArea = QPboth['Cell: Area µm^2'].sum() / 1e6 if not QPboth.empty else 0
-        posNoneArea = QPnone['Cell: Area µm^2'].sum() / 1e6 if not QPnone.empty else 0
-        totalCellArea = posYellowArea + posPinkArea + posBothArea
-
-        realAnnotations = ano_data[ano_data['Object type'].isin(["Annotation", "PathAnnotationObject"])]
-        anoArea = realAnnotations['Area µm^2'].sum() / 1e6 if not realAnnotations.empty else 0
-
-        YellowIntensity = QPYellow_only['AF568: Cell: Mean'].mean() if not QPYellow_only.empty else None
-        PinkIntensity = QPPink_only['AF647: Cell: Mean'].mean() if not QPPink_only.empty else None
-
-        YellowCellCount = len(QPYellow_only)
-        PinkCellCount = len(QPPink_only)
-        bothCellCount = len(QPboth)
-        noneCellCount = len(QPnone)
-        totalCells = YellowCellCount + PinkCellCount + bothCellCount + noneCellCount
-
-        YellowPercentage = (YellowCellCount / totalCells * 100) if totalCells > 0 else None
-        PinkPercentage = (PinkCellCount / totalCells * 100) if totalCells > 0 else None
-        bothPercentage = (bothCellCount / totalCells * 100) if totalCells > 0 else None
-        nonePercentage = (noneCellCount / totalCells * 100) if totalCells > 0 else None
-
-        # Populate DataDraft
-        DataDraft.loc[k, "Sample"] = filename
-        DataDraft.loc[k, "oprm1-: vglut2+ Cell Density (cells/mm^2)"] = (PinkCellCount / totalCellArea) if totalCellArea > 0 else None
-        DataDraft.loc[k, "oprm1-: vglut2+ Cell Count"] = PinkCellCount
-        DataDraft.loc[k, "oprm1-: vglut2+ Cell Area (mm^2)"] = posPinkArea
-        DataDraft.loc[k, "oprm1-: vglut2+ Cell Percentage"] = PinkPercentage
-        DataDraft.loc[k, "oprm1-: vglut2+ Intensity"] = PinkIntensity
-
-        DataDraft.loc[k, "oprm1+: vglut2- Cell Density (cells/mm^2)"] = (YellowCellCount / totalCellArea) if totalCellArea > 0 else None
-        DataDraft.loc[k, "oprm1+: vglut2- Cell Count"] = YellowCellCount
-        DataDraft.loc[k, "oprm1+: vglut2- Cell Area (mm^2)"] = posYellowArea
-        DataDraft.loc[k, "oprm1+: vglut2- Cell Percentage"] = YellowPercentage
-        DataDraft.loc[k, "oprm1+: vglut2- Intensity"] = YellowIntensity
-
-        DataDraft.loc[k, "Double Positive Cell Density (cells/mm^2)"] = (bothCellCount / totalCellArea) if totalCellArea > 0 else None
-        DataDraft.loc[k, "Double Positive Cell Count"] = bothCellCount
-        DataDraft.loc[k, "Double Positive Cell Area (mm^2)"] = posBothArea
-        DataDraft.loc[k, "Double Positive Cell Percentage"] = bothPercentage
-
-        DataDraft.loc[k, "Double Negative Cell Density (cells/mm^2)"] = (noneCellCount / totalCellArea) if totalCellArea > 0 else None
-        DataDraft.loc[k, "Double Negative Cell Count"] = noneCellCount
-        DataDraft.loc[k, "Double Negative Cell Area (mm^2)"] = posNoneArea
-        DataDraft.loc[k, "Double Negative Cell Percentage"] = nonePercentage
-
-        DataDraft.loc[k, "Total Cell Area (mm^2)"] = totalCellArea
-        DataDraft.loc[k, "Total Cell Count"] = totalCells  # Add this line
-        DataDraft.loc[k, "Total Annotation Area (mm^2)"] = anoArea
-
-
-        # Subcellular metrics
-        for cls in [Yellow_posName_2, Pink_posName_2, double_positive, double_negative]:
-            cls_data = det_data[det_data['Classification'] == cls]
-            for metric in subcellular_metrics:
-                DataDraft.loc[k, f"{metric} ({cls})"] = cls_data[metric].sum() if metric in cls_data.columns else None
-
-    except Exception as e:
-        print(f"Error processing {file}: {e}")
+] + [f"{metric} ({cls})" for metric in subcellular_metrics for cls in [Yellow_posName_2, Pink_posName_2, double_positive]]
+
+# Cell populations reported in the summary, with the channel used for their mean intensity
+cell_groups = {
+    "oprm1-: vglut2+": {"labels": [Pink_posName, Pink_posName_2], "intensity": f"{QPPink}: Cell: Mean"},
+    "oprm1+: vglut2-": {"labels": [Yellow_posName, Yellow_posName_2], "intensity": f"{QYellow}: Cell: Mean"},
+    "Double Positive": {"labels": [double_positive]},
+    "Double Negative": {"labels": [double_negative]}
+}
+
+# Classifications whose subcellular metrics are summed
+subcellular_classes = [Yellow_posName_2, Pink_posName_2, double_positive, double_negative]
+
+# Double negative cells are left out of the total cell area but counted in the percentages
+summary_options = {
+    "area_groups": ["oprm1-: vglut2+", "oprm1+: vglut2-", "Double Positive"],
+    "include_total_count": True
+}
+
+# Offline reclassification: marker -> positivity rule (see reclassification.py) to recompute the
+# classifications from the exported measurements instead of using QuPath's (None: keep QuPath's), e.g.
+# reclassification_rules = {"vglut2": {"column": f"{QPPink}: Cell: Mean", "threshold": 150},
+#                           "oprm1": {"column": f"{QYellow}: Cell: Mean", "threshold": 120}}
+reclassification_rules = None
+
+# Incremental mode: only new or changed exports are processed, the rest of the table comes
+# from the manifest written next to the outputs (set to False to recompute every sample)
+incremental = True
+manifest_path = "vglut2_oprm1_subcellular_metrics.manifest.json"
+
+# Samples keep the names of the CSV copies the table was built from before the .txt exports
+# were read directly ("... Scene #N.csv")
+sample_suffix = ".csv"
+
+# Process one image (run in a worker process): returns its one-row summary record, or None when
+# the image has no matching annotation export
+def process_sample(file):
+    filename = file.replace(" Detections", "")
+    ano_file = os.path.join(paths["raw_annotation"], filename)
+    if not os.path.exists(ano_file):
+        return None
+    det_data = read_export(os.path.join(paths["raw_detection"], file))
+    ano_data = read_export(ano_file)
+    if reclassification_rules:
+        det_data = reclassify(det_data, reclassification_rules, update_children=False)
+
+    # Missing subcellular metric columns are allowed (reported as None); anything else must exist
+    needed = [col for col in detection_columns(cell_groups, subcellular_metrics)
+              if col in det_data.columns or col not in subcellular_metrics]
+    sample = (os.path.splitext(filename)[0] + sample_suffix, det_data[needed], annotation_area(ano_data))
+    summary = summarize_samples([sample], cell_groups, subcellular_classes, subcellular_metrics, **summary_options)
+    return summary.to_dict("records")[0]
+
+
+# Fingerprint of one image's inputs (detection and annotation export) for the incremental manifest
+def sample_fingerprint(file):
+    ano_file = os.path.join(paths["raw_annotation"], file.replace(" Detections", ""))
+    return [path_fingerprint(os.path.join(paths["raw_detection"], file)), path_fingerprint(ano_file)]
 
 
 ##NEED TO FIX
@@ -273,6 +237,39 @@ for k, file in enumerate(filelist):
 
 
 
-# Write the results to CSV and XLSX
-DataDraft.to_csv("vglut2_oprm1_subcellular_metrics.csv", index=False)
-DataDraft.to_excel("vglut2_oprm1_subcellular_metrics.xlsx", index=False)
+
+if __name__ == "__main__":
+    # Stage timings, memory and rows read are reported when PUNCTA_PROFILE is set (see instrumentation.py)
+    instrumentation.phase("scan")
+
+    # Get all raw detection exports (parsed once and served from the columnar cache afterwards)
+    filelist = list_exports(paths["raw_detection"])
+
+    # Work out which exports are new or changed since the last run
+    fingerprints = {file: sample_fingerprint(file) for file in filelist}
+    manifest = SampleManifest(manifest_path, settings_hash(cell_groups, subcellular_classes, subcellular_metrics, summary_options, reclassification_rules, sample_suffix))
+    removed = manifest.prune(filelist)
+    todo = manifest.stale(fingerprints) if incremental else filelist
+    print(f"Processing {len(todo)} of {len(filelist)} samples ({len(removed)} removed since the last run)")
+
+    # Read and summarize the images in a process pool (one summary row per image comes back,
+    # in todo order)
+    instrumentation.phase("summarize samples")
+    results = run_per_file(process_sample, todo, n_workers=N_WORKERS)
+    for file, row in zip(todo, results):
+        if row is None:
+            manifest.discard(file)
+        else:
+            manifest.update(file, fingerprints[file], row)
+    manifest.save()
+
+    # Rebuild the full table from the stored rows
+    DataDraft = pd.DataFrame(manifest.rows(filelist))
+    DataDraft = DataDraft.reindex(columns=summary_columns + [col for col in DataDraft.columns if col not in summary_columns])
+
+    # Write the results to CSV and XLSX
+    instrumentation.phase("write csv")
+    DataDraft.to_csv("vglut2_oprm1_subcellular_metrics.csv", index=False)
+    instrumentation.phase("write xlsx")
+    DataDraft.to_excel("vglut2_oprm1_subcellular_metrics.xlsx", index=False)
+    instrumentation.report()